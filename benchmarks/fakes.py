@@ -0,0 +1,123 @@
+import re
+import time
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+EMBEDDING_DIMENSIONS = 768
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+def _token_vector(token: str) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(token.encode("utf-8")).digest()[:8], "big")
+    return np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSIONS).astype(np.float32)
+
+class FakeEmbeddings:
+    """
+    Sustituto determinista de GoogleGenerativeAIEmbeddings: suma de vectores aleatorios
+    por palabra (hashing), de modo que las paráfrasis que comparten palabras quedan
+    cerca. latency_ms simula la llamada remota (una por lote).
+    """
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.calls = 0
+        self._tokens = {}
+
+    def _embed(self, text_value: str) -> list:
+        vec = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+        for token in _TOKEN.findall(text_value.lower()):
+            if token not in self._tokens:
+                self._tokens[token] = _token_vector(token)
+            vec += self._tokens[token]
+        return vec.tolist()
+
+    def embed_query(self, text_value: str) -> list:
+        self.calls += 1
+        time.sleep(self.latency)
+        return self._embed(text_value)
+
+    def embed_documents(self, texts: list, task_type: str = None) -> list:
+        self.calls += 1
+        time.sleep(self.latency)
+        return [self._embed(t) for t in texts]
+
+    async def aembed_query(self, text_value: str) -> list:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self._embed(text_value)
+
+    async def aembed_documents(self, texts: list, task_type: str = None) -> list:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return [self._embed(t) for t in texts]
+
+class FakeMessage:
+    def __init__(self, content: str):
+        self.content = content
+
+class FakeChatModel:
+    """
+    Sustituto de ChatGoogleGenerativeAI: responde con un texto derivado del último
+    mensaje tras first_token_ms + tokens * token_ms, y emite los tokens uno a uno en
+    stream/astream.
+    """
+
+    def __init__(self, first_token_ms: float = 300.0, token_ms: float = 10.0, tokens: int = 40):
+        self.first_token = first_token_ms / 1000
+        self.per_token = token_ms / 1000
+        self.tokens = tokens
+        self.calls = 0
+
+    def _answer(self, messages) -> list:
+        prompt = messages[-1][1] if isinstance(messages[-1], tuple) else str(messages[-1])
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return [f"{digest[i % 64:i % 64 + 4]} " for i in range(self.tokens)]
+
+    def invoke(self, messages, config=None):
+        self.calls += 1
+        parts = self._answer(messages)
+        time.sleep(self.first_token + self.per_token * len(parts))
+        return FakeMessage("".join(parts))
+
+    async def ainvoke(self, messages, config=None):
+        self.calls += 1
+        parts = self._answer(messages)
+        await asyncio.sleep(self.first_token + self.per_token * len(parts))
+        return FakeMessage("".join(parts))
+
+    def batch(self, inputs, config=None, return_exceptions=False):
+        workers = (config or {}).get("max_concurrency") or max(len(inputs), 1)
+
+        def one(messages):
+            try:
+                return self.invoke(messages)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(one, inputs))
+
+    async def abatch(self, inputs, config=None, return_exceptions=False):
+        semaphore = asyncio.Semaphore((config or {}).get("max_concurrency") or max(len(inputs), 1))
+
+        async def one(messages):
+            async with semaphore:
+                return await self.ainvoke(messages)
+        return await asyncio.gather(*(one(messages) for messages in inputs), return_exceptions=return_exceptions)
+
+    def stream(self, messages, config=None):
+        self.calls += 1
+        time.sleep(self.first_token)
+        for part in self._answer(messages):
+            time.sleep(self.per_token)
+            yield FakeMessage(part)
+
+    async def astream(self, messages, config=None):
+        self.calls += 1
+        await asyncio.sleep(self.first_token)
+        for part in self._answer(messages):
+            await asyncio.sleep(self.per_token)
+            yield FakeMessage(part)
@@ -0,0 +1,203 @@
+"""
+Benchmark de carga offline: modelos falsos (benchmarks.fakes) con latencia configurable,
+Postgres+pgvector local inicializado con db/init.sql y prompts con repeticiones Zipf y
+paráfrasis lanzados contra los endpoints de la API dentro del mismo proceso.
+
+Ejemplo (con `docker compose up db` y las variables POSTGRES_* de config/.env):
+
+    python -m benchmarks.run --reset --requests 500 --concurrency 16 --json bench.json
+    python -m benchmarks.run --reset --compare bench.json --max-regression 0.2
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+from statistics import mean
+
+from benchmarks.fakes import FakeEmbeddings, FakeChatModel
+from benchmarks.workload import synthetic_corpus, base_questions, zipf_workload
+
+INIT_SQL = Path(__file__).resolve().parent.parent / "db" / "init.sql"
+BENCHMARK_TABLES = [
+    "documents", "document_parents", "index_checkpoints", "corpus_state", "embedding_cache", "query_logs",
+    "semantic_cache", "context_texts", "exact_cache",
+]
+ENDPOINTS = {"exact": "/rag/query_exact", "semantic": "/rag/query_semantic"}
+# Etapas que consisten en consultas a Postgres (el resto son modelo o CPU)
+DB_STAGES = ("cache_probe", "document_search", "cache_write")
+
+def reset_database():
+    """Aplica db/init.sql y vacía las tablas, para que cada ejecución parta del mismo estado."""
+    import psycopg
+    from src.app.db import POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_DB, POSTGRES_HOST, POSTGRES_PORT
+    # Conexión directa: el engine registra el tipo vector al conectar y la extensión puede no existir aún
+    with psycopg.connect(
+        host=POSTGRES_HOST, port=POSTGRES_PORT, dbname=POSTGRES_DB,
+        user=POSTGRES_USER, password=POSTGRES_PASSWORD, autocommit=True
+    ) as conn:
+        conn.execute(INIT_SQL.read_text())
+        conn.execute(f"TRUNCATE {', '.join(BENCHMARK_TABLES)}")
+        conn.execute("INSERT INTO corpus_state (id, version) VALUES (TRUE, 0)")
+
+def install_fakes(args):
+    """Sustituye los modelos de Google antes de que dependencies cree Retriever e Indexer."""
+    import src.retriever.retriever as retriever_module
+    from src.cache import embedding_cache
+    from src.cache.embedding_cache import CachedEmbeddings, PostgresEmbeddingStore, EMBEDDING_CACHE_BACKEND
+
+    embeddings = FakeEmbeddings(latency_ms=args.embed_latency_ms)
+    llm = FakeChatModel(first_token_ms=args.llm_first_token_ms, token_ms=args.llm_token_ms, tokens=args.llm_tokens)
+    store = PostgresEmbeddingStore() if EMBEDDING_CACHE_BACKEND == "postgres" else None
+    embedding_cache._shared_embeddings[retriever_module.EMBEDDING_MODEL] = CachedEmbeddings(
+        embeddings, retriever_module.EMBEDDING_MODEL, store=store
+    )
+    retriever_module.create_llm = lambda: llm
+    return embeddings, llm
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return round(ordered[index], 2)
+
+def summarize(samples: list, wall_seconds: float) -> dict:
+    """samples: (latencia_ms, cache_status, timings) de cada petición de un endpoint."""
+    latencies = [s[0] for s in samples]
+    statuses = {}
+    for _, cache_status, _ in samples:
+        statuses[cache_status] = statuses.get(cache_status, 0) + 1
+    stages = {}
+    for _, _, timings in samples:
+        for name, value in (timings or {}).items():
+            stages.setdefault(name, []).append(value)
+    return {
+        "requests": len(samples),
+        "throughput_rps": round(len(samples) / wall_seconds, 2) if wall_seconds else 0.0,
+        "latency_ms": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "p99": percentile(latencies, 99)},
+        "hit_rate": round(statuses.get("hit", 0) / len(samples), 4) if samples else 0.0,
+        "cache_status": statuses,
+        "stages_ms": {
+            name: {"mean": round(mean(values), 2), "p50": percentile(values, 50), "p99": percentile(values, 99)}
+            for name, values in sorted(stages.items())
+        },
+        "db_ms_mean": round(sum(mean(stages[name]) for name in DB_STAGES if name in stages), 2),
+    }
+
+async def replay(client, path: str, prompts: list, concurrency: int) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+
+    async def one(prompt):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(path, json={"prompt": prompt})
+            elapsed = (time.perf_counter() - start) * 1000
+            response.raise_for_status()
+            body = response.json()
+            samples.append((elapsed, body.get("cache_status", "unknown"), body.get("timings")))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(prompt) for prompt in prompts))
+    return samples, time.perf_counter() - start
+
+async def run_benchmark(args) -> dict:
+    import httpx
+    from src.app.main import app
+    from src.app.dependencies import get_indexer
+
+    # Sin rate limit: todas las peticiones llegan desde la misma "IP"
+    app.state.limiter.enabled = False
+    questions = base_questions(args.questions)
+    prompts = zipf_workload(questions, args.requests, zipf_s=args.zipf_s, paraphrase_rate=args.paraphrase_rate)
+    report = {"config": vars(args).copy(), "endpoints": {}}
+    report["config"].pop("compare", None)
+    report["config"].pop("json", None)
+
+    async with app.router.lifespan_context(app):
+        if args.corpus_size:
+            start = time.perf_counter()
+            indexed, deduplicated = await asyncio.to_thread(get_indexer().index_documents, synthetic_corpus(args.corpus_size))
+            report["indexing"] = {"chunks": indexed, "deduplicated": deduplicated, "seconds": round(time.perf_counter() - start, 2)}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for name in args.endpoints:
+                path = ENDPOINTS[name]
+                # Tamaño de cache inicial: las primeras --prefill preguntas se responden una vez sin medir
+                if args.prefill:
+                    await replay(client, path, questions[:args.prefill], args.concurrency)
+                samples, wall = await replay(client, path, prompts, args.concurrency)
+                report["endpoints"][name] = summarize(samples, wall)
+    return report
+
+def compare(report: dict, baseline: dict, max_regression: float) -> list:
+    """Devuelve las métricas que empeoran más de max_regression respecto a la referencia."""
+    regressions = []
+    for name, current in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if previous is None:
+            continue
+        for q in ("p50", "p99"):
+            before, after = previous["latency_ms"][q], current["latency_ms"][q]
+            if before and after > before * (1 + max_regression):
+                regressions.append(f"{name} {q}: {before} ms -> {after} ms")
+        before, after = previous["throughput_rps"], current["throughput_rps"]
+        if before and after < before * (1 - max_regression):
+            regressions.append(f"{name} throughput: {before} rps -> {after} rps")
+    return regressions
+
+def print_report(report: dict):
+    if "indexing" in report:
+        print(f"indexado: {report['indexing']['chunks']} chunks en {report['indexing']['seconds']} s")
+    for name, result in report["endpoints"].items():
+        latency = result["latency_ms"]
+        print(
+            f"{name}: {result['requests']} peticiones, {result['throughput_rps']} rps, "
+            f"p50={latency['p50']} ms p95={latency['p95']} ms p99={latency['p99']} ms, "
+            f"hit_rate={result['hit_rate']} {result['cache_status']}"
+        )
+        for stage, values in result["stages_ms"].items():
+            print(f"    {stage:<16} mean={values['mean']} ms p50={values['p50']} ms p99={values['p99']} ms")
+        if result["stages_ms"]:
+            print(f"    db (total medio) {result['db_ms_mean']} ms")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--endpoints", nargs="+", choices=sorted(ENDPOINTS), default=["exact", "semantic"])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--questions", type=int, default=100, help="Preguntas distintas del workload")
+    parser.add_argument("--zipf-s", type=float, default=1.1)
+    parser.add_argument("--paraphrase-rate", type=float, default=0.3)
+    parser.add_argument("--corpus-size", type=int, default=200, help="Documentos sintéticos a indexar (0 = no indexar)")
+    parser.add_argument("--prefill", type=int, default=0, help="Preguntas respondidas antes de medir")
+    parser.add_argument("--embed-latency-ms", type=float, default=50.0)
+    parser.add_argument("--llm-first-token-ms", type=float, default=300.0)
+    parser.add_argument("--llm-token-ms", type=float, default=10.0)
+    parser.add_argument("--llm-tokens", type=int, default=40)
+    parser.add_argument("--reset", action="store_true", help="Aplica db/init.sql y vacía las tablas antes de empezar")
+    parser.add_argument("--json", help="Guarda el informe en este fichero")
+    parser.add_argument("--compare", help="Informe JSON de referencia")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.reset:
+        reset_database()
+    install_fakes(args)
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.compare:
+        regressions = compare(report, json.loads(Path(args.compare).read_text()), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESIÓN {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
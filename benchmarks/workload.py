@@ -0,0 +1,60 @@
+import random
+
+TOPICS = [
+    "facturación", "envíos", "devoluciones", "garantía", "suscripción", "contraseña", "privacidad",
+    "reembolsos", "inventario", "descuentos", "soporte", "integraciones", "exportación", "seguridad",
+    "facturas", "pagos", "tarifas", "usuarios", "permisos", "notificaciones",
+]
+ACTIONS = [
+    "cambiar", "cancelar", "configurar", "consultar", "activar", "desactivar", "solicitar",
+    "actualizar", "revisar", "recuperar",
+]
+QUESTION_TEMPLATES = [
+    "¿Cómo puedo {action} {topic}?",
+    "¿Qué pasos hay que seguir para {action} {topic}?",
+    "¿Es posible {action} {topic} desde la aplicación?",
+    "¿Cuánto tarda en {action} {topic}?",
+]
+PARAPHRASE_PREFIXES = ["", "Hola, ", "Por favor, ", "Una duda: ", "Perdona, "]
+PARAPHRASE_SUFFIXES = ["", " Gracias.", " ¿Me ayudas?", " Es urgente."]
+
+def synthetic_corpus(size: int, seed: int = 7) -> list:
+    """Documentos sintéticos sobre los mismos temas que las preguntas, uno por (tema, acción)."""
+    rng = random.Random(seed)
+    documents = []
+    for i in range(size):
+        topic = TOPICS[i % len(TOPICS)]
+        action = ACTIONS[(i // len(TOPICS)) % len(ACTIONS)]
+        steps = " ".join(
+            f"Paso {n + 1}: {rng.choice(ACTIONS)} la sección de {rng.choice(TOPICS)} y confirma los cambios."
+            for n in range(rng.randint(3, 8))
+        )
+        documents.append(f"Guía {i}: para {action} {topic} entra en la configuración de la cuenta. {steps}")
+    return documents
+
+def base_questions(count: int, seed: int = 11) -> list:
+    rng = random.Random(seed)
+    questions = set()
+    while len(questions) < count:
+        template = rng.choice(QUESTION_TEMPLATES)
+        questions.add(template.format(action=rng.choice(ACTIONS), topic=rng.choice(TOPICS)))
+    return sorted(questions)
+
+def paraphrase(question: str, rng: random.Random) -> str:
+    """Variación superficial (saludo, cierre, mayúsculas) de la misma pregunta."""
+    text_value = rng.choice(PARAPHRASE_PREFIXES) + question + rng.choice(PARAPHRASE_SUFFIXES)
+    if rng.random() < 0.3:
+        text_value = text_value.lower()
+    return text_value
+
+def zipf_workload(questions: list, requests: int, zipf_s: float = 1.1, paraphrase_rate: float = 0.3, seed: int = 13) -> list:
+    """
+    Secuencia de prompts donde la pregunta de rango k aparece con probabilidad
+    proporcional a 1 / k^zipf_s; una fracción paraphrase_rate se reformula.
+    """
+    rng = random.Random(seed)
+    weights = [1 / (rank ** zipf_s) for rank in range(1, len(questions) + 1)]
+    prompts = []
+    for question in rng.choices(questions, weights=weights, k=requests):
+        prompts.append(paraphrase(question, rng) if rng.random() < paraphrase_rate else question)
+    return prompts
@@ -7,11 +7,72 @@ CREATE TABLE IF NOT EXISTS documents (
     content TEXT NOT NULL,
     embedding vector(768) NOT NULL,
     metadata JSONB,
+    -- Cada fila es un chunk: SHA-256 de su texto, SHA-256 del documento original y posición.
+    -- parent_id y chunk_index son los del primer documento que lo introdujo; el linaje
+    -- completo (chunks compartidos por varios documentos) está en document_parents
+    content_hash BYTEA NOT NULL,
+    parent_id BYTEA NOT NULL,
+    chunk_index INT NOT NULL DEFAULT 0,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Índice para búsquedas vectoriales
-CREATE INDEX IF NOT EXISTS idx_documents_embedding ON documents USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+-- Deduplicación: reindexar el mismo texto no crea filas nuevas
+CREATE UNIQUE INDEX IF NOT EXISTS idx_documents_content_hash ON documents (content_hash);
+CREATE INDEX IF NOT EXISTS idx_documents_parent_id ON documents (parent_id);
+
+-- Linaje chunk -> documento original: un chunk deduplicado se guarda una sola vez en documents
+-- pero tiene una fila por cada documento (parent_id) y posición en que aparece
+CREATE TABLE IF NOT EXISTS document_parents (
+    parent_id BYTEA NOT NULL,
+    chunk_index INT NOT NULL,
+    document_id INT NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    PRIMARY KEY (parent_id, chunk_index)
+);
+CREATE INDEX IF NOT EXISTS idx_document_parents_document_id ON document_parents (document_id);
+
+-- Índice ANN para búsquedas vectoriales. Las consultas usan <#> (producto interno negativo)
+-- sobre embeddings normalizados, por lo que la clase de operadores debe ser vector_ip_ops.
+-- Para cambiar a ivfflat: python -m src.app.db.vector_index --rebuild (con VECTOR_INDEX_TYPE=ivfflat)
+CREATE INDEX IF NOT EXISTS idx_documents_embedding ON documents USING hnsw (embedding vector_ip_ops) WITH (m = 16, ef_construction = 64);
+
+-- Progreso de ingestas en streaming (/rag/index/upload, Indexer.index_stream):
+-- documentos confirmados por job_id, para reanudar tras un fallo
+CREATE TABLE IF NOT EXISTS index_checkpoints (
+    job_id TEXT PRIMARY KEY,
+    processed BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Versión del corpus: el Indexer la incrementa en cada cambio de documents. Una entrada del
+-- semantic cache generada con una versión anterior a la actual se guarda ya marcada como stale.
+CREATE TABLE IF NOT EXISTS corpus_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO corpus_state (id, version) VALUES (TRUE, 0) ON CONFLICT (id) DO NOTHING;
+
+-- Estado compartido del mantenimiento de caches (src/cache/maintenance.py): último ciclo,
+-- último VACUUM y último REINDEX, comunes a todos los workers y réplicas
+CREATE TABLE IF NOT EXISTS cache_maintenance_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    last_run_at TIMESTAMP,
+    last_vacuum_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_reindex_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO cache_maintenance_state (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING;
+
+-- Cache persistente de embeddings, direccionada por contenido (modelo, tarea, SHA-256 del texto)
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    model TEXT NOT NULL,
+    task TEXT NOT NULL,
+    text_hash BYTEA NOT NULL,
+    embedding vector(768) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (model, task, text_hash)
+);
 
 -- Tabla para logging de queries
 CREATE TABLE IF NOT EXISTS query_logs (
@@ -33,35 +94,86 @@ CREATE TABLE IF NOT EXISTS public.semantic_cache (
     -- Embedding del prompt, para hacer búsqueda semántica
     prompt_embedding vector(768) NOT NULL,
 
-    -- Texto del contexto usado para generar la respuesta
-    context TEXT NOT NULL,
-
-    -- Hash SHA256 del contexto, para verificar si sigue siendo el mismo
+    -- Hash SHA256 del contexto, para verificar si sigue siendo el mismo.
+    -- El texto del contexto se guarda una sola vez en context_texts
     context_hash TEXT NOT NULL,
 
     -- Respuesta generada por el LLM
     response TEXT NOT NULL,
 
+    -- Versión del corpus (corpus_state.version) con la que se generó la respuesta
+    corpus_version BIGINT NOT NULL DEFAULT 0,
+
+    -- Radio propio de la entrada (más estricto que CACHE_DISTANCE_THRESHOLD en zonas densas);
+    -- NULL = se usa el threshold global
+    radius REAL,
+
+    -- Documentos (top-K) detrás de la respuesta y distancia <#> del K-ésimo al prompt:
+    -- un documento nuevo más cercano que kth_distance habría cambiado el contexto.
+    -- NULL = había menos de K documentos (cualquier documento nuevo entra en el top-K)
+    document_ids INT[] NOT NULL DEFAULT '{}',
+    kth_distance REAL,
+
+    -- Marcada por el Indexer cuando un documento insertado, actualizado o borrado afecta a su
+    -- top-K; el pipeline cache-first no reutiliza entradas stale
+    stale BOOLEAN NOT NULL DEFAULT false,
+
+    -- Uso de la entrada para el desalojo LFU/LRU (src/cache/maintenance.py)
+    hit_count INTEGER NOT NULL DEFAULT 0,
+    last_accessed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
     -- Timestamp automático
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Contextos compartidos por las entradas del semantic cache, una fila por context_hash
+CREATE TABLE IF NOT EXISTS public.context_texts (
+    context_hash TEXT PRIMARY KEY,
+    context TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Índice para búsquedas vectoriales en la tabla de semantic_cache
-CREATE INDEX IF NOT EXISTS idx_semantic_cache_embedding ON semantic_cache USING ivfflat (prompt_embedding vector_cosine_ops) WITH (lists = 100);
+CREATE INDEX IF NOT EXISTS idx_semantic_cache_embedding ON semantic_cache USING hnsw (prompt_embedding vector_ip_ops) WITH (m = 16, ef_construction = 64);
+
+-- Índice por contexto: la búsqueda semántica filtra por context_hash y ordena por distancia
+-- solo las entradas de ese contexto (normalmente pocas), evitando respuestas de un índice anterior.
+-- Si el contexto es poco selectivo, el planner usa el índice HNSW con hnsw.iterative_scan
+CREATE INDEX IF NOT EXISTS idx_semantic_cache_context_hash ON semantic_cache (context_hash);
+
+-- Búsqueda inversa documento -> entradas del semantic cache al actualizar o borrar documentos
+CREATE INDEX IF NOT EXISTS idx_semantic_cache_document_ids ON semantic_cache USING gin (document_ids);
+
+-- Entradas vigentes por kth_distance: las que cualquier documento nuevo invalida (kth_distance
+-- NULL, menos de K documentos al guardarse) y el mayor kth_distance que acota la búsqueda ANN
+CREATE INDEX IF NOT EXISTS idx_semantic_cache_kth_distance ON semantic_cache (kth_distance) WHERE NOT stale;
 
 -- Tabla para almacenamiento de respuestas para exact cache
 CREATE TABLE IF NOT EXISTS public.exact_cache (
     id SERIAL PRIMARY KEY,
 
-    -- Prompt exacto que ingresó el usuario
+    -- SHA-256 (32 bytes) del prompt normalizado, clave de búsqueda
+    prompt_hash BYTEA NOT NULL,
+
+    -- Prompt original que ingresó el usuario
     prompt TEXT NOT NULL,
 
     -- Respuesta generada por el LLM en su momento
     response TEXT NOT NULL,
 
+    -- Uso de la entrada para el desalojo LFU/LRU (src/cache/maintenance.py)
+    hit_count INTEGER NOT NULL DEFAULT 0,
+    last_accessed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
     -- Timestamp de creación
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Índice por prompt para búsquedas rápidas
-CREATE INDEX IF NOT EXISTS idx_exact_cache_prompt ON public.exact_cache (prompt);
\ No newline at end of file
+-- Índice único por hash del prompt: búsquedas con una sola clave pequeña y upserts sin duplicados
+CREATE UNIQUE INDEX IF NOT EXISTS idx_exact_cache_prompt_hash ON public.exact_cache (prompt_hash);
+
+-- Índices para el mantenimiento: TTL por created_at y desalojo por último acceso
+CREATE INDEX IF NOT EXISTS idx_semantic_cache_created_at ON semantic_cache (created_at);
+CREATE INDEX IF NOT EXISTS idx_semantic_cache_last_accessed_at ON semantic_cache (last_accessed_at);
+CREATE INDEX IF NOT EXISTS idx_exact_cache_created_at ON exact_cache (created_at);
+CREATE INDEX IF NOT EXISTS idx_exact_cache_last_accessed_at ON exact_cache (last_accessed_at);
@@ -0,0 +1,7 @@
+import os
+from dotenv import load_dotenv
+
+# Única carga de config/.env: la importan primero los módulos que leen variables de entorno
+# al importarse. Las variables ya definidas en el entorno (docker compose) tienen prioridad.
+ENV_FILE = os.getenv("RAG_ENV_FILE", os.path.join(os.path.dirname(__file__), '../../config/.env'))
+load_dotenv(ENV_FILE)
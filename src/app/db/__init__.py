@@ -1,11 +1,10 @@
 import os
-from sqlalchemy import create_engine
+from contextlib import contextmanager, asynccontextmanager
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
-from dotenv import load_dotenv
 import json
-
-load_dotenv(os.path.join(os.path.dirname(__file__), '../../../config/.env'))
+import src.app.config  # noqa: F401  (carga config/.env)
 
 POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
@@ -13,40 +12,183 @@ POSTGRES_DB = os.getenv("POSTGRES_DB")
 POSTGRES_HOST = os.getenv("POSTGRES_HOST")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT")
 
-DATABASE_URL = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+# Pool de conexiones (por proceso; el engine async tiene su propio pool con los mismos valores)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Sentencias preparadas: psycopg prepara una consulta en el servidor a partir de su
+# ejecución número DB_PREPARE_THRESHOLD en la misma conexión (vacío = nunca, p. ej. con
+# pgbouncer en modo transaction); asyncpg guarda hasta DB_PREPARED_STATEMENT_CACHE_SIZE
+DB_PREPARE_THRESHOLD = os.getenv("DB_PREPARE_THRESHOLD", "2")
+DB_PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv("DB_PREPARED_STATEMENT_CACHE_SIZE", "256"))
+
+DATABASE_URL = f"postgresql+psycopg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+ASYNC_DATABASE_URL = (
+    f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+    f"?prepared_statement_cache_size={DB_PREPARED_STATEMENT_CACHE_SIZE}"
+)
+
+POOL_OPTIONS = {
+    "pool_pre_ping": True,
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_timeout": DB_POOL_TIMEOUT,
+}
+
+# Los engines se crean al primer uso (o en el arranque, src/app/startup.py): importar
+# el módulo no carga el driver ni abre conexiones
+_engine = None
+_SessionLocal = None
+# El engine async (asyncpg) solo se necesita en modo async
+_async_engine = None
+_AsyncSessionLocal = None
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def get_engine():
+    global _engine, _SessionLocal
+    if _engine is None:
+        _engine = create_engine(
+            DATABASE_URL,
+            connect_args={"prepare_threshold": int(DB_PREPARE_THRESHOLD) if DB_PREPARE_THRESHOLD else None},
+            **POOL_OPTIONS
+        )
+
+        @event.listens_for(_engine, "connect")
+        def _register_vector_sync(dbapi_connection, connection_record):
+            # Adaptador de pgvector para psycopg 3: los arrays de NumPy se envían en binario
+            from pgvector.psycopg import register_vector
+            register_vector(dbapi_connection)
+
+        _SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=_engine)
+    return _engine
 
 def get_db_session():
+    get_engine()
     try:
-        db = SessionLocal()
+        db = _SessionLocal()
         return db
     except SQLAlchemyError as e:
         raise RuntimeError(f"Error connecting to DB: {e}")
 
-def log_query(session, endpoint: str, request_body: bytes, response: str, status_code: int):
+def get_async_engine():
+    global _async_engine, _AsyncSessionLocal
+    if _async_engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+        from pgvector.asyncpg import register_vector
+
+        _async_engine = create_async_engine(ASYNC_DATABASE_URL, **POOL_OPTIONS)
+
+        @event.listens_for(_async_engine.sync_engine, "connect")
+        def _register_vector(dbapi_connection, connection_record):
+            # Codec binario de pgvector para asyncpg, equivalente al adaptador sync
+            dbapi_connection.run_async(register_vector)
+
+        _AsyncSessionLocal = async_sessionmaker(_async_engine, autoflush=False, expire_on_commit=False)
+    return _async_engine
+
+def get_async_db_session():
+    get_async_engine()
     try:
-        from sqlalchemy import text
-        request_json = request_body.decode('utf-8') if request_body else '{}'
+        return _AsyncSessionLocal()
+    except SQLAlchemyError as e:
+        raise RuntimeError(f"Error connecting to DB: {e}")
+
+@contextmanager
+def reuse_session(session=None, factory=None):
+    """
+    Usa la sesión de la petición si se recibe; si no, abre una con factory
+    (get_db_session por defecto) y la cierra al salir. Ante un error se hace
+    rollback para que la sesión compartida siga siendo utilizable.
+    """
+    if session is not None:
         try:
-            json.loads(response)
-            response_json = response
+            yield session
         except Exception:
-            response_json = '{}'
+            session.rollback()
+            raise
+        return
+    own = (factory or get_db_session)()
+    try:
+        yield own
+    finally:
+        own.close()
+
+@asynccontextmanager
+async def areuse_session(session=None, factory=None):
+    """Variante async de reuse_session."""
+    if session is not None:
+        try:
+            yield session
+        except Exception:
+            await session.rollback()
+            raise
+        return
+    async with (factory or get_async_db_session)() as own:
+        yield own
+
+def get_request_session():
+    """Dependencia de FastAPI: una sesión por petición, cerrada al terminar la respuesta."""
+    session = get_db_session()
+    try:
+        yield session
+    finally:
+        session.close()
+
+async def get_async_request_session():
+    async with get_async_db_session() as session:
+        yield session
+
+def dispose_engine():
+    global _engine, _SessionLocal
+    if _engine is not None:
+        _engine.dispose()
+        _engine = None
+        _SessionLocal = None
+
+async def dispose_async_engine():
+    global _async_engine, _AsyncSessionLocal
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+        _AsyncSessionLocal = None
+
+def _as_json(value, default: str = '{}') -> str:
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', errors='replace')
+    if not value:
+        return default
+    try:
+        json.loads(value)
+        return value
+    except Exception:
+        return default
+
+def log_queries(session, entries):
+    """
+    Inserta varias filas en query_logs con un solo INSERT multi-fila.
+    entries: lista de (endpoint, request_body, response, status_code).
+    """
+    if not entries:
+        return
+    try:
+        from sqlalchemy import text
+        values = []
+        params = {}
+        for i, (endpoint, request_body, response, status_code) in enumerate(entries):
+            values.append(f"(:endpoint_{i}, :request_{i}, :response_{i}, :status_code_{i})")
+            params[f"endpoint_{i}"] = endpoint
+            params[f"request_{i}"] = _as_json(request_body)
+            params[f"response_{i}"] = _as_json(response)
+            params[f"status_code_{i}"] = status_code
         session.execute(
-            text("""
+            text(f"""
                 INSERT INTO query_logs (endpoint, request, response, status_code)
-                VALUES (:endpoint, :request, :response, :status_code)
+                VALUES {", ".join(values)}
             """),
-            {
-                "endpoint": endpoint,
-                "request": request_json,
-                "response": response_json,
-                "status_code": status_code
-            }
+            params
         )
         session.commit()
     except Exception as e:
         session.rollback()
-        raise e 
\ No newline at end of file
+        raise e
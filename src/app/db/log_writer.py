@@ -0,0 +1,124 @@
+import os
+import queue
+import random
+import threading
+from loguru import logger
+from src.app.db import get_db_session, log_queries
+from src.app.metrics import timed
+
+# Cola acotada entre las peticiones y el escritor en segundo plano
+LOG_QUEUE_MAX_SIZE = int(os.getenv("LOG_QUEUE_MAX_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "200"))
+LOG_FLUSH_INTERVAL_SECONDS = float(os.getenv("LOG_FLUSH_INTERVAL_SECONDS", "1.0"))
+# Con la cola por encima de este nivel (fracción) solo se guarda una muestra de las peticiones OK
+LOG_BACKPRESSURE_WATERMARK = float(os.getenv("LOG_BACKPRESSURE_WATERMARK", "0.8"))
+LOG_BACKPRESSURE_SAMPLE_RATE = float(os.getenv("LOG_BACKPRESSURE_SAMPLE_RATE", "0.1"))
+
+class QueryLogWriter:
+    """
+    Escribe query_logs en lotes desde un hilo en segundo plano. Las peticiones solo
+    encolan; si la cola está llena la entrada se descarta en lugar de bloquear.
+    """
+
+    def __init__(self, max_size: int = None, batch_size: int = None, flush_interval: float = None):
+        self.max_size = max_size if max_size is not None else LOG_QUEUE_MAX_SIZE
+        self.batch_size = batch_size if batch_size is not None else LOG_BATCH_SIZE
+        self.flush_interval = flush_interval if flush_interval is not None else LOG_FLUSH_INTERVAL_SECONDS
+        self._queue = queue.Queue(maxsize=self.max_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self.enqueued = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+
+    def enqueue(self, endpoint: str, request_body: bytes, response: str, status_code: int) -> bool:
+        depth = self._queue.qsize()
+        if status_code < 400 and depth >= self.max_size * LOG_BACKPRESSURE_WATERMARK:
+            # Bajo presión se conservan siempre los errores y una muestra del resto
+            if random.random() >= LOG_BACKPRESSURE_SAMPLE_RATE:
+                self.sampled_out += 1
+                return False
+        try:
+            self._queue.put_nowait((endpoint, request_body, response, status_code))
+            self.enqueued += 1
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="query-log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Detiene el hilo después de escribir lo que queda en la cola."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def flush(self):
+        """Escribe de inmediato todo lo encolado (en lotes de batch_size)."""
+        while True:
+            batch = self._drain()
+            if not batch:
+                return
+            self._write(batch)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "max_size": self.max_size,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            self._write([first] + self._drain(self.batch_size - 1))
+        self.flush()
+
+    def _drain(self, limit: int = None) -> list:
+        limit = self.batch_size if limit is None else limit
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list):
+        session = get_db_session()
+        try:
+            with timed("log_write"):
+                log_queries(session, batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error(f"Error escribiendo {len(batch)} query_logs: {e}")
+        finally:
+            session.close()
+
+_query_log_writer = None
+
+def get_query_log_writer() -> QueryLogWriter:
+    global _query_log_writer
+    if _query_log_writer is None:
+        _query_log_writer = QueryLogWriter()
+    return _query_log_writer
@@ -0,0 +1,137 @@
+import os
+import argparse
+from sqlalchemy import text
+from loguru import logger
+
+# Las búsquedas usan <#> (producto interno negativo) sobre embeddings normalizados:
+# equivale a similitud coseno y solo puede usar índices construidos con vector_ip_ops.
+VECTOR_OPERATOR = "<#>"
+VECTOR_OPCLASS = "vector_ip_ops"
+
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "hnsw").lower()  # hnsw | ivfflat
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+# pgvector >= 0.8: sigue recorriendo el índice cuando un filtro (WHERE) descarta candidatos.
+# Sin él, las búsquedas del semantic cache filtradas por context_hash o NOT stale solo ven los
+# ef_search vecinos más cercanos de toda la tabla y dan misses falsos en corpus populares.
+# relaxed_order puede devolver un candidato algo más lejano que el mejor (como cualquier
+# búsqueda ANN), pero la distancia se calcula exacta, así que no hay hits falsos.
+# Valores: relaxed_order | strict_order | vacío (no se fija; necesario con pgvector < 0.8)
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "relaxed_order")
+IVFFLAT_LISTS = int(os.getenv("IVFFLAT_LISTS", "100"))
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES", "10"))
+VECTOR_INDEX_CHECK = os.getenv("VECTOR_INDEX_CHECK", "true").lower() == "true"
+
+# nombre del índice -> (tabla, columna)
+VECTOR_INDEXES = {
+    "idx_documents_embedding": ("documents", "embedding"),
+    "idx_semantic_cache_embedding": ("semantic_cache", "prompt_embedding"),
+}
+
+def _check_index_type(index_type: str):
+    if index_type not in ("hnsw", "ivfflat"):
+        raise ValueError(f"VECTOR_INDEX_TYPE no soportado: {index_type} (usa hnsw o ivfflat)")
+
+def search_params_statements(index_type: str = None):
+    """Sentencias (sql, params) que fijan ef_search (hnsw) o probes (ivfflat)."""
+    index_type = index_type or VECTOR_INDEX_TYPE
+    _check_index_type(index_type)
+    if index_type == "hnsw":
+        statements = [(text(f"SET LOCAL hnsw.ef_search = {int(HNSW_EF_SEARCH)}"), None)]
+        if HNSW_ITERATIVE_SCAN:
+            statements.append((text("SELECT set_config('hnsw.iterative_scan', :mode, true)"), {"mode": HNSW_ITERATIVE_SCAN}))
+        return statements
+    return [(text(f"SET LOCAL ivfflat.probes = {int(IVFFLAT_PROBES)}"), None)]
+
+def apply_search_params(session, index_type: str = None):
+    """
+    Fija ef_search (hnsw) o probes (ivfflat) para la transacción actual.
+    Debe llamarse en la misma transacción que la búsqueda vectorial.
+    """
+    for sql, params in search_params_statements(index_type):
+        if params is None:
+            session.execute(sql)
+        else:
+            session.execute(sql, params)
+
+async def aapply_search_params(session, index_type: str = None):
+    """Variante async de apply_search_params para AsyncSession."""
+    for sql, params in search_params_statements(index_type):
+        if params is None:
+            await session.execute(sql)
+        else:
+            await session.execute(sql, params)
+
+def verify_vector_indexes(session, index_type: str = None):
+    """
+    Comprueba que cada índice vectorial existe, es del tipo configurado y usa la
+    clase de operadores que corresponde a VECTOR_OPERATOR. Si no, el planner haría
+    un sequential scan en cada consulta, así que se lanza RuntimeError.
+    """
+    index_type = index_type or VECTOR_INDEX_TYPE
+    _check_index_type(index_type)
+    sql = text('''
+        SELECT i.relname, am.amname, opc.opcname
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_am am ON am.oid = i.relam
+        JOIN pg_opclass opc ON opc.oid = x.indclass[0]
+        WHERE i.relname = ANY(:names)
+    ''')
+    rows = session.execute(sql, {"names": list(VECTOR_INDEXES)}).fetchall()
+    found = {name: (amname, opcname) for name, amname, opcname in rows}
+    problems = []
+    for name, (table, column) in VECTOR_INDEXES.items():
+        if name not in found:
+            problems.append(f"falta el índice {name} en {table}({column})")
+            continue
+        amname, opcname = found[name]
+        if opcname != VECTOR_OPCLASS:
+            problems.append(f"{name} usa {opcname}, pero las consultas usan {VECTOR_OPERATOR} (requiere {VECTOR_OPCLASS})")
+        if amname != index_type:
+            problems.append(f"{name} es {amname}, pero VECTOR_INDEX_TYPE={index_type}")
+    if problems:
+        raise RuntimeError(
+            "Índices vectoriales inconsistentes: " + "; ".join(problems)
+            + ". Ejecuta: python -m src.app.db.vector_index --rebuild"
+        )
+    logger.info(f"Índices vectoriales verificados: {index_type} ({VECTOR_OPCLASS})")
+
+def rebuild_vector_indexes(session, index_type: str = None, normalize_existing: bool = False):
+    """Recrea los índices vectoriales con el tipo y parámetros configurados."""
+    index_type = index_type or VECTOR_INDEX_TYPE
+    _check_index_type(index_type)
+    if index_type == "hnsw":
+        options = f"(m = {int(HNSW_M)}, ef_construction = {int(HNSW_EF_CONSTRUCTION)})"
+    else:
+        options = f"(lists = {int(IVFFLAT_LISTS)})"
+    try:
+        for name, (table, column) in VECTOR_INDEXES.items():
+            if normalize_existing:
+                # Los vectores guardados antes de normalizar en escritura se normalizan en sitio
+                session.execute(text(f"UPDATE {table} SET {column} = l2_normalize({column})"))
+            session.execute(text(f"DROP INDEX IF EXISTS {name}"))
+            session.execute(text(
+                f"CREATE INDEX {name} ON {table} USING {index_type} ({column} {VECTOR_OPCLASS}) WITH {options}"
+            ))
+            logger.info(f"Índice {name} recreado con {index_type} {options}")
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+if __name__ == "__main__":
+    from src.app.db import get_db_session
+
+    parser = argparse.ArgumentParser(description="Verifica o recrea los índices vectoriales (pgvector)")
+    parser.add_argument("--rebuild", action="store_true", help="Recrea los índices con VECTOR_INDEX_TYPE")
+    parser.add_argument("--normalize-existing", action="store_true", help="Normaliza los embeddings ya guardados")
+    args = parser.parse_args()
+    session = get_db_session()
+    try:
+        if args.rebuild:
+            rebuild_vector_indexes(session, normalize_existing=args.normalize_existing)
+        verify_vector_indexes(session)
+    finally:
+        session.close()
@@ -1,8 +1,10 @@
 from src.retriever.retriever import Retriever
 from src.indexer.indexer import Indexer
+from src.cache.cache_manager import ExactCacheManager
 
 _retriever = None
 _indexer = None
+_exact_cache = None
 
 def get_retriever():
     global _retriever
@@ -14,4 +16,10 @@ def get_indexer():
     global _indexer
     if _indexer is None:
         _indexer = Indexer()
-    return _indexer
\ No newline at end of file
+    return _indexer
+
+def get_exact_cache():
+    global _exact_cache
+    if _exact_cache is None:
+        _exact_cache = ExactCacheManager()
+    return _exact_cache
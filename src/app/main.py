@@ -1,19 +1,31 @@
 import os
 import time
-from fastapi import FastAPI, HTTPException, Depends, Query, status, Request
-from dotenv import load_dotenv
-
-load_dotenv()
-from fastapi.responses import JSONResponse, PlainTextResponse
+from contextlib import asynccontextmanager
+import src.app.config  # noqa: F401  (carga config/.env antes de leer la configuración)
+from fastapi import FastAPI, HTTPException, Depends, Query, status, Request, Response, UploadFile, File
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from loguru import logger
-from src.app.dependencies import get_retriever, get_indexer
-from src.app.schemas import QueryRequest, QueryResponse, IndexRequest, IndexResponse, ExactCacheResponse, SemanticCacheResponse
+from typing import Optional
+from src.app.dependencies import get_retriever, get_indexer, get_exact_cache
+from src.indexer.indexer import iter_documents_file
+from src.app.schemas import (
+    QueryRequest, QueryResponse, IndexRequest, IndexResponse, ExactCacheResponse, SemanticCacheResponse,
+    QueryBatchRequest, QueryBatchResponse, QueryBatchItem, DocumentUpdateRequest, DeleteResponse,
+)
+from src.retriever.retriever import QUERY_BATCH_MAX_SIZE
 from src.app.middleware import LoggingMiddleware
-from src.app.db import get_db_session, log_query
-import json
-from sqlalchemy import text
-from src.cache.cache_manager import ExactCacheManager, SemanticCacheManager
+from src.app.streaming import SSE_HEADERS, StreamedAnswer, sse_stream, llm_chunks, single_chunk
+from src.app.timing import StageTimer
+from src.app.metrics import SERVER_TIMING_HEADER, timed, record_llm_usage, record_cache_lookup, server_timing, render_metrics
+from src.app.db import get_request_session, get_async_request_session, dispose_engine, dispose_async_engine
+from src.app.db.log_writer import get_query_log_writer
+from src.app.startup import STARTUP_PREWARM_POOL, StartupReport, run_startup, aprewarm_pool
+from src.cache.maintenance import get_cache_maintainer
+from src.cache.thresholds import get_distance_recorder
+from src.cache.warmup import CACHE_WARMUP_ON_STARTUP, start_background_warmup
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
@@ -22,7 +34,36 @@ from slowapi.errors import RateLimitExceeded
 limiter = Limiter(key_func=get_remote_address)
 rate_limiter = limiter.limit
 
-app = FastAPI(title="LangChain RAG API")
+# Modo async: asyncpg + ainvoke/aembed_query en el event loop, sin ocupar hilos del threadpool
+RAG_ASYNC_MODE = os.getenv("RAG_ASYNC_MODE", "false").lower() == "true"
+# Una sola sesión por petición, compartida por Retriever y cache managers
+request_session = get_async_request_session if RAG_ASYNC_MODE else get_request_session
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Engine, clientes y pre-calentado opcional antes de aceptar peticiones (ver src/app/startup.py)
+    report = await run_in_threadpool(run_startup, StartupReport(), RAG_ASYNC_MODE)
+    if STARTUP_PREWARM_POOL and RAG_ASYNC_MODE:
+        with report.step("pool"):
+            await aprewarm_pool(STARTUP_PREWARM_POOL)
+    with report.step("background_workers"):
+        log_writer = get_query_log_writer()
+        log_writer.start()
+        # TTL, desalojo y VACUUM/REINDEX de las tablas de cache en segundo plano
+        cache_maintainer = get_cache_maintainer()
+        cache_maintainer.start()
+        # Precalentado de las caches con los prompts más frecuentes de query_logs (en segundo plano)
+        if CACHE_WARMUP_ON_STARTUP:
+            start_background_warmup(get_retriever(), get_exact_cache())
+    app.state.startup_report = report.as_dict()
+    logger.info(f"Arranque completado en {app.state.startup_report['total_ms']} ms: {report.steps}")
+    yield
+    await run_in_threadpool(cache_maintainer.stop)
+    await run_in_threadpool(log_writer.stop)
+    await run_in_threadpool(dispose_engine)
+    await dispose_async_engine()
+
+app = FastAPI(title="LangChain RAG API", lifespan=lifespan)
 app.add_middleware(LoggingMiddleware)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, lambda request, exc: PlainTextResponse("Rate limit exceeded", status_code=429))
@@ -38,65 +79,297 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def stream_headers(timings: dict, start: float) -> dict:
+    """En SSE la cabecera Server-Timing sale antes del primer token: solo cubre las etapas previas."""
+    if not SERVER_TIMING_HEADER:
+        return SSE_HEADERS
+    return {**SSE_HEADERS, "Server-Timing": server_timing(timings, round((time.perf_counter() - start) * 1000))}
+
 @app.post("/rag/query_exact", response_model=ExactCacheResponse, tags=["RAG"])
 @rate_limiter("5/minute")
-def rag_query_exact(request: Request, query_request: QueryRequest, session=Depends(get_db_session), retriever=Depends(get_retriever)):
+async def rag_query_exact(request: Request, response: Response, query_request: QueryRequest, retriever=Depends(get_retriever), exact_cache=Depends(get_exact_cache), session=Depends(request_session)):
     start = time.perf_counter()
-    response_content = None
-    cache_status = "miss"
-    status_code = status.HTTP_200_OK
     try:
         prompt = query_request.prompt
-        sql = text("SELECT response FROM exact_cache WHERE prompt = :prompt LIMIT 1")
-        row = session.execute(sql, {"prompt": prompt}).fetchone()
-        if row:
-            response_content = row[0]
-            cache_status = "hit"
+        messages = [("human", prompt)]
+        # Misses concurrentes del mismo prompt esperan a una sola llamada al LLM
+        if RAG_ASYNC_MODE:
+            async def generate():
+                with timed("llm"):
+                    message = await retriever.llm.ainvoke(messages)
+                record_llm_usage(messages, message.content, getattr(message, "usage_metadata", None))
+                return message.content
+            response_content, cache_status = await exact_cache.aget_or_generate(prompt, generate, session=session)
         else:
-            response = retriever.llm.invoke([("human", prompt)])
-            response_content = response.content
-            insert_sql = text("INSERT INTO exact_cache (prompt, response) VALUES (:prompt, :response)")
-            session.execute(insert_sql, {"prompt": prompt, "response": response_content})
-            session.commit()
+            def generate():
+                with timed("llm"):
+                    message = retriever.llm.invoke(messages)
+                record_llm_usage(messages, message.content, getattr(message, "usage_metadata", None))
+                return message.content
+            response_content, cache_status = await run_in_threadpool(
+                exact_cache.get_or_generate, prompt, generate, session=session
+            )
+        record_cache_lookup("exact", cache_status, prompt, response_content)
         elapsed = round((time.perf_counter() - start) * 1000)  # Convertir a milisegundos y redondear a entero
+        if SERVER_TIMING_HEADER:
+            response.headers["Server-Timing"] = server_timing({}, elapsed)
         return ExactCacheResponse(result=response_content, cache_status=cache_status, elapsed=elapsed)
     except Exception as e:
-        session.rollback()
         logger.error(f"Error en /rag/query_exact: {e}", exc_info=True)
-        status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-        raise HTTPException(status_code=status_code, detail="Internal server error")
-    finally:
-        log_query(session, "/rag/query_exact", query_request.json().encode('utf-8'), json.dumps({"result": response_content, "cache_status": cache_status}), status_code)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error")
 
 @app.post("/rag/query_semantic", response_model=SemanticCacheResponse, tags=["RAG"])
 @rate_limiter("5/minute")
-def rag_query_semantic(request: Request, query_request: QueryRequest, retriever=Depends(get_retriever), session=Depends(get_db_session)):
-    result_content = None
-    cache_status = "miss"
-    min_distance = None
-    status_code = status.HTTP_200_OK
+async def rag_query_semantic(request: Request, response: Response, query_request: QueryRequest, retriever=Depends(get_retriever), session=Depends(request_session)):
     start = time.perf_counter()
     try:
-        result_content, cache_status, min_distance, _ = retriever.query(query_request.prompt)
+        if RAG_ASYNC_MODE:
+            result_content, cache_status, min_distance, _, timings = await retriever.aquery(query_request.prompt, session=session)
+        else:
+            result_content, cache_status, min_distance, _, timings = await run_in_threadpool(
+                retriever.query, query_request.prompt, session=session
+            )
+        record_cache_lookup("semantic", cache_status, query_request.prompt, result_content)
         elapsed = round((time.perf_counter() - start) * 1000) # Calcular elapsed aquí y redondear a entero
-        return SemanticCacheResponse(result=result_content, cache_status=cache_status, min_distance=min_distance, elapsed=elapsed)
+        if SERVER_TIMING_HEADER:
+            response.headers["Server-Timing"] = server_timing(timings, elapsed)
+        return SemanticCacheResponse(result=result_content, cache_status=cache_status, min_distance=min_distance, elapsed=elapsed, timings=timings)
     except Exception as e:
         logger.error(f"Error en /rag/query_semantic: {e}", exc_info=True)
-        status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-        raise HTTPException(status_code=status_code, detail="Internal server error")
-    finally:
-        log_query(session, "/rag/query_semantic", query_request.json().encode('utf-8'), json.dumps({"result": result_content, "cache_status": cache_status, "min_distance": min_distance}), status_code)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error")
+
+@app.post("/rag/query_batch", response_model=QueryBatchResponse, tags=["RAG"])
+@rate_limiter("5/minute")
+async def rag_query_batch(request: Request, response: Response, batch_request: QueryBatchRequest, retriever=Depends(get_retriever), session=Depends(request_session)):
+    """
+    Varios prompts del semantic cache en una sola petición: un embedding por lotes, una
+    sola consulta SQL para documentos y cache, y solo los misses van al LLM.
+    """
+    if len(batch_request.prompts) > QUERY_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=422, detail=f"Máximo {QUERY_BATCH_MAX_SIZE} prompts por petición")
+    start = time.perf_counter()
+    try:
+        if RAG_ASYNC_MODE:
+            results, timings = await retriever.aquery_many(batch_request.prompts, session=session)
+        else:
+            results, timings = await run_in_threadpool(retriever.query_many, batch_request.prompts, session=session)
+        for prompt, (result_content, cache_status, _) in zip(batch_request.prompts, results):
+            record_cache_lookup("semantic", cache_status, prompt, result_content)
+        elapsed = round((time.perf_counter() - start) * 1000)
+        if SERVER_TIMING_HEADER:
+            response.headers["Server-Timing"] = server_timing(timings, elapsed)
+        return QueryBatchResponse(
+            results=[
+                QueryBatchItem(
+                    result=r, cache_status=c, min_distance=d,
+                    error="Error generando la respuesta" if c == "error" else None
+                )
+                for r, c, d in results
+            ],
+            elapsed=elapsed, timings=timings
+        )
+    except Exception as e:
+        logger.error(f"Error en /rag/query_batch: {e}", exc_info=True)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error")
+
+@app.post("/rag/query_exact/stream", tags=["RAG"])
+@rate_limiter("5/minute")
+async def rag_query_exact_stream(request: Request, query_request: QueryRequest, retriever=Depends(get_retriever), exact_cache=Depends(get_exact_cache), session=Depends(request_session)):
+    """
+    Variante SSE de /rag/query_exact: un hit se envía de inmediato y un miss reenvía
+    los tokens del modelo según llegan. La respuesta se guarda al terminar el stream.
+    """
+    start = time.perf_counter()
+    prompt = query_request.prompt
+    try:
+        if RAG_ASYNC_MODE:
+            cached_response = await exact_cache.aget(prompt, session=session)
+            await session.commit()
+        else:
+            cached_response = await run_in_threadpool(exact_cache.get, prompt, session=session)
+            # La conexión no se retiene durante el stream
+            await run_in_threadpool(session.commit)
+    except Exception as e:
+        logger.error(f"Error en /rag/query_exact/stream: {e}", exc_info=True)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error")
+
+    answer = StreamedAnswer()
+    cache_status = "hit" if cached_response is not None else "miss"
+    record_cache_lookup("exact", cache_status, prompt, cached_response)
+
+    async def write_behind():
+        if not answer.complete:
+            return
+        try:
+            if RAG_ASYNC_MODE:
+                await exact_cache.aset(prompt, answer.text, session=session)
+            else:
+                await run_in_threadpool(exact_cache.set, prompt, answer.text, session=session)
+        except Exception as e:
+            logger.error(f"Error guardando la respuesta de /rag/query_exact/stream: {e}")
+
+    chunks = single_chunk(cached_response) if cached_response is not None else llm_chunks(retriever.llm, [("human", prompt)])
+    events = sse_stream(
+        chunks, answer, {"cache_status": cache_status},
+        lambda: {"cache_status": cache_status, "elapsed": round((time.perf_counter() - start) * 1000)}
+    )
+    return StreamingResponse(
+        events, media_type="text/event-stream", headers=stream_headers({}, start),
+        background=BackgroundTask(write_behind) if cached_response is None else None
+    )
+
+@app.post("/rag/query_semantic/stream", tags=["RAG"])
+@rate_limiter("5/minute")
+async def rag_query_semantic_stream(request: Request, query_request: QueryRequest, retriever=Depends(get_retriever), session=Depends(request_session)):
+    """
+    Variante SSE de /rag/query_semantic: embedding, búsqueda y consulta a la cache se
+    hacen antes de empezar el stream; en un miss los tokens se reenvían según llegan
+    y la entrada del semantic cache se escribe al terminar.
+    """
+    start = time.perf_counter()
+    prompt = query_request.prompt
+    timer = StageTimer()
+    try:
+        if RAG_ASYNC_MODE:
+            probe = await retriever.aprepare_stream(prompt, timer, session=session)
+        else:
+            probe = await run_in_threadpool(retriever.prepare_stream, prompt, timer, session=session)
+    except Exception as e:
+        logger.error(f"Error en /rag/query_semantic/stream: {e}", exc_info=True)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error")
+    cached_response, min_distance, query_vector, context, context_hash, corpus_version, sources = probe
+
+    answer = StreamedAnswer()
+    cache_status = "hit" if cached_response is not None else "miss"
+    record_cache_lookup("semantic", cache_status, prompt, cached_response)
+
+    async def generate():
+        with timer.stage("llm"):
+            async for chunk in retriever.astream_answer(prompt, context):
+                yield chunk
+
+    async def write_behind():
+        if not answer.complete:
+            return
+        semantic_cache = retriever.semantic_cache
+        try:
+            if RAG_ASYNC_MODE:
+                await semantic_cache.aset(
+                    prompt, query_vector, context, context_hash, answer.text,
+                    corpus_version=corpus_version, sources=sources, session=session
+                )
+            else:
+                await run_in_threadpool(
+                    semantic_cache.set, prompt, query_vector, context, context_hash, answer.text,
+                    corpus_version=corpus_version, sources=sources, session=session
+                )
+        except Exception as e:
+            logger.error(f"Error guardando la respuesta de /rag/query_semantic/stream: {e}")
+
+    events = sse_stream(
+        single_chunk(cached_response) if cached_response is not None else generate(), answer,
+        {"cache_status": cache_status, "min_distance": min_distance},
+        lambda: {
+            "cache_status": cache_status, "min_distance": min_distance,
+            "elapsed": round((time.perf_counter() - start) * 1000), "timings": timer.timings,
+        }
+    )
+    return StreamingResponse(
+        events, media_type="text/event-stream", headers=stream_headers(timer.timings, start),
+        background=BackgroundTask(write_behind) if cached_response is None else None
+    )
 
 @app.post("/rag/index", response_model=IndexResponse, tags=["RAG"])
 @rate_limiter("2/minute")
-def rag_index(request: IndexRequest, indexer=Depends(get_indexer)):
+def rag_index(request: Request, index_request: IndexRequest, indexer=Depends(get_indexer)):
     try:
-        count = indexer.index_documents(request.documents)
-        return IndexResponse(indexed=count)
+        indexed, deduplicated = indexer.index_documents(index_request.documents)
+        return IndexResponse(indexed=indexed, deduplicated=deduplicated)
     except Exception as e:
         logger.exception("Error en /rag/index")
         raise HTTPException(status_code=500, detail="Internal server error") 
+
+@app.post("/rag/index/upload", response_model=IndexResponse, tags=["RAG"])
+@rate_limiter("2/minute")
+def rag_index_upload(request: Request, file: UploadFile = File(...), job_id: Optional[str] = Query(None), indexer=Depends(get_indexer)):
+    """
+    Indexa un fichero JSONL o de texto (un documento por línea) en lotes, sin cargarlo
+    entero en memoria. Con job_id, un reintento continúa desde el último lote confirmado.
+    """
+    try:
+        indexed, deduplicated = indexer.index_stream(iter_documents_file(file.file), job_id=job_id)
+        return IndexResponse(indexed=indexed, deduplicated=deduplicated)
+    except Exception as e:
+        logger.exception("Error en /rag/index/upload")
+        raise HTTPException(status_code=500, detail="Internal server error")
     
+@app.put("/rag/documents/{document_id}", response_model=IndexResponse, tags=["RAG"])
+@rate_limiter("2/minute")
+def rag_update_document(request: Request, document_id: int, update_request: DocumentUpdateRequest, indexer=Depends(get_indexer)):
+    """Sustituye un chunk; solo se invalidan las entradas del semantic cache afectadas."""
+    try:
+        result = indexer.update_document(document_id, update_request.content, update_request.metadata)
+    except Exception as e:
+        logger.exception("Error en PUT /rag/documents")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    if result is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    indexed, deduplicated = result
+    return IndexResponse(indexed=indexed, deduplicated=deduplicated)
+
+@app.delete("/rag/documents/{document_id}", response_model=DeleteResponse, tags=["RAG"])
+@rate_limiter("2/minute")
+def rag_delete_document(request: Request, document_id: int, indexer=Depends(get_indexer)):
+    try:
+        deleted = indexer.delete_documents([document_id])
+    except Exception as e:
+        logger.exception("Error en DELETE /rag/documents")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return DeleteResponse(deleted=deleted)
+
+@app.delete("/rag/parents/{parent_id}", response_model=DeleteResponse, tags=["RAG"])
+@rate_limiter("2/minute")
+def rag_delete_parent(request: Request, parent_id: str, indexer=Depends(get_indexer)):
+    """Quita un documento original (parent_id en hex); conserva los chunks que comparte con otros."""
+    try:
+        parent = bytes.fromhex(parent_id)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="parent_id must be hex")
+    try:
+        deleted = indexer.delete_parent(parent)
+    except Exception as e:
+        logger.exception("Error en DELETE /rag/parents")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    if deleted is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return DeleteResponse(deleted=deleted)
+
 @app.get("/health",tags=["STATUS"])
 def health_check():
-    return {"status": "ok"}    
+    return {"status": "ok"}
+
+@app.get("/startup", tags=["STATUS"])
+def startup_report(request: Request):
+    return getattr(request.app.state, "startup_report", {})
+
+@app.get("/cache/stats", tags=["STATUS"])
+def cache_stats(exact_cache=Depends(get_exact_cache), retriever=Depends(get_retriever)):
+    stats = {
+        "exact_l1": exact_cache.stats(),
+        "maintenance": get_cache_maintainer().stats(),
+        "semantic_distances": get_distance_recorder().stats(),
+    }
+    if hasattr(retriever.embeddings, "stats"):
+        stats["embeddings"] = retriever.embeddings.stats()
+    return stats
+
+@app.get("/metrics", tags=["STATUS"])
+def metrics():
+    body, content_type = render_metrics(get_query_log_writer().stats())
+    return Response(content=body, media_type=content_type)
+
+@app.get("/logs/stats", tags=["STATUS"])
+def log_stats():
+    return get_query_log_writer().stats()
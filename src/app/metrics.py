@@ -0,0 +1,86 @@
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# Cabecera Server-Timing con el tiempo de cada etapa en las respuestas de /rag/*
+SERVER_TIMING_HEADER = os.getenv("SERVER_TIMING_HEADER", "false").lower() == "true"
+# Precio del LLM (USD por millón de tokens) para estimar el coste ahorrado por la cache
+LLM_INPUT_COST_PER_MTOK = float(os.getenv("LLM_INPUT_COST_PER_MTOK", "0.30"))
+LLM_OUTPUT_COST_PER_MTOK = float(os.getenv("LLM_OUTPUT_COST_PER_MTOK", "2.50"))
+# Si el modelo no informa del uso, los tokens se estiman como caracteres / LLM_CHARS_PER_TOKEN
+LLM_CHARS_PER_TOKEN = float(os.getenv("LLM_CHARS_PER_TOKEN", "4"))
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds", "Duración de cada etapa de una petición (embed, cache_probe, llm, ...)", ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+CACHE_LOOKUPS = Counter("rag_cache_lookups_total", "Consultas a la cache por resultado", ["cache", "status"])
+LLM_TOKENS = Counter("rag_llm_tokens_total", "Tokens enviados (input) y generados (output) por el LLM", ["direction"])
+LLM_TOKENS_SAVED = Counter("rag_llm_tokens_saved_total", "Tokens estimados que la cache evitó pedir al LLM", ["cache"])
+LLM_COST_SAVED = Counter("rag_llm_cost_saved_usd_total", "Coste estimado (USD) que la cache evitó", ["cache"])
+STALE_SCANS = Counter(
+    "rag_stale_scans_total", "Documentos nuevos comprobados contra el semantic cache por tipo de búsqueda", ["scan"]
+)
+LOG_QUEUE_DEPTH = Gauge("rag_log_queue_depth", "Entradas de query_logs pendientes de escribir")
+LOG_ENTRIES = Gauge("rag_log_entries", "Entradas de query_logs por estado desde el arranque", ["state"])
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage=stage).observe(seconds)
+
+@contextmanager
+def timed(stage: str):
+    """Mide un bloque fuera de un StageTimer (p. ej. en los cache managers)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def estimate_tokens(text_value: str) -> int:
+    return round(len(text_value or "") / LLM_CHARS_PER_TOKEN)
+
+def _messages_text(messages) -> str:
+    return "\n".join(m[1] if isinstance(m, tuple) else str(m) for m in messages)
+
+def record_llm_usage(messages, response_text: str, usage: dict = None):
+    """Cuenta los tokens de una llamada al LLM; sin usage_metadata se estiman por caracteres."""
+    if usage:
+        input_tokens, output_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    else:
+        input_tokens, output_tokens = estimate_tokens(_messages_text(messages)), estimate_tokens(response_text)
+    LLM_TOKENS.labels(direction="input").inc(input_tokens)
+    LLM_TOKENS.labels(direction="output").inc(output_tokens)
+
+def record_stale_scans(ann: int, exact: int):
+    """Cuenta los documentos nuevos resueltos con la búsqueda ANN y los que necesitaron la pasada exacta."""
+    STALE_SCANS.labels(scan="ann").inc(ann)
+    STALE_SCANS.labels(scan="exact").inc(exact)
+
+def record_cache_lookup(cache: str, cache_status: str, prompt: str, response: str = None):
+    """
+    Cuenta el resultado de una consulta a la cache. En un hit o coalesced se estima lo
+    ahorrado a partir del prompt y la respuesta (sin system prompt ni contexto, de modo
+    que la estimación queda por debajo del ahorro real).
+    """
+    CACHE_LOOKUPS.labels(cache=cache, status=cache_status).inc()
+    if cache_status == "miss" or response is None:
+        return
+    input_tokens, output_tokens = estimate_tokens(prompt), estimate_tokens(response)
+    LLM_TOKENS_SAVED.labels(cache=cache).inc(input_tokens + output_tokens)
+    LLM_COST_SAVED.labels(cache=cache).inc(
+        (input_tokens * LLM_INPUT_COST_PER_MTOK + output_tokens * LLM_OUTPUT_COST_PER_MTOK) / 1_000_000
+    )
+
+def server_timing(timings: dict, elapsed_ms: float) -> str:
+    """Valor de la cabecera Server-Timing, p. ej. 'embed;dur=12.3, llm;dur=840.1, total;dur=861'."""
+    entries = [f"{name};dur={value}" for name, value in timings.items()]
+    entries.append(f"total;dur={elapsed_ms}")
+    return ", ".join(entries)
+
+def render_metrics(log_stats: dict) -> tuple:
+    """Actualiza los gauges leídos bajo demanda y devuelve (cuerpo, content type)."""
+    LOG_QUEUE_DEPTH.set(log_stats["queue_depth"])
+    for state in ("enqueued", "dropped", "sampled_out", "written", "failed"):
+        LOG_ENTRIES.labels(state=state).set(log_stats[state])
+    return generate_latest(), CONTENT_TYPE_LATEST
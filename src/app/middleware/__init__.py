@@ -1,36 +1,63 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
-from starlette.responses import Response
+import os
 from loguru import logger
-from src.app.db import get_db_session, log_query
-import json
-
-class LoggingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        request_body = await request.body()
-        logger.info(f"Request: {request.url.path} - Body: {request_body}")
-        
-        response = await call_next(request)
-        
-        response_body = b""
-        async for chunk in response.body_iterator:
-            response_body += chunk
-        
+from src.app.db.log_writer import get_query_log_writer
+
+# Máximo de bytes del request/response que se conservan para query_logs
+LOG_MAX_BODY_BYTES = int(os.getenv("LOG_MAX_BODY_BYTES", str(64 * 1024)))
+
+class LoggingMiddleware:
+    """
+    Middleware ASGI que registra cada petición en query_logs a través del
+    QueryLogWriter. Los chunks de la respuesta se reenvían tal cual; solo se
+    guarda una copia de los primeros LOG_MAX_BODY_BYTES para el log.
+    """
+
+    def __init__(self, app, writer=None, max_body_bytes: int = None):
+        self.app = app
+        self.writer = writer
+        self.max_body_bytes = max_body_bytes if max_body_bytes is not None else LOG_MAX_BODY_BYTES
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_body = bytearray()
+        response_body = bytearray()
+        truncated = False
+        status_code = 500
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                self._capture(request_body, message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status_code, truncated
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                truncated = self._capture(response_body, message.get("body", b"")) or truncated
+            await send(message)
+
         try:
-            session = get_db_session()
-            log_query(
-                session,
-                endpoint=str(request.url),
-                request_body=request_body,
-                response=response_body.decode(),
-                status_code=response.status_code
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            path = scope.get("path", "")
+            logger.info(f"Request: {path} - Body: {bytes(request_body)}")
+            writer = self.writer or get_query_log_writer()
+            # Una respuesta truncada no es JSON válido: se registra sin cuerpo
+            writer.enqueue(
+                endpoint=path,
+                request_body=bytes(request_body),
+                response="" if truncated else response_body.decode("utf-8", errors="replace"),
+                status_code=status_code,
             )
-        except Exception as e:
-            logger.error(f"Error logging query: {e}")
-            
-        return Response(
-            content=response_body,
-            status_code=response.status_code,
-            headers=dict(response.headers),
-            media_type=response.media_type
-        ) 
\ No newline at end of file
+
+    def _capture(self, buffer: bytearray, chunk: bytes) -> bool:
+        """Copia el chunk hasta el límite; devuelve True si algo quedó fuera."""
+        remaining = self.max_body_bytes - len(buffer)
+        if remaining > 0:
+            buffer.extend(chunk[:remaining])
+        return len(chunk) > max(remaining, 0)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional, Any
+from typing import List, Optional, Any, Dict
 
 class QueryRequest(BaseModel):
     prompt: str
@@ -13,6 +13,8 @@ class IndexRequest(BaseModel):
 
 class IndexResponse(BaseModel):
     indexed: int
+    # Chunks que no se insertaron porque ya existían (mismo content_hash)
+    deduplicated: int = 0
 
 class ExactCacheResponse(BaseModel):
     result: str
@@ -22,5 +24,30 @@ class ExactCacheResponse(BaseModel):
 class SemanticCacheResponse(BaseModel):
     result: str
     cache_status: str
-    min_distance: float
-    elapsed: float 
\ No newline at end of file
+    min_distance: Optional[float] = None
+    elapsed: float
+    # Tiempo en ms de cada etapa (embed, cache_probe, document_search, llm, cache_write)
+    timings: Optional[Dict[str, float]] = None 
+
+class QueryBatchRequest(BaseModel):
+    prompts: List[str]
+
+class QueryBatchItem(BaseModel):
+    # None si cache_status es error (falló la generación de ese prompt)
+    result: Optional[str] = None
+    cache_status: str
+    min_distance: Optional[float] = None
+    error: Optional[str] = None
+
+class QueryBatchResponse(BaseModel):
+    results: List[QueryBatchItem]
+    elapsed: float
+    # Tiempo en ms de cada etapa del lote (embed, batch_probe, llm, cache_write)
+    timings: Optional[Dict[str, float]] = None
+
+class DocumentUpdateRequest(BaseModel):
+    content: str
+    metadata: Optional[Dict[str, Any]] = None
+
+class DeleteResponse(BaseModel):
+    deleted: int
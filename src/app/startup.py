@@ -0,0 +1,87 @@
+import os
+import time
+import asyncio
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from src.app.db import DB_POOL_SIZE, get_engine, get_async_engine, get_db_session
+from src.app.db.vector_index import VECTOR_INDEX_CHECK, verify_vector_indexes
+from src.app.dependencies import get_retriever, get_indexer, get_exact_cache
+
+# Clientes (Retriever, Indexer, exact cache) creados en el arranque y no en la primera petición
+STARTUP_EAGER_CLIENTS = os.getenv("STARTUP_EAGER_CLIENTS", "true").lower() == "true"
+# Conexiones del pool que se abren en el arranque (0 = ninguna; como máximo DB_POOL_SIZE)
+STARTUP_PREWARM_POOL = int(os.getenv("STARTUP_PREWARM_POOL", "0"))
+# Primera llamada a la API de embeddings (conexión HTTP y autenticación) en el arranque
+STARTUP_PREWARM_EMBEDDINGS = os.getenv("STARTUP_PREWARM_EMBEDDINGS", "false").lower() == "true"
+
+class StartupReport:
+    """Tiempo (en ms) de cada paso del arranque, en el orden en que se ejecutaron."""
+
+    def __init__(self):
+        self.steps = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    def as_dict(self) -> dict:
+        return {"total_ms": round((time.perf_counter() - self._start) * 1000, 1), "steps": self.steps}
+
+def prewarm_pool(connections: int) -> int:
+    """Abre a la vez hasta `connections` conexiones del pool sync y las devuelve al pool."""
+    connections = min(connections, DB_POOL_SIZE)
+    engine = get_engine()
+
+    def open_connection(_):
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        list(executor.map(open_connection, range(connections)))
+    return connections
+
+async def aprewarm_pool(connections: int) -> int:
+    connections = min(connections, DB_POOL_SIZE)
+    engine = get_async_engine()
+
+    async def open_connection():
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(open_connection() for _ in range(connections)))
+    return connections
+
+def run_startup(report: StartupReport, async_mode: bool = False) -> StartupReport:
+    """
+    Pasos bloqueantes del arranque (se ejecutan en el threadpool desde el lifespan):
+    engine, verificación de índices, pool, clientes y primer embedding.
+    """
+    with report.step("engine"):
+        get_engine()
+    # Falla al arrancar si los índices vectoriales no sirven para el operador usado en las consultas
+    if VECTOR_INDEX_CHECK:
+        with report.step("vector_index_check"):
+            session = get_db_session()
+            try:
+                verify_vector_indexes(session)
+            finally:
+                session.close()
+    if STARTUP_PREWARM_POOL and not async_mode:
+        with report.step("pool"):
+            prewarm_pool(STARTUP_PREWARM_POOL)
+    if STARTUP_EAGER_CLIENTS or STARTUP_PREWARM_EMBEDDINGS:
+        with report.step("clients"):
+            retriever = get_retriever()
+            get_indexer()
+            get_exact_cache()
+        if STARTUP_PREWARM_EMBEDDINGS:
+            with report.step("first_embedding"):
+                # Directamente al cliente remoto: la cache de embeddings respondería sin llamar a la API
+                getattr(retriever.embeddings, "embeddings", retriever.embeddings).embed_query("warm-up")
+    return report
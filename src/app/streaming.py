@@ -0,0 +1,58 @@
+import json
+from loguru import logger
+from src.app.metrics import record_llm_usage
+
+# Sin estas cabeceras algunos proxies (nginx) acumulan el stream antes de reenviarlo
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+class StreamedAnswer:
+    """
+    Acumula el texto reenviado al cliente. Solo se marca como completo si el modelo
+    terminó sin errores, y solo entonces se escribe en la cache (write-behind).
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.complete = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+async def sse_stream(chunks, answer: StreamedAnswer, start_event: dict, end_event):
+    """
+    Eventos SSE: start (cache_status, min_distance), token (text) por fragmento y
+    done (end_event() con los tiempos finales) o error si la generación falla.
+    """
+    yield sse_event("start", start_event)
+    try:
+        async for chunk in chunks:
+            answer.parts.append(chunk)
+            yield sse_event("token", {"text": chunk})
+    except Exception as e:
+        logger.error(f"Error durante el streaming: {e}", exc_info=True)
+        yield sse_event("error", {"detail": "Internal server error"})
+        return
+    answer.complete = True
+    yield sse_event("done", end_event())
+
+async def llm_chunks(llm, messages):
+    """Reenvía los fragmentos de texto del modelo según llegan y cuenta los tokens al terminar."""
+    parts = []
+    usage = {}
+    async for chunk in llm.astream(messages):
+        # En LangChain el usage_metadata de los fragmentos es aditivo (se suma al unirlos)
+        for key, value in (getattr(chunk, "usage_metadata", None) or {}).items():
+            if key in ("input_tokens", "output_tokens"):
+                usage[key] = usage.get(key, 0) + value
+        if chunk.content:
+            parts.append(chunk.content)
+            yield chunk.content
+    record_llm_usage(messages, "".join(parts), usage)
+
+async def single_chunk(text: str):
+    """Un hit se devuelve por la misma interfaz, como un único token."""
+    yield text
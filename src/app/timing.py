@@ -0,0 +1,28 @@
+import time
+from contextlib import contextmanager
+from src.app.metrics import observe_stage
+
+class StageTimer:
+    """
+    Acumula el tiempo (en ms) de cada etapa de una petición, p. ej.
+    embed, cache_probe, document_search, llm, cache_write. Cada medida se
+    registra también en el histograma rag_stage_seconds.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            observe_stage(name, elapsed_ms / 1000)
+            self.timings[name] = round(self.timings.get(name, 0.0) + elapsed_ms, 2)
+
+    def elapsed(self) -> float:
+        """Segundos desde la creación del timer."""
+        return time.perf_counter() - self._start
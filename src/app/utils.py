@@ -1,2 +1,23 @@
-def to_pgvector_str(vec):
-    return '[' + ','.join(str(float(x)) for x in vec) + ']' 
\ No newline at end of file
+import numpy as np
+from pgvector import Vector
+
+def as_vector(vec):
+    """
+    Convierte un embedding (lista, array o pgvector.Vector) en un array float32.
+    Es el formato que los adaptadores de pgvector envían en binario, tanto con
+    psycopg como con asyncpg.
+    """
+    if isinstance(vec, Vector):
+        return vec.to_numpy()
+    return np.asarray(vec, dtype=np.float32)
+
+def normalize_vector(vec):
+    """
+    Normaliza el vector a norma L2 = 1. Con vectores unitarios el producto interno
+    (<#>) equivale a la similitud coseno y puede usar índices vector_ip_ops.
+    """
+    vec = as_vector(vec)
+    norm = np.linalg.norm(vec)
+    if norm == 0:
+        return vec
+    return vec / norm
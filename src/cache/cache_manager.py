@@ -1,100 +1,481 @@
 import os
-from src.app.db import get_db_session
+from src.app.db import get_db_session, get_async_db_session, reuse_session, areuse_session
 from sqlalchemy import text
-import hashlib
 from loguru import logger
-from src.app.utils import to_pgvector_str
+from src.app.utils import as_vector
+from src.app.metrics import timed
+from src.app.db.vector_index import apply_search_params, aapply_search_params
+from src.cache.l1_cache import L1Cache
+from src.cache.maintenance import HitTracker, get_hit_tracker
+from src.cache.thresholds import (
+    CACHE_DISTANCE_THRESHOLD, SEMANTIC_CACHE_ENTRY_RADIUS, DistanceRecorder, answers_agree, effective_threshold,
+    entry_radius, get_distance_recorder,
+)
+from src.cache.normalization import EXACT_CACHE_NORMALIZATION, parse_normalization, prompt_digest
+from src.cache.single_flight import (
+    CACHE_SINGLE_FLIGHT, CACHE_ADVISORY_LOCKS, EXACT_LOCK_NAMESPACE, SEMANTIC_LOCK_NAMESPACE,
+    SingleFlight, advisory_lock, aadvisory_lock,
+)
 
-# Para <#> (negative dot product), valores más negativos = mayor similitud
-CACHE_DISTANCE_THRESHOLD = float(os.getenv("CACHE_DISTANCE_THRESHOLD", "-0.95"))
+# Cache L1 en memoria del proceso delante de exact_cache (0 bytes = deshabilitado)
+EXACT_L1_MAX_BYTES = int(os.getenv("EXACT_L1_MAX_BYTES", str(64 * 1024 * 1024)))
+EXACT_L1_TTL_SECONDS = float(os.getenv("EXACT_L1_TTL_SECONDS", "300"))
+
+# SQL compartido por las variantes sync (psycopg) y async (asyncpg); los vectores
+# se pasan como arrays float32 y viajan en binario con ambos drivers
+EXACT_GET_SQL = text("SELECT response, id FROM exact_cache WHERE prompt_hash = :prompt_hash")
+
+# Upsert: prompts concurrentes con la misma clave no generan filas duplicadas
+EXACT_UPSERT_SQL = text('''
+    INSERT INTO exact_cache (prompt_hash, prompt, response)
+    VALUES (:prompt_hash, :prompt, :response)
+    ON CONFLICT (prompt_hash) DO UPDATE
+    SET response = EXCLUDED.response, prompt = EXCLUDED.prompt,
+        created_at = CURRENT_TIMESTAMP, last_accessed_at = CURRENT_TIMESTAMP
+    RETURNING id
+''')
+
+# Solo se comparan entradas generadas con el mismo contexto y se trae
+# únicamente el mejor candidato (sin el vector, que no se usa)
+SEMANTIC_GET_SQL = text('''
+    SELECT response, prompt_embedding <#> :query_vector AS distance, id, radius
+    FROM semantic_cache
+    WHERE context_hash = :context_hash
+    ORDER BY distance ASC
+    LIMIT 1
+''')
+
+# cache_first: solo entradas que ningún cambio del corpus ha invalidado (stale lo marca el Indexer)
+SEMANTIC_GET_BY_CORPUS_VERSION_SQL = text('''
+    SELECT s.version, c.response, c.distance, c.id, c.radius
+    FROM corpus_state s
+    LEFT JOIN LATERAL (
+        SELECT response, prompt_embedding <#> :query_vector AS distance, id, radius
+        FROM semantic_cache
+        WHERE NOT stale
+        ORDER BY distance ASC
+        LIMIT 1
+    ) c ON true
+''')
+
+# El texto del contexto se guarda una sola vez por context_hash en context_texts.
+# Sin versión explícita se usa la versión actual del corpus.
+# :radius y :neighbor_id los calcula SemanticCacheManager._tightening: la entrada nueva y su
+# vecino más cercano del mismo contexto reciben radio = (distancia - 1) / 2 solo si sus
+# respuestas difieren (ver thresholds.entry_radius y answers_agree)
+# document_ids y kth_distance vienen de la búsqueda top-K que produjo el contexto (invalidación
+# incremental); si el corpus cambió desde que se leyó corpus_version, la entrada nace stale
+SEMANTIC_INSERT_SQL = text('''
+    WITH ctx AS (
+        INSERT INTO context_texts (context_hash, context)
+        VALUES (:context_hash, :context)
+        ON CONFLICT (context_hash) DO NOTHING
+    ),
+    tightened AS (
+        UPDATE semantic_cache
+        SET radius = LEAST(COALESCE(radius, :threshold), CAST(:radius AS REAL))
+        WHERE id = CAST(:neighbor_id AS INT)
+    )
+    INSERT INTO semantic_cache (
+        prompt, prompt_embedding, context_hash, response, corpus_version, radius, document_ids, kth_distance, stale
+    )
+    VALUES (:prompt, :prompt_embedding, :context_hash, :response,
+            COALESCE(:corpus_version, (SELECT version FROM corpus_state)),
+            CAST(:radius AS REAL),
+            COALESCE(CAST(:document_ids AS INT[]), '{}'),
+            CAST(:kth_distance AS REAL),
+            COALESCE(:corpus_version, (SELECT version FROM corpus_state)) < (SELECT version FROM corpus_state))
+''')
 
 class ExactCacheManager:
-    def get(self, prompt: str):
-        session = get_db_session()
-        try:
-            sql = text("SELECT response FROM exact_cache WHERE prompt = :prompt LIMIT 1")
-            row = session.execute(sql, {"prompt": prompt}).fetchone()
-            if row:
-                logger.info(f"ExactCache HIT for prompt: {prompt[:30]}...")
-                return row[0]
+    def __init__(self, l1: L1Cache = None, normalization: str = None, hits: HitTracker = None):
+        self.l1 = l1 if l1 is not None else L1Cache(EXACT_L1_MAX_BYTES, EXACT_L1_TTL_SECONDS)
+        self.normalization = parse_normalization(
+            normalization if normalization is not None else EXACT_CACHE_NORMALIZATION
+        )
+        self._flights = SingleFlight()
+        self.hits = hits if hits is not None else get_hit_tracker()
+
+    def key(self, prompt: str) -> bytes:
+        return prompt_digest(prompt, self.normalization)
+
+    def _lookup_l1(self, prompt: str, prompt_hash: bytes):
+        # La L1 guarda (response, id): sus hits también cuentan para el LRU/LFU de la tabla
+        found, value = self.l1.lookup(prompt_hash)
+        if not found:
             return None
-        finally:
-            session.close()
+        logger.info(f"ExactCache L1 HIT for prompt: {prompt[:30]}...")
+        response, entry_id = value
+        self.hits.record("exact_cache", entry_id)
+        return response
 
-    def set(self, prompt: str, response: str):
-        session = get_db_session()
-        try:
-            insert_sql = text("INSERT INTO exact_cache (prompt, response) VALUES (:prompt, :response)")
-            session.execute(insert_sql, {"prompt": prompt, "response": response})
+    def get(self, prompt: str, session=None):
+        prompt_hash = self.key(prompt)
+        response = self._lookup_l1(prompt, prompt_hash)
+        if response is not None:
+            return response
+        return self._get_from_db(prompt, prompt_hash, session)
+
+    async def aget(self, prompt: str, session=None):
+        prompt_hash = self.key(prompt)
+        response = self._lookup_l1(prompt, prompt_hash)
+        if response is not None:
+            return response
+        return await self._aget_from_db(prompt, prompt_hash, session)
+
+    def _get_from_db(self, prompt: str, prompt_hash: bytes, session=None):
+        with timed("exact_cache_probe"), reuse_session(session, get_db_session) as session:
+            row = session.execute(EXACT_GET_SQL, {"prompt_hash": prompt_hash}).fetchone()
+            return self._remember(prompt, prompt_hash, row)
+
+    async def _aget_from_db(self, prompt: str, prompt_hash: bytes, session=None):
+        with timed("exact_cache_probe"):
+            async with areuse_session(session, get_async_db_session) as session:
+                row = (await session.execute(EXACT_GET_SQL, {"prompt_hash": prompt_hash})).fetchone()
+            return self._remember(prompt, prompt_hash, row)
+
+    def _remember(self, prompt: str, prompt_hash: bytes, row):
+        if row:
+            logger.info(f"ExactCache HIT for prompt: {prompt[:30]}...")
+            self.hits.record("exact_cache", row[1])
+            self.l1.set(prompt_hash, (row[0], row[1]))
+            return row[0]
+        return None
+
+    def set(self, prompt: str, response: str, session=None):
+        prompt_hash = self.key(prompt)
+        with timed("exact_cache_write"), reuse_session(session, get_db_session) as session:
+            row = session.execute(
+                EXACT_UPSERT_SQL, {"prompt_hash": prompt_hash, "prompt": prompt, "response": response}
+            ).fetchone()
             session.commit()
-            logger.info(f"ExactCache SET for prompt: {prompt[:30]}...")
-        finally:
-            session.close()
+        self.l1.set(prompt_hash, (response, row[0] if row else None))
+        logger.info(f"ExactCache SET for prompt: {prompt[:30]}...")
+
+    async def aset(self, prompt: str, response: str, session=None):
+        prompt_hash = self.key(prompt)
+        with timed("exact_cache_write"):
+            async with areuse_session(session, get_async_db_session) as session:
+                row = (await session.execute(
+                    EXACT_UPSERT_SQL, {"prompt_hash": prompt_hash, "prompt": prompt, "response": response}
+                )).fetchone()
+                await session.commit()
+        self.l1.set(prompt_hash, (response, row[0] if row else None))
+        logger.info(f"ExactCache SET for prompt: {prompt[:30]}...")
+
+    def get_or_generate(self, prompt: str, generate, session=None):
+        """
+        Devuelve (response, cache_status) con cache_status hit, miss o coalesced.
+        generate() produce la respuesta en un miss; los misses concurrentes del mismo
+        prompt normalizado esperan a una sola generación y comparten su resultado.
+        session es la sesión de la petición (opcional) para la lectura y la escritura.
+        """
+        cached_response = self.get(prompt, session)
+        if cached_response is not None:
+            return cached_response, "hit"
+        if session is not None:
+            # La conexión vuelve al pool mientras se espera al LLM
+            session.commit()
+        prompt_hash = self.key(prompt)
+        if not CACHE_SINGLE_FLIGHT:
+            return self._generate(prompt, prompt_hash, generate, session)
+        (response, cache_status), shared = self._flights.do(
+            prompt_hash, lambda: self._generate(prompt, prompt_hash, generate, session)
+        )
+        return response, "coalesced" if shared else cache_status
+
+    async def aget_or_generate(self, prompt: str, generate, session=None):
+        """Variante async de get_or_generate: generate es una función async."""
+        cached_response = await self.aget(prompt, session)
+        if cached_response is not None:
+            return cached_response, "hit"
+        if session is not None:
+            await session.commit()
+        prompt_hash = self.key(prompt)
+        if not CACHE_SINGLE_FLIGHT:
+            return await self._agenerate(prompt, prompt_hash, generate, session)
+        (response, cache_status), shared = await self._flights.ado(
+            prompt_hash, lambda: self._agenerate(prompt, prompt_hash, generate, session)
+        )
+        return response, "coalesced" if shared else cache_status
+
+    def _generate(self, prompt: str, prompt_hash: bytes, generate, session=None):
+        if not CACHE_ADVISORY_LOCKS:
+            response = generate()
+            self.set(prompt, response, session)
+            return response, "miss"
+        # La re-consulta y la escritura van por la conexión del lock: la de la petición ya se
+        # devolvió al pool y no se vuelve a ocupar mientras se espera al LLM. El commit de set()
+        # libera el lock justo cuando la respuesta queda visible para los demás workers.
+        with advisory_lock(EXACT_LOCK_NAMESPACE, prompt_hash) as lock_session:
+            # Otro worker pudo generar la respuesta mientras se esperaba el lock
+            cached_response = self._get_from_db(prompt, prompt_hash, lock_session)
+            if cached_response is not None:
+                return cached_response, "coalesced"
+            response = generate()
+            self.set(prompt, response, lock_session)
+            return response, "miss"
+
+    async def _agenerate(self, prompt: str, prompt_hash: bytes, generate, session=None):
+        if not CACHE_ADVISORY_LOCKS:
+            response = await generate()
+            await self.aset(prompt, response, session)
+            return response, "miss"
+        async with aadvisory_lock(EXACT_LOCK_NAMESPACE, prompt_hash) as lock_session:
+            cached_response = await self._aget_from_db(prompt, prompt_hash, lock_session)
+            if cached_response is not None:
+                return cached_response, "coalesced"
+            response = await generate()
+            await self.aset(prompt, response, lock_session)
+            return response, "miss"
+
+    def stats(self) -> dict:
+        return self.l1.stats()
 
 class SemanticCacheManager:
-    def get(self, prompt: str, prompt_embedding, context_hash: str, threshold: float = None):
-        session = get_db_session()
+    def __init__(self, hits: HitTracker = None, distances: DistanceRecorder = None, embeddings=None):
+        self._flights = SingleFlight()
+        # Para comparar respuestas al asignar radios por entrada; sin él no se endurece ningún radio
+        self.embeddings = embeddings
+        self.hits = hits if hits is not None else get_hit_tracker()
+        self.distances = distances if distances is not None else get_distance_recorder()
+
+    def get(self, prompt: str, prompt_embedding, context_hash: str, threshold: float = None, session=None):
+        # Usar threshold de entorno si no se pasa explícito
+        th = threshold if threshold is not None else CACHE_DISTANCE_THRESHOLD
+        logger.debug(f"Using threshold: {th}")
         try:
-            # Usar threshold de entorno si no se pasa explícito
-            th = threshold if threshold is not None else CACHE_DISTANCE_THRESHOLD
-            
-            sql = text('''
-                SELECT response, prompt_embedding, prompt_embedding <#> vector(:query_vector) AS distance
-                FROM semantic_cache
-                ORDER BY distance ASC
-                LIMIT 5
-            ''')
-            
-            logger.debug(f"Using threshold: {th}")
-    
-            results = session.execute(sql, {
-                "query_vector": to_pgvector_str(prompt_embedding)
-            }).fetchall()
-            
-            if not results:
-                logger.info("SemanticCache MISS: No results found")
-                return None, None
-                
-            response, cached_vector, distance = results[0]
-            
-            # Para <#>: valores más negativos indican mayor similitud
-            # Verificamos si la distancia es menor que el threshold (más negativa = más similar)
-            if distance <= th:
-                similarity_percentage = (1 + distance) * 50  # Convierte a porcentaje aproximado
-                logger.info(f"SemanticCache HIT: distance={distance:.4f} (~{similarity_percentage:.1f}% similarity)")
-                return response, distance
-            else:
-                similarity_percentage = (1 + distance) * 50
-                logger.info(f"SemanticCache MISS: distance={distance:.4f} (~{similarity_percentage:.1f}% similarity) > threshold={th}")
-                return None, distance
-                
+            with reuse_session(session, get_db_session) as session:
+                apply_search_params(session)
+                row = session.execute(SEMANTIC_GET_SQL, {
+                    "query_vector": as_vector(prompt_embedding),
+                    "context_hash": context_hash
+                }).fetchone()
+            return self._evaluate_row(row, th, context_hash)
         except Exception as e:
             logger.error(f"Error in SemanticCache get: {e}")
             return None, None
-        finally:
-            session.close()
 
-    def set(self, prompt: str, prompt_embedding, context: str, context_hash: str, response: str):
-        session = get_db_session()
+    async def aget(self, prompt: str, prompt_embedding, context_hash: str, threshold: float = None, session=None):
+        th = threshold if threshold is not None else CACHE_DISTANCE_THRESHOLD
         try:
-            insert_sql = text('''
-                INSERT INTO semantic_cache (prompt, prompt_embedding, context, context_hash, response)
-                VALUES (:prompt, :prompt_embedding, :context, :context_hash, :response)
-            ''')
-            session.execute(insert_sql, {
-                "prompt": prompt,
-                "prompt_embedding": prompt_embedding,
-                "context": context,
-                "context_hash": context_hash,
-                "response": response
-            })
-            session.commit()
+            async with areuse_session(session, get_async_db_session) as session:
+                await aapply_search_params(session)
+                row = (await session.execute(SEMANTIC_GET_SQL, {
+                    "query_vector": as_vector(prompt_embedding),
+                    "context_hash": context_hash
+                })).fetchone()
+            return self._evaluate_row(row, th, context_hash)
+        except Exception as e:
+            logger.error(f"Error in SemanticCache aget: {e}")
+            return None, None
+
+    def _evaluate_row(self, row, th: float, context_hash: str):
+        if not row:
+            logger.info(f"SemanticCache MISS: No results found for context_hash={context_hash[:8]}...")
+            return None, None
+        response, distance, entry_id, radius = row
+        return self.check_candidate(response, distance, entry_id, radius, th)
+
+    def check_candidate(self, response: str, distance: float, entry_id: int, radius: float, threshold: float = None):
+        """
+        Evalúa el mejor candidato de una consulta hecha fuera del manager (p. ej. las
+        búsquedas por lotes de Retriever.query_many). Devuelve (response, distance).
+        """
+        if response is None:
+            return None, None
+        th = threshold if threshold is not None else CACHE_DISTANCE_THRESHOLD
+        return self._check_threshold(response, distance, effective_threshold(th, radius), entry_id)
+
+    def get_by_corpus_version(self, prompt: str, prompt_embedding, threshold: float = None, session=None):
+        """
+        Búsqueda para el pipeline cache-first: no requiere el contexto, solo compara
+        entradas que no están marcadas como stale. Devuelve (response, distance, corpus_version)
+        con la versión leída en la misma consulta, que se pasa luego a set().
+        """
+        th = threshold if threshold is not None else CACHE_DISTANCE_THRESHOLD
+        try:
+            with reuse_session(session, get_db_session) as session:
+                apply_search_params(session)
+                row = session.execute(SEMANTIC_GET_BY_CORPUS_VERSION_SQL, {
+                    "query_vector": as_vector(prompt_embedding)
+                }).fetchone()
+            return self._evaluate_versioned_row(row, th)
+        except Exception as e:
+            logger.error(f"Error in SemanticCache get_by_corpus_version: {e}")
+            return None, None, None
+
+    async def aget_by_corpus_version(self, prompt: str, prompt_embedding, threshold: float = None, session=None):
+        th = threshold if threshold is not None else CACHE_DISTANCE_THRESHOLD
+        try:
+            async with areuse_session(session, get_async_db_session) as session:
+                await aapply_search_params(session)
+                row = (await session.execute(SEMANTIC_GET_BY_CORPUS_VERSION_SQL, {
+                    "query_vector": as_vector(prompt_embedding)
+                })).fetchone()
+            return self._evaluate_versioned_row(row, th)
+        except Exception as e:
+            logger.error(f"Error in SemanticCache aget_by_corpus_version: {e}")
+            return None, None, None
+
+    def _evaluate_versioned_row(self, row, th: float):
+        if not row:
+            return None, None, None
+        corpus_version, response, distance, entry_id, radius = row
+        if response is None:
+            logger.info(f"SemanticCache MISS: No results found for corpus_version={corpus_version}")
+            return None, None, corpus_version
+        response, distance = self._check_threshold(response, distance, effective_threshold(th, radius), entry_id)
+        return response, distance, corpus_version
+
+    def _check_threshold(self, response: str, distance: float, th: float, entry_id: int = None):
+        # Para <#>: valores más negativos indican mayor similitud
+        # Verificamos si la distancia es menor que el threshold (más negativa = más similar)
+        similarity_percentage = self.get_similarity_percentage(distance)
+        self.distances.record(distance, distance <= th)
+        if distance <= th:
+            logger.info(f"SemanticCache HIT: distance={distance:.4f} (~{similarity_percentage:.1f}% similarity)")
+            self.hits.record("semantic_cache", entry_id)
+            return response, distance
+        logger.info(f"SemanticCache MISS: distance={distance:.4f} (~{similarity_percentage:.1f}% similarity) > threshold={th}")
+        return None, distance
+
+    def set(self, prompt: str, prompt_embedding, context: str, context_hash: str, response: str, corpus_version: int = None,
+            sources: tuple = None, session=None):
+        """
+        sources es (document_ids, kth_distance) de la búsqueda que produjo el contexto; sin él
+        la entrada no guarda documentos y cualquier documento nuevo la marca como stale.
+        """
+        try:
+            with reuse_session(session, get_db_session) as session:
+                tightening = self._tightening(session, prompt_embedding, context_hash, response)
+                session.execute(SEMANTIC_INSERT_SQL, {
+                    "prompt": prompt,
+                    "prompt_embedding": as_vector(prompt_embedding),
+                    "context": context,
+                    "context_hash": context_hash,
+                    "response": response,
+                    "corpus_version": corpus_version,
+                    "threshold": CACHE_DISTANCE_THRESHOLD,
+                    **tightening,
+                    **self._sources_params(sources)
+                })
+                session.commit()
             logger.info(f"SemanticCache SET for prompt: {prompt[:30]}...")
         except Exception as e:
             logger.error(f"Error in SemanticCache set: {e}")
             raise
-        finally:
-            session.close()
+
+    async def aset(self, prompt: str, prompt_embedding, context: str, context_hash: str, response: str, corpus_version: int = None,
+            sources: tuple = None, session=None):
+        try:
+            async with areuse_session(session, get_async_db_session) as session:
+                tightening = await self._atightening(session, prompt_embedding, context_hash, response)
+                await session.execute(SEMANTIC_INSERT_SQL, {
+                    "prompt": prompt,
+                    "prompt_embedding": as_vector(prompt_embedding),
+                    "context": context,
+                    "context_hash": context_hash,
+                    "response": response,
+                    "corpus_version": corpus_version,
+                    "threshold": CACHE_DISTANCE_THRESHOLD,
+                    **tightening,
+                    **self._sources_params(sources)
+                })
+                await session.commit()
+            logger.info(f"SemanticCache SET for prompt: {prompt[:30]}...")
+        except Exception as e:
+            logger.error(f"Error in SemanticCache aset: {e}")
+            raise
+
+    def _tightening(self, session, prompt_embedding, context_hash: str, response: str) -> dict:
+        """
+        Radio para la entrada nueva y su vecino más cercano del mismo contexto. Solo se
+        endurece si el vecino está más cerca de lo que permite el threshold y su respuesta
+        no equivale a la nueva; si coinciden, compartir la respuesta no es un error.
+        """
+        none = {"radius": None, "neighbor_id": None}
+        if not SEMANTIC_CACHE_ENTRY_RADIUS or self.embeddings is None:
+            return none
+        row = session.execute(SEMANTIC_GET_SQL, {
+            "query_vector": as_vector(prompt_embedding), "context_hash": context_hash
+        }).fetchone()
+        radius = entry_radius(row[1], CACHE_DISTANCE_THRESHOLD) if row else None
+        if radius is None:
+            return none
+        try:
+            if answers_agree(*self.embeddings.embed_documents([response, row[0]])):
+                return none
+        except Exception as e:
+            logger.error(f"Error comparando respuestas para el radio de la entrada: {e}")
+            return none
+        return {"radius": radius, "neighbor_id": row[2]}
+
+    async def _atightening(self, session, prompt_embedding, context_hash: str, response: str) -> dict:
+        none = {"radius": None, "neighbor_id": None}
+        if not SEMANTIC_CACHE_ENTRY_RADIUS or self.embeddings is None:
+            return none
+        row = (await session.execute(SEMANTIC_GET_SQL, {
+            "query_vector": as_vector(prompt_embedding), "context_hash": context_hash
+        })).fetchone()
+        radius = entry_radius(row[1], CACHE_DISTANCE_THRESHOLD) if row else None
+        if radius is None:
+            return none
+        try:
+            if answers_agree(*await self.embeddings.aembed_documents([response, row[0]])):
+                return none
+        except Exception as e:
+            logger.error(f"Error comparando respuestas para el radio de la entrada: {e}")
+            return none
+        return {"radius": radius, "neighbor_id": row[2]}
+
+    def _sources_params(self, sources: tuple) -> dict:
+        document_ids, kth_distance = sources if sources is not None else (None, None)
+        return {
+            "document_ids": list(document_ids) if document_ids is not None else None,
+            "kth_distance": float(kth_distance) if kth_distance is not None else None,
+        }
+
+    def coalesce(self, prompt: str, prompt_embedding, context_hash: str, generate, threshold: float = None):
+        """
+        Ejecuta generate() (que genera y guarda la respuesta) agrupando misses concurrentes
+        con el mismo contexto cuyo embedding está dentro del threshold. Devuelve
+        (response, cache_status) con cache_status miss o coalesced.
+        """
+        if not CACHE_SINGLE_FLIGHT:
+            return generate(), "miss"
+        th = threshold if threshold is not None else CACHE_DISTANCE_THRESHOLD
+
+        def leader():
+            if not CACHE_ADVISORY_LOCKS:
+                return generate(), "miss"
+            # Entre workers solo se agrupan prompts idénticos (tras normalizar) con el mismo contexto
+            with advisory_lock(SEMANTIC_LOCK_NAMESPACE, prompt_digest(f"{context_hash}\n{prompt}")) as lock_session:
+                cached_response, _ = self.get(prompt, prompt_embedding, context_hash, th, session=lock_session)
+                if cached_response is not None:
+                    return cached_response, "coalesced"
+                return generate(), "miss"
+
+        (response, cache_status), shared = self._flights.do(context_hash, leader, vector=prompt_embedding, threshold=th)
+        return response, "coalesced" if shared else cache_status
+
+    async def acoalesce(self, prompt: str, prompt_embedding, context_hash: str, generate, threshold: float = None):
+        """Variante async de coalesce: generate es una función async."""
+        if not CACHE_SINGLE_FLIGHT:
+            return await generate(), "miss"
+        th = threshold if threshold is not None else CACHE_DISTANCE_THRESHOLD
+
+        async def leader():
+            if not CACHE_ADVISORY_LOCKS:
+                return await generate(), "miss"
+            async with aadvisory_lock(SEMANTIC_LOCK_NAMESPACE, prompt_digest(f"{context_hash}\n{prompt}")) as lock_session:
+                cached_response, _ = await self.aget(prompt, prompt_embedding, context_hash, th, session=lock_session)
+                if cached_response is not None:
+                    return cached_response, "coalesced"
+                return await generate(), "miss"
+
+        (response, cache_status), shared = await self._flights.ado(context_hash, leader, vector=prompt_embedding, threshold=th)
+        return response, "coalesced" if shared else cache_status
 
     def get_similarity_percentage(self, distance: float) -> float:
         """
@@ -0,0 +1,220 @@
+import os
+import hashlib
+import threading
+from array import array
+from sqlalchemy import text
+from loguru import logger
+from src.app.db import get_db_session, get_async_db_session, reuse_session, areuse_session
+from src.app.utils import as_vector
+from src.cache.l1_cache import L1Cache
+
+# Presupuesto de la cache de embeddings en memoria (0 = deshabilitada)
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Almacenamiento persistente detrás de la cache en memoria: postgres | none
+EMBEDDING_CACHE_BACKEND = os.getenv("EMBEDDING_CACHE_BACKEND", "postgres").lower()
+
+# Los embeddings de consulta y de documento usan tareas distintas en Gemini
+# (retrieval_query / retrieval_document), así que forman parte de la clave.
+TASK_QUERY = "query"
+TASK_DOCUMENT = "document"
+# task_type con el que GoogleGenerativeAIEmbeddings.embed_query embebe los prompts
+REMOTE_QUERY_TASK_TYPE = "RETRIEVAL_QUERY"
+
+def text_digest(text_value: str) -> bytes:
+    return hashlib.sha256(text_value.encode("utf-8")).digest()
+
+EMBEDDING_GET_SQL = text('''
+    SELECT text_hash, embedding
+    FROM embedding_cache
+    WHERE model = :model AND task = :task AND text_hash = ANY(:digests)
+''')
+
+class PostgresEmbeddingStore:
+    """
+    Persiste embeddings en la tabla embedding_cache, clave (model, task, text_hash).
+    Con session (la de la petición) no se saca otra conexión del pool.
+    """
+
+    def get_many(self, model: str, task: str, digests: list, session=None) -> dict:
+        with reuse_session(session, get_db_session) as session:
+            rows = session.execute(EMBEDDING_GET_SQL, {"model": model, "task": task, "digests": digests}).fetchall()
+            return self._parse_rows(rows)
+
+    async def aget_many(self, model: str, task: str, digests: list, session=None) -> dict:
+        async with areuse_session(session, get_async_db_session) as session:
+            result = await session.execute(EMBEDDING_GET_SQL, {"model": model, "task": task, "digests": digests})
+            return self._parse_rows(result.fetchall())
+
+    def put_many(self, model: str, task: str, items: list, session=None):
+        if not items:
+            return
+        with reuse_session(session, get_db_session) as session:
+            try:
+                session.execute(*self._insert_statement(model, task, items))
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+
+    async def aput_many(self, model: str, task: str, items: list, session=None):
+        if not items:
+            return
+        async with areuse_session(session, get_async_db_session) as session:
+            await session.execute(*self._insert_statement(model, task, items))
+            await session.commit()
+
+    def _parse_rows(self, rows) -> dict:
+        return {bytes(digest): as_vector(embedding) for digest, embedding in rows}
+
+    def _insert_statement(self, model: str, task: str, items: list):
+        values = []
+        params = {"model": model, "task": task}
+        for i, (digest, vector) in enumerate(items):
+            values.append(f"(:model, :task, :hash_{i}, :embedding_{i})")
+            params[f"hash_{i}"] = digest
+            params[f"embedding_{i}"] = as_vector(vector)
+        sql = text(f'''
+            INSERT INTO embedding_cache (model, task, text_hash, embedding)
+            VALUES {", ".join(values)}
+            ON CONFLICT (model, task, text_hash) DO NOTHING
+        ''')
+        return sql, params
+
+class CachedEmbeddings:
+    """
+    Envuelve un objeto de embeddings de LangChain con una cache direccionada por
+    contenido: LRU en memoria y, detrás, un almacenamiento persistente. Solo los
+    textos que no están en ninguna de las dos se envían a la API remota.
+    Los métodos de consulta aceptan session (la de la petición) para leer y escribir
+    en el almacenamiento sin otra conexión del pool.
+    """
+
+    def __init__(self, embeddings, model: str, max_bytes: int = None, store=None):
+        self.embeddings = embeddings
+        self.model = model
+        max_bytes = max_bytes if max_bytes is not None else EMBEDDING_CACHE_MAX_BYTES
+        self.memory = L1Cache(max_bytes, ttl_seconds=float("inf"))
+        self.store = store
+        self.remote_calls = 0
+
+    def embed_query(self, text_value: str, session=None):
+        return self._embed(
+            [text_value], TASK_QUERY, lambda texts: [self.embeddings.embed_query(texts[0])], session
+        )[0]
+
+    def embed_documents(self, texts: list):
+        return self._embed(list(texts), TASK_DOCUMENT, self.embeddings.embed_documents)
+
+    def embed_queries(self, texts: list, session=None):
+        """
+        Varios prompts en una sola llamada remota (embed_documents con la tarea de
+        consulta): mismos vectores y mismas entradas de cache que embed_query.
+        """
+        return self._embed(
+            list(texts), TASK_QUERY, lambda batch: self.embeddings.embed_documents(batch, task_type=REMOTE_QUERY_TASK_TYPE),
+            session
+        )
+
+    async def aembed_query(self, text_value: str, session=None):
+        async def compute(texts):
+            return [await self.embeddings.aembed_query(texts[0])]
+        return (await self._aembed([text_value], TASK_QUERY, compute, session))[0]
+
+    async def aembed_documents(self, texts: list):
+        return await self._aembed(list(texts), TASK_DOCUMENT, self.embeddings.aembed_documents)
+
+    async def aembed_queries(self, texts: list, session=None):
+        async def compute(batch):
+            return await self.embeddings.aembed_documents(batch, task_type=REMOTE_QUERY_TASK_TYPE)
+        return await self._aembed(list(texts), TASK_QUERY, compute, session)
+
+    def _embed(self, texts: list, task: str, compute, session=None):
+        results, pending = self._lookup_memory(texts, task)
+        if pending and self.store is not None:
+            try:
+                stored = self.store.get_many(self.model, task, list(pending), session=session)
+            except Exception as e:
+                logger.error(f"Error leyendo embedding_cache: {e}")
+                stored = {}
+            self._fill_stored(task, stored, results, pending)
+        if pending:
+            missing = list(pending)
+            vectors = compute([texts[pending[digest][0]] for digest in missing])
+            self._fill_computed(task, missing, vectors, results, pending)
+            if self.store is not None:
+                try:
+                    self.store.put_many(self.model, task, list(zip(missing, vectors)), session=session)
+                except Exception as e:
+                    logger.error(f"Error guardando en embedding_cache: {e}")
+        return results
+
+    async def _aembed(self, texts: list, task: str, compute, session=None):
+        results, pending = self._lookup_memory(texts, task)
+        if pending and self.store is not None:
+            try:
+                stored = await self.store.aget_many(self.model, task, list(pending), session=session)
+            except Exception as e:
+                logger.error(f"Error leyendo embedding_cache: {e}")
+                stored = {}
+            self._fill_stored(task, stored, results, pending)
+        if pending:
+            missing = list(pending)
+            vectors = await compute([texts[pending[digest][0]] for digest in missing])
+            self._fill_computed(task, missing, vectors, results, pending)
+            if self.store is not None:
+                try:
+                    await self.store.aput_many(self.model, task, list(zip(missing, vectors)), session=session)
+                except Exception as e:
+                    logger.error(f"Error guardando en embedding_cache: {e}")
+        return results
+
+    def _lookup_memory(self, texts: list, task: str):
+        """Devuelve (results, pending): pending agrupa por digest los índices que faltan."""
+        results = [None] * len(texts)
+        pending = {}
+        for i, text_value in enumerate(texts):
+            digest = text_digest(text_value)
+            found, vector = self.memory.lookup((self.model, task, digest))
+            if found:
+                results[i] = list(vector)
+            else:
+                pending.setdefault(digest, []).append(i)
+        return results, pending
+
+    def _fill_stored(self, task: str, stored: dict, results: list, pending: dict):
+        for digest, vector in stored.items():
+            self._remember(task, digest, vector)
+            for i in pending.pop(digest):
+                results[i] = vector
+
+    def _fill_computed(self, task: str, missing: list, vectors: list, results: list, pending: dict):
+        self.remote_calls += 1
+        for digest, vector in zip(missing, vectors):
+            self._remember(task, digest, vector)
+            for i in pending[digest]:
+                results[i] = vector
+        pending.clear()
+
+    def _remember(self, task: str, digest: bytes, vector):
+        # array('f') ocupa 4 bytes por dimensión y sys.getsizeof lo mide bien
+        self.memory.set((self.model, task, digest), array("f", as_vector(vector).tobytes()))
+
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        stats["remote_calls"] = self.remote_calls
+        return stats
+
+_shared_embeddings = {}
+_shared_lock = threading.Lock()
+
+def get_cached_embeddings(model: str):
+    """
+    Devuelve una instancia compartida por modelo, de modo que Retriever e Indexer
+    reutilizan la misma cache en memoria.
+    """
+    with _shared_lock:
+        if model not in _shared_embeddings:
+            from langchain_google_genai import GoogleGenerativeAIEmbeddings
+            store = PostgresEmbeddingStore() if EMBEDDING_CACHE_BACKEND == "postgres" else None
+            _shared_embeddings[model] = CachedEmbeddings(GoogleGenerativeAIEmbeddings(model=model), model, store=store)
+        return _shared_embeddings[model]
@@ -0,0 +1,102 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class L1Cache:
+    """
+    Cache en memoria del proceso (L1) delante de las tablas de cache en Postgres.
+    Desaloja por LRU cuando se supera el presupuesto en bytes y por TTL al leer.
+    Solo guarda hits: un miss siempre se vuelve a consultar en la DB, donde otro
+    worker pudo guardar la respuesta.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def lookup(self, key):
+        """Devuelve (found, value)."""
+        if not self.enabled:
+            return False, None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            value, size, expires_at = entry
+            if expires_at <= now:
+                self._remove(key)
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def set(self, key, value: str):
+        self._store(key, value, self.ttl_seconds)
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _store(self, key, value, ttl: float):
+        if not self.enabled or ttl <= 0:
+            return
+        size = sys.getsizeof(key) + _sizeof(value)
+        if size > self.max_bytes:
+            # Una entrada que no cabe en el presupuesto no se guarda
+            self.invalidate(key)
+            return
+        expires_at = time.monotonic() + ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires_at)
+            self._current_bytes += size
+            while self._current_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._current_bytes -= size
+
+
+def _sizeof(value) -> int:
+    if value is None:
+        return 0
+    # Las tuplas (p. ej. (response, id)) cuentan también el tamaño de sus elementos
+    if isinstance(value, tuple):
+        return sys.getsizeof(value) + sum(_sizeof(item) for item in value)
+    return sys.getsizeof(value)
@@ -0,0 +1,311 @@
+import os
+import math
+import time
+import threading
+from sqlalchemy import text
+from loguru import logger
+from src.app.db import get_engine, get_db_session
+
+# Cada cuánto corre el ciclo de mantenimiento (0 = deshabilitado)
+CACHE_MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("CACHE_MAINTENANCE_INTERVAL_SECONDS", "300"))
+# Antigüedad máxima de una entrada desde su creación (0 = sin TTL)
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+EXACT_CACHE_TTL_SECONDS = float(os.getenv("EXACT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Presupuestos por tabla (0 = sin límite); al superarlos se desaloja según CACHE_EVICTION_POLICY
+SEMANTIC_CACHE_MAX_ROWS = int(os.getenv("SEMANTIC_CACHE_MAX_ROWS", "100000"))
+SEMANTIC_CACHE_MAX_BYTES = int(os.getenv("SEMANTIC_CACHE_MAX_BYTES", "0"))
+EXACT_CACHE_MAX_ROWS = int(os.getenv("EXACT_CACHE_MAX_ROWS", "100000"))
+EXACT_CACHE_MAX_BYTES = int(os.getenv("EXACT_CACHE_MAX_BYTES", "0"))
+# lru: primero las menos usadas recientemente; lfu: primero las de menos hits
+CACHE_EVICTION_POLICY = os.getenv("CACHE_EVICTION_POLICY", "lru").lower()
+# VACUUM (ANALYZE) y REINDEX de las tablas de cache (0 = deshabilitado)
+CACHE_VACUUM_INTERVAL_SECONDS = float(os.getenv("CACHE_VACUUM_INTERVAL_SECONDS", str(24 * 3600)))
+CACHE_REINDEX_INTERVAL_SECONDS = float(os.getenv("CACHE_REINDEX_INTERVAL_SECONDS", str(7 * 24 * 3600)))
+
+EVICTION_ORDER = {
+    "lru": "last_accessed_at ASC",
+    "lfu": "hit_count ASC, last_accessed_at ASC",
+}
+
+# tabla -> (ttl, max_rows, max_bytes)
+CACHE_TABLES = {
+    "semantic_cache": (SEMANTIC_CACHE_TTL_SECONDS, SEMANTIC_CACHE_MAX_ROWS, SEMANTIC_CACHE_MAX_BYTES),
+    "exact_cache": (EXACT_CACHE_TTL_SECONDS, EXACT_CACHE_MAX_ROWS, EXACT_CACHE_MAX_BYTES),
+}
+
+DELETE_ORPHAN_CONTEXTS_SQL = text('''
+    DELETE FROM context_texts c
+    WHERE NOT EXISTS (SELECT 1 FROM semantic_cache s WHERE s.context_hash = c.context_hash)
+''')
+
+# pg_try_advisory_lock(int, int): un solo ciclo de mantenimiento a la vez entre workers y réplicas
+# (7301 y 7302 son los del single-flight, 7303 el del warm-up)
+MAINTENANCE_LOCK_NAMESPACE = 7304
+MAINTENANCE_LOCK_KEY = 0
+
+MAINTENANCE_LOCK_SQL = text("SELECT pg_try_advisory_lock(:namespace, :key)")
+MAINTENANCE_UNLOCK_SQL = text("SELECT pg_advisory_unlock(:namespace, :key)")
+MAINTENANCE_LOCK_PARAMS = {"namespace": MAINTENANCE_LOCK_NAMESPACE, "key": MAINTENANCE_LOCK_KEY}
+
+# Reclama el ciclo si ningún proceso lo ha ejecutado en los últimos :min_gap segundos, para que
+# los workers que despiertan a la vez no repitan el desalojo con estadísticas aún sin actualizar.
+# Devuelve si toca VACUUM y REINDEX según las fechas compartidas (no se reinician con cada arranque).
+MAINTENANCE_CLAIM_SQL = text('''
+    UPDATE cache_maintenance_state
+    SET last_run_at = LOCALTIMESTAMP
+    WHERE id AND (last_run_at IS NULL OR last_run_at <= LOCALTIMESTAMP - make_interval(secs => :min_gap))
+    RETURNING COALESCE(last_vacuum_at <= LOCALTIMESTAMP - make_interval(secs => :vacuum_interval), true),
+              COALESCE(last_reindex_at <= LOCALTIMESTAMP - make_interval(secs => :reindex_interval), true)
+''')
+MAINTENANCE_VACUUM_DONE_SQL = text("UPDATE cache_maintenance_state SET last_vacuum_at = LOCALTIMESTAMP WHERE id")
+MAINTENANCE_REINDEX_DONE_SQL = text("UPDATE cache_maintenance_state SET last_reindex_at = LOCALTIMESTAMP WHERE id")
+
+TABLE_SIZE_ESTIMATE_SQL = text('''
+    SELECT s.n_live_tup,
+           pg_table_size(s.relid) * s.n_live_tup / GREATEST(s.n_live_tup + s.n_dead_tup, 1)
+    FROM pg_stat_user_tables s
+    WHERE s.relid = CAST(:table AS regclass)
+''')
+
+class HitTracker:
+    """
+    Acumula en memoria los hits por entrada (tabla, id). Los cache managers solo
+    incrementan un contador; el mantenimiento los vuelca a hit_count y
+    last_accessed_at con un UPDATE por tabla.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hits = {}  # (table, id) -> [count, last_access_epoch]
+
+    def record(self, table: str, entry_id: int):
+        if entry_id is None:
+            return
+        with self._lock:
+            entry = self._hits.setdefault((table, entry_id), [0, 0.0])
+            entry[0] += 1
+            entry[1] = time.time()
+
+    def drain(self) -> dict:
+        """Devuelve {table: [(id, count, last_access_epoch)]} y vacía los contadores."""
+        with self._lock:
+            hits, self._hits = self._hits, {}
+        by_table = {}
+        for (table, entry_id), (count, last_access) in hits.items():
+            by_table.setdefault(table, []).append((entry_id, count, last_access))
+        return by_table
+
+    def restore(self, by_table: dict):
+        """Devuelve a los contadores unos hits drenados que no se llegaron a escribir."""
+        with self._lock:
+            for table, rows in by_table.items():
+                for entry_id, count, last_access in rows:
+                    entry = self._hits.setdefault((table, entry_id), [0, 0.0])
+                    entry[0] += count
+                    entry[1] = max(entry[1], last_access)
+
+    def flush(self, session) -> int:
+        """
+        Escribe los hits acumulados y hace commit. Si la escritura o el commit fallan, los
+        hits vuelven a los contadores para el siguiente volcado y se relanza el error.
+        """
+        drained = self.drain()
+        try:
+            written = self._write(session, drained)
+            session.commit()
+        except Exception:
+            self.restore(drained)
+            raise
+        return written
+
+    def _write(self, session, by_table: dict) -> int:
+        written = 0
+        for table, rows in by_table.items():
+            values = []
+            params = {}
+            for i, (entry_id, count, last_access) in enumerate(rows):
+                values.append(f"(:id_{i}, :count_{i}, :ts_{i})")
+                params[f"id_{i}"] = entry_id
+                params[f"count_{i}"] = count
+                params[f"ts_{i}"] = last_access
+            session.execute(text(f'''
+                UPDATE {table} t
+                SET hit_count = t.hit_count + v.hits,
+                    last_accessed_at = GREATEST(t.last_accessed_at, to_timestamp(v.ts)::timestamp)
+                FROM (VALUES {", ".join(values)}) AS v(id, hits, ts)
+                WHERE t.id = v.id
+            '''), params)
+            written += len(rows)
+        return written
+
+class CacheMaintainer:
+    """
+    Ciclo de vida de exact_cache y semantic_cache en un hilo en segundo plano:
+    vuelca los hits, aplica TTL y presupuestos de filas/bytes, elimina contextos
+    huérfanos y lanza VACUUM/REINDEX según su propio intervalo. Cada proceso vuelca
+    sus propios hits; el resto del ciclo lo ejecuta un solo proceso a la vez (advisory
+    lock) y como mucho una vez por intervalo (cache_maintenance_state).
+    """
+
+    def __init__(self, hits: HitTracker = None, interval: float = None, policy: str = None, tables: dict = None):
+        self.hits = hits if hits is not None else get_hit_tracker()
+        self.interval = interval if interval is not None else CACHE_MAINTENANCE_INTERVAL_SECONDS
+        self.policy = policy or CACHE_EVICTION_POLICY
+        if self.policy not in EVICTION_ORDER:
+            raise ValueError(f"CACHE_EVICTION_POLICY no soportado: {self.policy}")
+        self.tables = tables if tables is not None else CACHE_TABLES
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.skipped_runs = 0
+        self.failed_runs = 0
+        self.hits_flushed = 0
+        self.evicted = {table: 0 for table in self.tables}
+
+    def start(self):
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="cache-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        # Los hits pendientes no se pierden al apagar
+        self._flush_hits()
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "runs": self.runs,
+            "skipped_runs": self.skipped_runs,
+            "failed_runs": self.failed_runs,
+            "hits_flushed": self.hits_flushed,
+            "evicted": dict(self.evicted),
+        }
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self) -> dict:
+        """Ejecuta un ciclo completo; devuelve las filas desalojadas por tabla."""
+        evicted = {}
+        try:
+            self._flush_hits()
+            # Conexión propia en AUTOCOMMIT: mantiene el lock de sesión y admite VACUUM/REINDEX
+            with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                if not connection.execute(MAINTENANCE_LOCK_SQL, MAINTENANCE_LOCK_PARAMS).scalar():
+                    self.skipped_runs += 1
+                    logger.debug("Mantenimiento de cache omitido: otro worker o réplica lo está ejecutando")
+                    return evicted
+                try:
+                    due = connection.execute(MAINTENANCE_CLAIM_SQL, {
+                        "min_gap": self.interval / 2,
+                        "vacuum_interval": CACHE_VACUUM_INTERVAL_SECONDS,
+                        "reindex_interval": CACHE_REINDEX_INTERVAL_SECONDS,
+                    }).fetchone()
+                    if due is None:
+                        self.skipped_runs += 1
+                        logger.debug("Mantenimiento de cache omitido: otro proceso acaba de ejecutarlo")
+                        return evicted
+                    session = get_db_session()
+                    try:
+                        for table, (ttl, max_rows, max_bytes) in self.tables.items():
+                            evicted[table] = self._evict(session, table, ttl, max_rows, max_bytes)
+                            self.evicted[table] = self.evicted.get(table, 0) + evicted[table]
+                        session.execute(DELETE_ORPHAN_CONTEXTS_SQL)
+                        session.commit()
+                    except Exception:
+                        session.rollback()
+                        raise
+                    finally:
+                        session.close()
+                    self._run_scheduled_maintenance(connection, *due)
+                finally:
+                    connection.execute(MAINTENANCE_UNLOCK_SQL, MAINTENANCE_LOCK_PARAMS)
+            self.runs += 1
+            if any(evicted.values()):
+                logger.info(f"Mantenimiento de cache: desalojadas {evicted}")
+        except Exception as e:
+            self.failed_runs += 1
+            logger.error(f"Error en el mantenimiento de cache: {e}")
+        return evicted
+
+    def _flush_hits(self):
+        session = get_db_session()
+        try:
+            self.hits_flushed += self.hits.flush(session)
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error volcando hits de cache: {e}")
+        finally:
+            session.close()
+
+    def _evict(self, session, table: str, ttl: float, max_rows: int, max_bytes: int) -> int:
+        evicted = 0
+        if ttl > 0:
+            evicted += session.execute(
+                text(f"DELETE FROM {table} WHERE created_at < CURRENT_TIMESTAMP - make_interval(secs => :ttl)"),
+                {"ttl": ttl}
+            ).rowcount
+        if max_rows <= 0 and max_bytes <= 0:
+            return evicted
+        # Estimación sin recorrer la tabla: filas vivas según las estadísticas de Postgres y
+        # pg_table_size en proporción a ellas (sin el espacio muerto que deja DELETE hasta el VACUUM).
+        # Las estadísticas aún no ven el DELETE por TTL de esta misma transacción.
+        live_rows, live_bytes = session.execute(TABLE_SIZE_ESTIMATE_SQL, {"table": table}).fetchone() or (0, 0)
+        rows = max(int(live_rows) - evicted, 0)
+        live_bytes = int(live_bytes) * rows // max(int(live_rows), 1)
+        excess = 0
+        if max_rows > 0 and rows > max_rows:
+            excess = rows - max_rows
+        if max_bytes > 0 and live_bytes > max_bytes and rows:
+            excess = max(excess, math.ceil((live_bytes - max_bytes) / (live_bytes / rows)))
+        if excess:
+            evicted += session.execute(text(f'''
+                DELETE FROM {table}
+                WHERE id IN (SELECT id FROM {table} ORDER BY {EVICTION_ORDER[self.policy]} LIMIT :excess)
+            '''), {"excess": excess}).rowcount
+        return evicted
+
+    def _run_scheduled_maintenance(self, connection, vacuum_due: bool, reindex_due: bool):
+        # VACUUM y REINDEX CONCURRENTLY no pueden ejecutarse dentro de una transacción: connection va en AUTOCOMMIT
+        if CACHE_VACUUM_INTERVAL_SECONDS > 0 and vacuum_due:
+            for table in list(self.tables) + ["context_texts"]:
+                logger.info(f"Mantenimiento de cache: VACUUM (ANALYZE) {table}")
+                connection.execute(text(f"VACUUM (ANALYZE) {table}"))
+            connection.execute(MAINTENANCE_VACUUM_DONE_SQL)
+        if CACHE_REINDEX_INTERVAL_SECONDS > 0 and reindex_due:
+            # Los índices HNSW no recuperan el espacio de las filas borradas hasta reconstruirse
+            for table in self.tables:
+                logger.info(f"Mantenimiento de cache: REINDEX TABLE CONCURRENTLY {table}")
+                connection.execute(text(f"REINDEX TABLE CONCURRENTLY {table}"))
+            connection.execute(MAINTENANCE_REINDEX_DONE_SQL)
+
+_hit_tracker = HitTracker()
+_cache_maintainer = None
+
+def get_hit_tracker() -> HitTracker:
+    return _hit_tracker
+
+def get_cache_maintainer() -> CacheMaintainer:
+    global _cache_maintainer
+    if _cache_maintainer is None:
+        _cache_maintainer = CacheMaintainer()
+    return _cache_maintainer
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Mantenimiento de exact_cache y semantic_cache")
+    parser.add_argument("--once", action="store_true", help="Ejecuta un ciclo de TTL y desalojo y termina")
+    args = parser.parse_args()
+    if args.once:
+        # interval=0: el ciclo manual no espera a que pase medio intervalo desde el último
+        print(CacheMaintainer(interval=0).run_once())
+    else:
+        parser.print_help()
@@ -0,0 +1,39 @@
+import os
+import re
+import hashlib
+import unicodedata
+
+# Pasos de normalización aplicados al prompt antes de calcular la clave del exact cache.
+# Valores posibles (separados por coma): nfc, whitespace, casefold, accents
+EXACT_CACHE_NORMALIZATION = os.getenv("EXACT_CACHE_NORMALIZATION", "nfc,whitespace")
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def parse_normalization(spec: str) -> frozenset:
+    steps = frozenset(step.strip().lower() for step in spec.split(",") if step.strip())
+    unknown = steps - {"nfc", "whitespace", "casefold", "accents"}
+    if unknown:
+        raise ValueError(f"Pasos de normalización desconocidos: {', '.join(sorted(unknown))}")
+    return steps
+
+def normalize_prompt(prompt: str, steps: frozenset = None) -> str:
+    """
+    Normaliza el prompt según los pasos configurados. "accents" elimina tildes y
+    diacríticos (¿Cuál -> ¿Cual) y "casefold" ignora mayúsculas.
+    """
+    steps = steps if steps is not None else parse_normalization(EXACT_CACHE_NORMALIZATION)
+    text = prompt
+    if "nfc" in steps or "accents" in steps:
+        text = unicodedata.normalize("NFC", text)
+    if "accents" in steps:
+        decomposed = unicodedata.normalize("NFD", text)
+        text = unicodedata.normalize("NFC", "".join(c for c in decomposed if not unicodedata.combining(c)))
+    if "casefold" in steps:
+        text = text.casefold()
+    if "whitespace" in steps:
+        text = _WHITESPACE_RE.sub(" ", text).strip()
+    return text
+
+def prompt_digest(prompt: str, steps: frozenset = None) -> bytes:
+    """SHA-256 (32 bytes) del prompt normalizado, usado como clave del exact cache."""
+    return hashlib.sha256(normalize_prompt(prompt, steps).encode("utf-8")).digest()
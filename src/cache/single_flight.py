@@ -0,0 +1,144 @@
+import os
+import asyncio
+import threading
+import numpy as np
+from contextlib import contextmanager, asynccontextmanager
+from sqlalchemy import text
+from src.app.db import get_db_session, get_async_db_session
+
+# Agrupa misses concurrentes del mismo prompt en una sola generación
+CACHE_SINGLE_FLIGHT = os.getenv("CACHE_SINGLE_FLIGHT", "true").lower() == "true"
+# Extiende el agrupamiento a otros workers/réplicas con advisory locks de Postgres.
+# El worker que genera mantiene una conexión mientras espera al LLM.
+CACHE_ADVISORY_LOCKS = os.getenv("CACHE_ADVISORY_LOCKS", "false").lower() == "true"
+
+# Primer argumento de pg_advisory_xact_lock(int, int), para no chocar con otros locks
+EXACT_LOCK_NAMESPACE = 7301
+SEMANTIC_LOCK_NAMESPACE = 7302
+
+class _Call:
+    def __init__(self, vector=None):
+        self.vector = vector
+        self.done = threading.Event()
+        self.future = None
+        self.value = None
+        self.error = None
+        # El líder se interrumpió sin resultado (CancelledError, desconexión, timeout)
+        self.abandoned = False
+
+class SingleFlight:
+    """
+    Coalescing de llamadas concurrentes: la primera llamada con una clave ejecuta fn
+    y las demás esperan y comparten su resultado (o su excepción). Si el líder se
+    cancela, las que esperaban vuelven a intentarlo y una de ellas pasa a líder. Con vector y
+    threshold, también se unen llamadas en curso del mismo grupo cuyo embedding está
+    a una distancia <#> menor o igual al threshold.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> [_Call]
+
+    def _join_or_lead(self, key, vector, threshold):
+        with self._lock:
+            calls = self._calls.setdefault(key, [])
+            for call in calls:
+                if vector is None or call.vector is None:
+                    return call, False
+                distance = -float(np.dot(vector, call.vector))
+                if distance <= threshold:
+                    return call, False
+            call = _Call(vector)
+            calls.append(call)
+            return call, True
+
+    def _finish(self, key, call):
+        with self._lock:
+            calls = self._calls.get(key, [])
+            if call in calls:
+                calls.remove(call)
+            if not calls:
+                self._calls.pop(key, None)
+        call.done.set()
+
+    @staticmethod
+    def _fail(call, error: BaseException):
+        # Los errores del propio fn se comparten; una cancelación del líder no debe
+        # cancelar ni dejar sin valor a quienes esperaban
+        if isinstance(error, Exception):
+            call.error = error
+        else:
+            call.abandoned = True
+
+    def do(self, key, fn, vector=None, threshold=None):
+        """Devuelve (value, shared); shared=True si se reutilizó una llamada en curso."""
+        while True:
+            call, leader = self._join_or_lead(key, vector, threshold)
+            if leader:
+                break
+            call.done.wait()
+            if call.abandoned:
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+        try:
+            call.value = fn()
+            return call.value, False
+        except BaseException as e:
+            self._fail(call, e)
+            raise
+        finally:
+            self._finish(key, call)
+
+    async def ado(self, key, fn, vector=None, threshold=None):
+        """Variante async de do: fn es una función async."""
+        while True:
+            call, leader = self._join_or_lead(key, vector, threshold)
+            if leader:
+                break
+            if call.future is not None and call.future.get_loop() is asyncio.get_running_loop():
+                await asyncio.shield(call.future)
+            else:
+                await asyncio.to_thread(call.done.wait)
+            if call.abandoned:
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+        call.future = asyncio.get_running_loop().create_future()
+        try:
+            call.value = await fn()
+            return call.value, False
+        except BaseException as e:
+            self._fail(call, e)
+            raise
+        finally:
+            call.future.set_result(None)
+            self._finish(key, call)
+
+def _lock_key(digest: bytes) -> int:
+    return int.from_bytes(digest[:4], "big", signed=True)
+
+@contextmanager
+def advisory_lock(namespace: int, digest: bytes):
+    """
+    Lock de transacción en Postgres; se libera con el commit o al cerrar la sesión.
+    Devuelve la sesión del lock para que la re-consulta y la escritura no ocupen otra conexión.
+    """
+    session = get_db_session()
+    try:
+        session.execute(text("SELECT pg_advisory_xact_lock(:namespace, :key)"), {"namespace": namespace, "key": _lock_key(digest)})
+        yield session
+    finally:
+        session.rollback()
+        session.close()
+
+@asynccontextmanager
+async def aadvisory_lock(namespace: int, digest: bytes):
+    async with get_async_db_session() as session:
+        try:
+            await session.execute(text("SELECT pg_advisory_xact_lock(:namespace, :key)"), {"namespace": namespace, "key": _lock_key(digest)})
+            yield session
+        finally:
+            await session.rollback()
@@ -0,0 +1,166 @@
+import os
+import threading
+from collections import deque
+import numpy as np
+from sqlalchemy import text
+from loguru import logger
+from src.app.utils import as_vector, normalize_vector
+
+# Para <#> (negative dot product), valores más negativos = mayor similitud
+CACHE_DISTANCE_THRESHOLD = float(os.getenv("CACHE_DISTANCE_THRESHOLD", "-0.95"))
+# Radio por entrada: en zonas densas (vecino cercano con el mismo contexto cuya respuesta es
+# distinta) el radio se reduce a la mitad de la distancia coseno al vecino, nunca por encima
+# del threshold global
+SEMANTIC_CACHE_ENTRY_RADIUS = os.getenv("SEMANTIC_CACHE_ENTRY_RADIUS", "true").lower() == "true"
+# Distancias recientes (hit/miss) que se conservan en memoria para /cache/stats
+THRESHOLD_SAMPLE_SIZE = int(os.getenv("THRESHOLD_SAMPLE_SIZE", "1000"))
+# Dos respuestas se consideran equivalentes con similitud coseno >= este valor (calibración
+# y radio por entrada)
+CALIBRATION_RESPONSE_SIMILARITY = float(os.getenv("CALIBRATION_RESPONSE_SIMILARITY", "0.9"))
+
+def effective_threshold(threshold: float, radius: float = None) -> float:
+    """El radio de una entrada solo puede endurecer el threshold, nunca relajarlo."""
+    return threshold if radius is None else min(threshold, radius)
+
+def entry_radius(neighbor_distance: float, threshold: float):
+    """
+    Radio de una entrada nueva a partir de la distancia <#> a su vecino más cercano:
+    la mitad de la distancia coseno (1 + d). Devuelve None si no es más estricto
+    que el threshold global.
+    """
+    if neighbor_distance is None:
+        return None
+    radius = (neighbor_distance - 1) / 2
+    return radius if radius < threshold else None
+
+def answers_agree(first_vector, second_vector) -> bool:
+    """Compara los embeddings de dos respuestas con CALIBRATION_RESPONSE_SIMILARITY."""
+    return float(np.dot(normalize_vector(first_vector), normalize_vector(second_vector))) >= CALIBRATION_RESPONSE_SIMILARITY
+
+class DistanceRecorder:
+    """Guarda las últimas distancias del candidato más cercano, separadas en hits y misses."""
+
+    def __init__(self, max_samples: int = None):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=max_samples if max_samples is not None else THRESHOLD_SAMPLE_SIZE)
+
+    def record(self, distance: float, hit: bool):
+        if distance is None:
+            return
+        with self._lock:
+            self._samples.append((float(distance), hit))
+
+    def samples(self) -> list:
+        with self._lock:
+            return list(self._samples)
+
+    def stats(self) -> dict:
+        samples = self.samples()
+        hits = sorted(d for d, hit in samples if hit)
+        misses = sorted(d for d, hit in samples if not hit)
+        return {
+            "threshold": CACHE_DISTANCE_THRESHOLD,
+            "samples": len(samples),
+            "hit_p50": _percentile(hits, 0.5),
+            "hit_p95": _percentile(hits, 0.95),
+            "miss_p5": _percentile(misses, 0.05),
+            "miss_p50": _percentile(misses, 0.5),
+        }
+
+_distance_recorder = DistanceRecorder()
+
+def get_distance_recorder() -> DistanceRecorder:
+    return _distance_recorder
+
+def _percentile(values: list, q: float):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def choose_threshold(samples, target_false_hit_rate: float) -> dict:
+    """
+    samples: (distance, correct) del vecino más cercano, donde correct indica si su
+    respuesta habría sido válida. Devuelve el threshold más permisivo cuya tasa de
+    falsos hits (hits incorrectos / hits) no supera target_false_hit_rate.
+    """
+    ordered = sorted(samples)
+    best = {"threshold": None, "hit_rate": 0.0, "false_hit_rate": 0.0, "samples": len(ordered)}
+    hits = 0
+    false_hits = 0
+    for i, (distance, correct) in enumerate(ordered):
+        hits += 1
+        false_hits += 0 if correct else 1
+        # Empates: el threshold incluye todas las muestras con la misma distancia
+        if i + 1 < len(ordered) and ordered[i + 1][0] == distance:
+            continue
+        if false_hits / hits <= target_false_hit_rate:
+            best.update(threshold=distance, hit_rate=hits / len(ordered), false_hit_rate=false_hits / hits)
+    return best
+
+CALIBRATION_LOGS_SQL = text('''
+    SELECT request->>'prompt', response->>'result'
+    FROM query_logs
+    WHERE endpoint = '/rag/query_semantic' AND status_code = 200 AND response->>'cache_status' = 'miss'
+    ORDER BY created_at DESC
+    LIMIT :limit
+''')
+
+# Contexto con el que se generó la respuesta del miss (su propia entrada en semantic_cache)
+CALIBRATION_CONTEXT_SQL = text('''
+    SELECT context_hash
+    FROM semantic_cache
+    WHERE prompt = :prompt
+    ORDER BY created_at DESC
+    LIMIT 1
+''')
+
+# En producción solo pueden dar hit entradas con el mismo context_hash
+CALIBRATION_NEIGHBOR_SQL = text('''
+    SELECT prompt_embedding <#> :query_vector AS distance, response
+    FROM semantic_cache
+    WHERE context_hash = :context_hash AND prompt <> :prompt
+    ORDER BY distance ASC
+    LIMIT 1
+''')
+
+def calibration_samples(session, embeddings, limit: int = 5000) -> list:
+    """
+    Reproduce los misses registrados en query_logs: para cada prompt busca la entrada
+    más cercana de otro prompt con el mismo contexto y compara su respuesta con la que
+    generó el LLM. Se omiten los prompts cuya entrada ya no está en la cache.
+    """
+    rows = [row for row in session.execute(CALIBRATION_LOGS_SQL, {"limit": limit}).fetchall() if row[0] and row[1]]
+    samples = []
+    for prompt, generated in rows:
+        context = session.execute(CALIBRATION_CONTEXT_SQL, {"prompt": prompt}).fetchone()
+        if not context:
+            continue
+        query_vector = normalize_vector(embeddings.embed_query(prompt))
+        neighbor = session.execute(CALIBRATION_NEIGHBOR_SQL, {
+            "query_vector": as_vector(query_vector), "context_hash": context[0], "prompt": prompt
+        }).fetchone()
+        if not neighbor:
+            continue
+        distance, cached = neighbor
+        samples.append((distance, answers_agree(*embeddings.embed_documents([generated, cached]))))
+    return samples
+
+if __name__ == "__main__":
+    import argparse
+    from src.app.db import get_db_session
+    from src.cache.embedding_cache import get_cached_embeddings
+
+    parser = argparse.ArgumentParser(description="Calibra CACHE_DISTANCE_THRESHOLD reproduciendo query_logs")
+    parser.add_argument("--target-false-hit-rate", type=float, default=0.01)
+    parser.add_argument("--limit", type=int, default=5000, help="Misses de query_logs a reproducir")
+    args = parser.parse_args()
+
+    session = get_db_session()
+    try:
+        embeddings = get_cached_embeddings(os.getenv("EMBEDDING_MODEL", "models/embedding-001"))
+        result = choose_threshold(calibration_samples(session, embeddings, args.limit), args.target_false_hit_rate)
+    finally:
+        session.close()
+    logger.info(f"Calibración: {result}")
+    if result["threshold"] is not None:
+        print(f"CACHE_DISTANCE_THRESHOLD={result['threshold']:.4f}")
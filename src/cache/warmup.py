@@ -0,0 +1,204 @@
+import os
+import threading
+import numpy as np
+from sqlalchemy import text
+from loguru import logger
+from src.app.db import get_engine, get_db_session
+from src.app.metrics import record_llm_usage
+from src.app.utils import normalize_vector
+from src.cache.thresholds import CACHE_DISTANCE_THRESHOLD
+
+# Precalentado de exact_cache / semantic_cache con los prompts más frecuentes y recientes de query_logs
+CACHE_WARMUP_ON_STARTUP = os.getenv("CACHE_WARMUP_ON_STARTUP", "false").lower() == "true"
+# Presupuesto: prompts distintos (tras agrupar paráfrasis) que se precalientan como máximo
+CACHE_WARMUP_MAX_PROMPTS = int(os.getenv("CACHE_WARMUP_MAX_PROMPTS", "200"))
+CACHE_WARMUP_CONCURRENCY = int(os.getenv("CACHE_WARMUP_CONCURRENCY", "4"))
+CACHE_WARMUP_LOOKBACK_HOURS = float(os.getenv("CACHE_WARMUP_LOOKBACK_HOURS", "168"))
+# Peso de cada aparición: 2^(-antigüedad / vida media), así pesan más los prompts recientes
+CACHE_WARMUP_HALF_LIFE_HOURS = float(os.getenv("CACHE_WARMUP_HALF_LIFE_HOURS", "24"))
+CACHE_WARMUP_MIN_COUNT = int(os.getenv("CACHE_WARMUP_MIN_COUNT", "2"))
+# Prompts por llamada a Retriever.query_many
+CACHE_WARMUP_BATCH_SIZE = int(os.getenv("CACHE_WARMUP_BATCH_SIZE", "50"))
+
+# pg_try_advisory_lock(int, int): un solo warm-up a la vez entre workers y réplicas
+# (los namespaces 7301 y 7302 son los del single-flight)
+WARMUP_LOCK_NAMESPACE = 7303
+WARMUP_LOCK_KEY = 0
+
+WARMUP_LOCK_SQL = text("SELECT pg_try_advisory_lock(:namespace, :key)")
+WARMUP_UNLOCK_SQL = text("SELECT pg_advisory_unlock(:namespace, :key)")
+WARMUP_LOCK_PARAMS = {"namespace": WARMUP_LOCK_NAMESPACE, "key": WARMUP_LOCK_KEY}
+
+# Incluye las variantes SSE; endpoint se normaliza a exact / semantic
+WARMUP_CANDIDATES_SQL = text('''
+    SELECT CASE WHEN endpoint LIKE '/rag/query_exact%' THEN 'exact' ELSE 'semantic' END AS cache,
+           request->>'prompt' AS prompt,
+           count(*) AS requests,
+           sum(power(2, GREATEST(-EXTRACT(EPOCH FROM (LOCALTIMESTAMP - created_at)) / :half_life_seconds, -60))) AS score
+    FROM query_logs
+    WHERE endpoint IN ('/rag/query_exact', '/rag/query_exact/stream', '/rag/query_semantic', '/rag/query_semantic/stream')
+      AND status_code = 200
+      AND request->>'prompt' IS NOT NULL
+      AND created_at >= LOCALTIMESTAMP - make_interval(secs => :lookback_seconds)
+    GROUP BY 1, 2
+    HAVING count(*) >= :min_count
+    ORDER BY score DESC
+    LIMIT :limit
+''')
+
+def mine_prompts(session, limit: int, min_count: int = None, lookback_hours: float = None, half_life_hours: float = None) -> list:
+    """Devuelve [(cache, prompt, requests, score)] ordenado por score (frecuencia ponderada por recencia)."""
+    rows = session.execute(WARMUP_CANDIDATES_SQL, {
+        "half_life_seconds": (half_life_hours if half_life_hours is not None else CACHE_WARMUP_HALF_LIFE_HOURS) * 3600,
+        "lookback_seconds": (lookback_hours if lookback_hours is not None else CACHE_WARMUP_LOOKBACK_HOURS) * 3600,
+        "min_count": min_count if min_count is not None else CACHE_WARMUP_MIN_COUNT,
+        "limit": limit,
+    }).fetchall()
+    return [(cache, prompt, int(requests), float(score)) for cache, prompt, requests, score in rows]
+
+def group_exact(candidates: list, key) -> list:
+    """Agrupa los prompts con la misma clave normalizada del exact cache; devuelve [(prompt, score)]."""
+    groups = {}
+    for prompt, score in candidates:
+        digest = key(prompt)
+        if digest in groups:
+            groups[digest][1] += score
+        else:
+            groups[digest] = [prompt, score]
+    return sorted((tuple(group) for group in groups.values()), key=lambda group: -group[1])
+
+def cluster_paraphrases(candidates: list, vectors: list, threshold: float = None) -> list:
+    """
+    Agrupa paráfrasis: recorriendo los candidatos por score, un prompt se une al grupo
+    más cercano si su representante daría hit en el semantic cache (distancia <#> <= threshold).
+    Devuelve [(representante, score acumulado, tamaño)] ordenado por score.
+    """
+    th = threshold if threshold is not None else CACHE_DISTANCE_THRESHOLD
+    order = sorted(range(len(candidates)), key=lambda i: -candidates[i][1])
+    matrix = np.asarray([normalize_vector(v) for v in vectors], dtype=np.float32)
+    leaders = []
+    clusters = []
+    for i in order:
+        if leaders:
+            distances = -(matrix[leaders] @ matrix[i])
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= th:
+                clusters[nearest][1] += candidates[i][1]
+                clusters[nearest][2] += 1
+                continue
+        leaders.append(i)
+        clusters.append([candidates[i][0], candidates[i][1], 1])
+    return sorted((tuple(cluster) for cluster in clusters), key=lambda cluster: -cluster[1])
+
+def select_within_budget(exact_groups: list, semantic_clusters: list, max_prompts: int) -> tuple:
+    """Reparte el presupuesto entre ambas caches por score; devuelve (prompts exact, prompts semantic)."""
+    ranked = [("exact", prompt, score) for prompt, score in exact_groups]
+    ranked += [("semantic", prompt, score) for prompt, score, _ in semantic_clusters]
+    ranked.sort(key=lambda item: -item[2])
+    selected = ranked[:max_prompts]
+    return (
+        [prompt for cache, prompt, _ in selected if cache == "exact"],
+        [prompt for cache, prompt, _ in selected if cache == "semantic"],
+    )
+
+def warm_exact(exact_cache, llm, prompts: list, max_concurrency: int) -> dict:
+    """
+    Genera solo los prompts que no están ya en exact_cache; get() también llena la L1.
+    Un prompt que falla se cuenta en failed sin interrumpir el resto.
+    """
+    missing = [prompt for prompt in prompts if exact_cache.get(prompt) is None]
+    failed = 0
+    if missing:
+        messages = [[("human", prompt)] for prompt in missing]
+        responses = llm.batch(messages, config={"max_concurrency": max_concurrency}, return_exceptions=True)
+        for prompt, message_list, response in zip(missing, messages, responses):
+            if isinstance(response, Exception):
+                logger.warning(f"Warm-up: error generando '{prompt[:30]}...': {response}")
+                failed += 1
+                continue
+            record_llm_usage(message_list, response.content, getattr(response, "usage_metadata", None))
+            exact_cache.set(prompt, response.content)
+    return {
+        "prompts": len(prompts), "cached": len(prompts) - len(missing),
+        "generated": len(missing) - failed, "failed": failed,
+    }
+
+def warm_semantic(retriever, prompts: list, max_concurrency: int, batch_size: int = None) -> dict:
+    """Reutiliza Retriever.query_many: solo los misses llaman al LLM y se guardan en semantic_cache."""
+    batch_size = batch_size or CACHE_WARMUP_BATCH_SIZE
+    statuses = {}
+    for start in range(0, len(prompts), batch_size):
+        results, _ = retriever.query_many(prompts[start:start + batch_size], max_concurrency=max_concurrency)
+        for _, cache_status, _ in results:
+            statuses[cache_status] = statuses.get(cache_status, 0) + 1
+    return {"prompts": len(prompts), **statuses}
+
+def warm_up(retriever, exact_cache, max_prompts: int = None, max_concurrency: int = None, **mining) -> dict:
+    """
+    Mina query_logs, agrupa prompts equivalentes y precalienta ambas caches dentro del
+    presupuesto de max_prompts, con hasta max_concurrency llamadas simultáneas al LLM.
+    """
+    max_prompts = max_prompts if max_prompts is not None else CACHE_WARMUP_MAX_PROMPTS
+    max_concurrency = max_concurrency or CACHE_WARMUP_CONCURRENCY
+    # Lock de sesión en una conexión propia (una Session la devolvería al pool en cada commit)
+    with get_engine().connect() as lock_connection:
+        if not lock_connection.execute(WARMUP_LOCK_SQL, WARMUP_LOCK_PARAMS).scalar():
+            lock_connection.rollback()
+            logger.info("Warm-up de caches omitido: otro worker o réplica lo está ejecutando")
+            return {"skipped": True}
+        lock_connection.commit()
+        try:
+            session = get_db_session()
+            try:
+                # Se minan más candidatos que el presupuesto: las paráfrasis se agrupan después
+                candidates = mine_prompts(session, limit=max_prompts * 5, **mining)
+            finally:
+                session.close()
+            return _warm_candidates(retriever, exact_cache, candidates, max_prompts, max_concurrency)
+        finally:
+            lock_connection.execute(WARMUP_UNLOCK_SQL, WARMUP_LOCK_PARAMS)
+            lock_connection.commit()
+
+def _warm_candidates(retriever, exact_cache, candidates: list, max_prompts: int, max_concurrency: int) -> dict:
+    exact_candidates = [(prompt, score) for cache, prompt, _, score in candidates if cache == "exact"]
+    semantic_candidates = [(prompt, score) for cache, prompt, _, score in candidates if cache == "semantic"]
+    exact_groups = group_exact(exact_candidates, exact_cache.key)
+    semantic_clusters = []
+    if semantic_candidates:
+        vectors = retriever.embeddings.embed_queries([prompt for prompt, _ in semantic_candidates])
+        semantic_clusters = cluster_paraphrases(semantic_candidates, vectors)
+    exact_prompts, semantic_prompts = select_within_budget(exact_groups, semantic_clusters, max_prompts)
+    report = {
+        "candidates": len(candidates),
+        "exact": warm_exact(exact_cache, retriever.llm, exact_prompts, max_concurrency),
+        "semantic": warm_semantic(retriever, semantic_prompts, max_concurrency),
+    }
+    logger.info(f"Warm-up de caches: {report}")
+    return report
+
+def start_background_warmup(retriever, exact_cache) -> threading.Thread:
+    """Hook de arranque: el warm-up corre en un hilo para no retrasar el inicio del servidor."""
+    def run():
+        try:
+            warm_up(retriever, exact_cache)
+        except Exception as e:
+            logger.error(f"Error en el warm-up de caches: {e}")
+
+    thread = threading.Thread(target=run, name="cache-warmup", daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == "__main__":
+    import argparse
+    from src.app.dependencies import get_retriever, get_exact_cache
+
+    parser = argparse.ArgumentParser(description="Precalienta exact_cache y semantic_cache a partir de query_logs")
+    parser.add_argument("--max-prompts", type=int, default=CACHE_WARMUP_MAX_PROMPTS)
+    parser.add_argument("--concurrency", type=int, default=CACHE_WARMUP_CONCURRENCY)
+    parser.add_argument("--lookback-hours", type=float, default=CACHE_WARMUP_LOOKBACK_HOURS)
+    parser.add_argument("--min-count", type=int, default=CACHE_WARMUP_MIN_COUNT)
+    args = parser.parse_args()
+    print(warm_up(
+        get_retriever(), get_exact_cache(), max_prompts=args.max_prompts, max_concurrency=args.concurrency,
+        lookback_hours=args.lookback_hours, min_count=args.min_count,
+    ))
@@ -0,0 +1,78 @@
+import os
+import re
+import hashlib
+
+# sentence: agrupa frases completas hasta CHUNK_SIZE palabras
+# token: ventanas de CHUNK_SIZE palabras (aproximación a tokens, sin tokenizer)
+# none: un chunk por documento
+CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "sentence").lower()
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "200"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "40"))
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+def content_digest(content: str) -> bytes:
+    """SHA-256 del texto; clave de deduplicación de documents (content_hash, parent_id)."""
+    return hashlib.sha256(content.encode("utf-8")).digest()
+
+def chunk_text(content: str, size: int = None, overlap: int = None, strategy: str = None) -> list:
+    """
+    Divide un documento en chunks de como máximo size palabras. Los chunks consecutivos
+    comparten hasta overlap palabras para no perder el contexto en los cortes.
+    """
+    size = size or CHUNK_SIZE
+    overlap = CHUNK_OVERLAP if overlap is None else overlap
+    strategy = strategy or CHUNK_STRATEGY
+    if overlap >= size:
+        raise ValueError(f"CHUNK_OVERLAP ({overlap}) debe ser menor que CHUNK_SIZE ({size})")
+    content = content.strip()
+    if not content:
+        return []
+    if strategy == "none":
+        return [content]
+    if strategy == "token":
+        return _window(content.split(), size, overlap)
+    if strategy == "sentence":
+        return _pack_sentences(content, size, overlap)
+    raise ValueError(f"CHUNK_STRATEGY no soportado: {strategy}")
+
+def _window(words: list, size: int, overlap: int) -> list:
+    chunks = []
+    step = size - overlap
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + size]))
+        if start + size >= len(words):
+            break
+    return chunks
+
+def _pack_sentences(content: str, size: int, overlap: int) -> list:
+    chunks = []
+    current = []  # lista de frases, cada una como lista de palabras
+    current_words = 0
+    for sentence in _SENTENCE_END.split(content):
+        words = sentence.split()
+        if not words:
+            continue
+        if len(words) > size:
+            # Una frase más larga que el chunk se corta por palabras
+            if current:
+                chunks.append(" ".join(w for s in current for w in s))
+                current, current_words = [], 0
+            chunks.extend(_window(words, size, overlap))
+            continue
+        if current_words + len(words) > size and current:
+            chunks.append(" ".join(w for s in current for w in s))
+            # Se arrastran las últimas frases que caben en el solapamiento
+            carried = []
+            carried_words = 0
+            for previous in reversed(current):
+                if carried_words + len(previous) > overlap or carried_words + len(previous) + len(words) > size:
+                    break
+                carried.insert(0, previous)
+                carried_words += len(previous)
+            current, current_words = carried, carried_words
+        current.append(words)
+        current_words += len(words)
+    if current:
+        chunks.append(" ".join(w for s in current for w in s))
+    return chunks
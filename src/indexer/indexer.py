@@ -1,38 +1,394 @@
 import os
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from sqlalchemy import text
+from loguru import logger
 from src.app.db import get_db_session
-from dotenv import load_dotenv
+from src.app.db.vector_index import HNSW_EF_SEARCH
+from src.app.metrics import record_stale_scans
+from src.app.utils import as_vector, normalize_vector
+from src.cache.embedding_cache import get_cached_embeddings
+from src.indexer.chunking import chunk_text, content_digest
 
-load_dotenv(os.path.join(os.path.dirname(__file__), '../../config/.env'))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "models/embedding-001")
+# Documentos por lote de embedding + INSERT + commit en la ingesta en streaming
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "64"))
+# Lotes cuyo embedding se calcula en paralelo (llamadas concurrentes a la API)
+INDEX_EMBED_CONCURRENCY = int(os.getenv("INDEX_EMBED_CONCURRENCY", "4"))
+# Entradas del semantic cache (vecinas más cercanas) que se comprueban por cada documento nuevo
+STALE_SCAN_CANDIDATES = int(os.getenv("STALE_SCAN_CANDIDATES", "100"))
 
-EMBEDDING_MODEL = "models/embedding-001"
+BUMP_CORPUS_VERSION_SQL = text("UPDATE corpus_state SET version = version + 1, updated_at = CURRENT_TIMESTAMP")
+EXISTING_HASHES_SQL = text("SELECT content_hash FROM documents WHERE content_hash = ANY(:hashes)")
+
+# Invalidación incremental del semantic cache. Un documento nuevo solo afecta a las entradas
+# en cuyo top-K habría entrado (más cercano al prompt que el K-ésimo documento guardado).
+# Por cada documento nuevo se buscan con el índice HNSW las STALE_SCAN_CANDIDATES entradas
+# más cercanas y solo entre ellas se compara con kth_distance, en vez de recorrer toda la cache.
+# Las entradas sin kth_distance (menos de K documentos) las invalida cualquier documento nuevo.
+# La búsqueda solo es concluyente si devolvió todos los candidatos y el más lejano ya está más
+# allá del mayor kth_distance de la cache (ninguna entrada más lejana puede verse afectada).
+# Devuelve los documentos para los que no lo es; esos pasan por STALE_BY_NEW_DOCUMENTS_EXACT_SQL.
+STALE_BY_NEW_DOCUMENTS_SQL = text('''
+    WITH bound AS (
+        SELECT max(kth_distance) AS max_kth FROM semantic_cache WHERE NOT stale
+    ),
+    nearest AS (
+        SELECT d.id AS document_id, c.id, c.kth_distance, c.distance,
+               count(c.id) OVER w AS scanned_rows, max(c.distance) OVER w AS farthest
+        FROM documents d
+        LEFT JOIN LATERAL (
+            SELECT id, kth_distance, prompt_embedding <#> d.embedding AS distance
+            FROM semantic_cache
+            ORDER BY prompt_embedding <#> d.embedding ASC
+            LIMIT :candidates
+        ) c ON true
+        WHERE d.id = ANY(:document_ids)
+        WINDOW w AS (PARTITION BY d.id)
+    ),
+    marked AS (
+        UPDATE semantic_cache
+        SET stale = true
+        WHERE NOT stale AND id IN (
+            SELECT id FROM nearest WHERE distance < kth_distance
+            UNION ALL
+            SELECT id FROM semantic_cache WHERE kth_distance IS NULL AND NOT stale
+        )
+    )
+    SELECT DISTINCT n.document_id
+    FROM nearest n, bound b
+    WHERE n.scanned_rows < :candidates OR n.farthest < b.max_kth
+''')
+# Comprobación exacta (recorre la cache) para los documentos en que la búsqueda ANN no fue concluyente
+STALE_BY_NEW_DOCUMENTS_EXACT_SQL = text('''
+    UPDATE semantic_cache c
+    SET stale = true
+    FROM documents d
+    WHERE d.id = ANY(:document_ids) AND NOT c.stale
+      AND c.prompt_embedding <#> d.embedding < c.kth_distance
+''')
+# Un documento actualizado o borrado afecta a las entradas que lo usaron (búsqueda inversa, índice GIN)
+STALE_BY_REMOVED_DOCUMENTS_SQL = text('''
+    UPDATE semantic_cache
+    SET stale = true
+    WHERE NOT stale AND document_ids && CAST(:document_ids AS INT[])
+''')
+DELETE_DOCUMENTS_SQL = text("DELETE FROM documents WHERE id = ANY(:document_ids) RETURNING id")
+
+# Linaje: una fila por (documento original, posición), también para los chunks que ya existían
+INSERT_LINEAGE_SQL = text('''
+    INSERT INTO document_parents (parent_id, chunk_index, document_id)
+    SELECT v.parent_id, v.chunk_index, d.id
+    FROM unnest(CAST(:parent_ids AS BYTEA[]), CAST(:chunk_indexes AS INT[]), CAST(:hashes AS BYTEA[]))
+         AS v(parent_id, chunk_index, content_hash)
+    JOIN documents d ON d.content_hash = v.content_hash
+    ON CONFLICT (parent_id, chunk_index) DO NOTHING
+''')
+# Quita el linaje de un documento original; orphan indica si el chunk ya no pertenece a ningún otro
+DELETE_PARENT_SQL = text('''
+    WITH removed AS (
+        DELETE FROM document_parents WHERE parent_id = :parent_id RETURNING document_id
+    )
+    SELECT DISTINCT r.document_id, NOT EXISTS (
+        SELECT 1 FROM document_parents p WHERE p.document_id = r.document_id AND p.parent_id <> :parent_id
+    ) AS orphan
+    FROM removed r
+''')
+
+def iter_documents_file(fileobj, encoding: str = "utf-8"):
+    """
+    Lee documentos línea a línea de un fichero binario: JSONL con
+    {"content": ..., "metadata": {...}} o texto plano (un documento por línea).
+    """
+    for raw_line in fileobj:
+        line = raw_line.decode(encoding).strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            try:
+                item = json.loads(line)
+                yield item["content"], item.get("metadata")
+                continue
+            except (ValueError, KeyError):
+                pass
+        yield line, None
 
 class Indexer:
     def __init__(self):
-        self.embeddings = GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL)
+        self.embeddings = get_cached_embeddings(EMBEDDING_MODEL)
 
     def index_documents(self, documents, metadata=None):
+        """
+        Divide los documentos en chunks y guarda solo los que no existen todavía
+        (deduplicados por content_hash). Devuelve (indexed, deduplicated): chunks
+        insertados y chunks que ya existían, repetidos o insertados a la vez por otro proceso.
+        """
         session = get_db_session()
         try:
-            vectors = self.embeddings.embed_documents(documents)
-            for i, doc in enumerate(documents):
-                meta = metadata[i] if metadata and i < len(metadata) else None
-                session.execute(
-                    text("""
-                        INSERT INTO documents (content, embedding, metadata)
-                        VALUES (:content, :embedding, :metadata)
-                    """),
-                    {
-                        "content": doc,
-                        "embedding": vectors[i],
-                        "metadata": meta
-                    }
-                )
+            metas = [metadata[i] if metadata and i < len(metadata) else None for i in range(len(documents))]
+            rows, lineage = self._new_chunks(session, list(zip(documents, metas)))
+            indexed = self._embed_and_insert(session, rows, lineage)
             session.commit()
-            return len(documents)
+            return indexed, len(lineage) - indexed
         except Exception as e:
             session.rollback()
             raise e
         finally:
-            session.close() 
\ No newline at end of file
+            session.close()
+
+    def delete_documents(self, document_ids: list) -> int:
+        """
+        Borra chunks por id y marca como stale solo las entradas del semantic cache
+        construidas con ellos. Devuelve el número de chunks borrados.
+        """
+        session = get_db_session()
+        try:
+            deleted = self._delete_chunks(session, document_ids)
+            if deleted:
+                session.execute(BUMP_CORPUS_VERSION_SQL)
+            session.commit()
+            return deleted
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def delete_parent(self, parent_id: bytes):
+        """
+        Quita un documento original: borra solo los chunks que no comparte con otro documento
+        (y marca como stale las entradas que los usaron). Devuelve el número de chunks
+        borrados, o None si no hay ningún chunk con ese parent_id.
+        """
+        session = get_db_session()
+        try:
+            rows = session.execute(DELETE_PARENT_SQL, {"parent_id": parent_id}).fetchall()
+            if not rows:
+                session.rollback()
+                return None
+            deleted = self._delete_chunks(session, [document_id for document_id, orphan in rows if orphan])
+            if deleted:
+                session.execute(BUMP_CORPUS_VERSION_SQL)
+            session.commit()
+            return deleted
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def update_document(self, document_id: int, content: str, metadata=None):
+        """
+        Sustituye un chunk por el texto nuevo (que se vuelve a trocear) en una sola
+        transacción. Devuelve (indexed, deduplicated) como index_documents, o None si el id no existe.
+        """
+        session = get_db_session()
+        try:
+            if not self._delete_chunks(session, [document_id]):
+                session.rollback()
+                return None
+            rows, lineage = self._new_chunks(session, [(content, metadata)])
+            indexed = self._embed_and_insert(session, rows, lineage, bump=False)
+            session.execute(BUMP_CORPUS_VERSION_SQL)
+            session.commit()
+            return indexed, len(lineage) - indexed
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _embed_and_insert(self, session, rows, lineage, bump: bool = True) -> int:
+        """Devuelve el número de chunks insertados (sin los que ON CONFLICT descartó)."""
+        document_ids = []
+        if rows:
+            # Se guardan normalizados para que <#> equivalga a similitud coseno
+            vectors = [normalize_vector(v) for v in self.embeddings.embed_documents([row[0] for row in rows])]
+            document_ids = self._insert_chunks(session, rows, vectors)
+            self._invalidate_for_new(session, document_ids)
+            if bump:
+                # Nueva versión del corpus en la misma transacción que los documentos
+                session.execute(BUMP_CORPUS_VERSION_SQL)
+        self._record_lineage(session, lineage)
+        return len(document_ids)
+
+    def _record_lineage(self, session, lineage: list):
+        if lineage:
+            session.execute(INSERT_LINEAGE_SQL, {
+                "parent_ids": [parent_id for parent_id, _, _ in lineage],
+                "chunk_indexes": [chunk_index for _, chunk_index, _ in lineage],
+                "hashes": [digest for _, _, digest in lineage],
+            })
+
+    def _delete_chunks(self, session, document_ids: list) -> int:
+        if not document_ids:
+            return 0
+        session.execute(STALE_BY_REMOVED_DOCUMENTS_SQL, {"document_ids": list(document_ids)})
+        deleted = len(session.execute(DELETE_DOCUMENTS_SQL, {"document_ids": list(document_ids)}).fetchall())
+        logger.info(f"{deleted} chunks borrados")
+        return deleted
+
+    def _invalidate_for_new(self, session, document_ids: list):
+        if document_ids:
+            # hnsw.ef_search limita las filas que devuelve el índice: al menos tantas como candidatos
+            session.execute(
+                text("SELECT set_config('hnsw.ef_search', :ef_search, true)"),
+                {"ef_search": str(max(HNSW_EF_SEARCH, STALE_SCAN_CANDIDATES))}
+            )
+            unresolved = [row[0] for row in session.execute(
+                STALE_BY_NEW_DOCUMENTS_SQL, {"document_ids": document_ids, "candidates": STALE_SCAN_CANDIDATES}
+            ).fetchall()]
+            record_stale_scans(len(document_ids) - len(unresolved), len(unresolved))
+            if unresolved:
+                logger.info(f"{len(unresolved)} chunks nuevos sin cota en la búsqueda ANN; comprobación exacta del semantic cache")
+                session.execute(STALE_BY_NEW_DOCUMENTS_EXACT_SQL, {"document_ids": unresolved})
+
+    def index_stream(self, documents, job_id: str = None, batch_size: int = None, max_concurrency: int = None):
+        """
+        Indexa un iterable de documentos (str o (str, metadata)) sin cargarlo entero en memoria.
+        Se embeben hasta max_concurrency lotes en paralelo y cada lote se inserta y confirma
+        por separado. Con job_id se guarda el progreso en index_checkpoints: si la ingesta
+        falla, repetirla con el mismo job_id salta los documentos ya confirmados.
+        Devuelve (indexed, deduplicated) de esta ejecución, como index_documents.
+        """
+        batch_size = batch_size or INDEX_BATCH_SIZE
+        max_concurrency = max_concurrency or INDEX_EMBED_CONCURRENCY
+        processed = self._load_checkpoint(job_id) if job_id else 0
+        if processed:
+            logger.info(f"Reanudando ingesta {job_id} desde el documento {processed}")
+        batches = self._batches(islice(iter(documents), processed, None), batch_size)
+
+        indexed = deduplicated = 0
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            for batch in batches:
+                in_flight.append((batch, executor.submit(self._embed_batch, batch)))
+                # Como máximo max_concurrency lotes embebiéndose; se escriben en orden
+                while len(in_flight) >= max_concurrency:
+                    done_batch, future = in_flight.popleft()
+                    processed, written, skipped = self._write_batch(job_id, processed, done_batch, future)
+                    indexed += written
+                    deduplicated += skipped
+            while in_flight:
+                done_batch, future = in_flight.popleft()
+                processed, written, skipped = self._write_batch(job_id, processed, done_batch, future)
+                indexed += written
+                deduplicated += skipped
+        return indexed, deduplicated
+
+    def _embed_batch(self, batch):
+        """Devuelve (rows, vectors, lineage) con los chunks del lote que aún no están en documents."""
+        session = get_db_session()
+        try:
+            rows, lineage = self._new_chunks(session, batch)
+        finally:
+            session.close()
+        if not rows:
+            return rows, [], lineage
+        return rows, [normalize_vector(v) for v in self.embeddings.embed_documents([row[0] for row in rows])], lineage
+
+    def _write_batch(self, job_id, processed, batch, future):
+        rows, vectors, lineage = future.result()
+        session = get_db_session()
+        try:
+            document_ids = []
+            if rows:
+                document_ids = self._insert_chunks(session, rows, vectors)
+                self._invalidate_for_new(session, document_ids)
+                session.execute(BUMP_CORPUS_VERSION_SQL)
+            self._record_lineage(session, lineage)
+            processed += len(batch)
+            if job_id:
+                # El checkpoint se confirma en la misma transacción que el lote
+                session.execute(text('''
+                    INSERT INTO index_checkpoints (job_id, processed, updated_at)
+                    VALUES (:job_id, :processed, CURRENT_TIMESTAMP)
+                    ON CONFLICT (job_id) DO UPDATE
+                    SET processed = EXCLUDED.processed, updated_at = EXCLUDED.updated_at
+                '''), {"job_id": job_id, "processed": processed})
+            session.commit()
+            written, skipped = len(document_ids), len(lineage) - len(document_ids)
+            logger.info(f"Lote de {len(batch)} documentos indexado: {written} chunks nuevos, {skipped} deduplicados (total {processed})")
+            return processed, written, skipped
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _new_chunks(self, session, documents):
+        """
+        Trocea (content, metadata) en filas (chunk, metadata, parent_id, chunk_index, content_hash)
+        y descarta los chunks repetidos o ya guardados, para no volver a embeberlos.
+        Devuelve (rows, lineage); lineage tiene (parent_id, chunk_index, content_hash) de todos
+        los chunks, también de los descartados, para document_parents.
+        """
+        rows = []
+        lineage = []
+        seen = set()
+        for content, meta in documents:
+            parent_id = content_digest(content)
+            for chunk_index, chunk in enumerate(chunk_text(content)):
+                digest = content_digest(chunk)
+                lineage.append((parent_id, chunk_index, digest))
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                rows.append((chunk, meta, parent_id, chunk_index, digest))
+        if not rows:
+            return rows, lineage
+        existing = {
+            bytes(row[0]) for row in
+            session.execute(EXISTING_HASHES_SQL, {"hashes": [row[4] for row in rows]}).fetchall()
+        }
+        if existing:
+            logger.info(f"{len(existing)} chunks ya indexados; se omiten")
+        return [row for row in rows if row[4] not in existing], lineage
+
+    def _insert_chunks(self, session, rows, vectors):
+        """
+        Inserta los chunks con un solo INSERT multi-fila; los duplicados concurrentes se
+        ignoran. Devuelve los ids de las filas insertadas.
+        """
+        values = []
+        params = {}
+        for i, ((content, meta, parent_id, chunk_index, digest), vector) in enumerate(zip(rows, vectors)):
+            values.append(f"(:content_{i}, :embedding_{i}, :metadata_{i}, :hash_{i}, :parent_{i}, :chunk_{i})")
+            params[f"content_{i}"] = content
+            params[f"embedding_{i}"] = as_vector(vector)
+            params[f"metadata_{i}"] = json.dumps(meta) if meta is not None else None
+            params[f"hash_{i}"] = digest
+            params[f"parent_{i}"] = parent_id
+            params[f"chunk_{i}"] = chunk_index
+        result = session.execute(
+            text(f'''
+                INSERT INTO documents (content, embedding, metadata, content_hash, parent_id, chunk_index)
+                VALUES {", ".join(values)}
+                ON CONFLICT (content_hash) DO NOTHING
+                RETURNING id
+            '''),
+            params
+        )
+        return [row[0] for row in result.fetchall()]
+
+    def _load_checkpoint(self, job_id: str) -> int:
+        session = get_db_session()
+        try:
+            row = session.execute(
+                text("SELECT processed FROM index_checkpoints WHERE job_id = :job_id"), {"job_id": job_id}
+            ).fetchone()
+            return row[0] if row else 0
+        finally:
+            session.close()
+
+    def _batches(self, documents, batch_size: int):
+        batch = []
+        for doc in documents:
+            batch.append(doc if isinstance(doc, tuple) else (doc, None))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
@@ -1,77 +1,434 @@
 import os
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
 from sqlalchemy import text
-from src.app.db import get_db_session
-from dotenv import load_dotenv
+from src.app.db import get_db_session, get_async_db_session, reuse_session, areuse_session
 from loguru import logger
-import json
-import time
 import hashlib
 from src.cache.cache_manager import SemanticCacheManager
-from src.app.utils import to_pgvector_str
-
-load_dotenv(os.path.join(os.path.dirname(__file__), '../../config/.env'))
+from src.cache.thresholds import CACHE_DISTANCE_THRESHOLD
+from src.cache.embedding_cache import get_cached_embeddings
+from src.app.utils import as_vector, normalize_vector
+from src.app.db.vector_index import apply_search_params, aapply_search_params
+from src.app.timing import StageTimer
+from src.app.streaming import llm_chunks
+from src.app.metrics import record_llm_usage
 
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "models/embedding-001")
 LLM_MODEL = os.getenv("LLM_MODEL", "gemini-2.5-flash")
 TOP_K = 4
-CACHE_DISTANCE_THRESHOLD = float(os.getenv("CACHE_DISTANCE_THRESHOLD", "-0.95"))
+# context_first: busca documentos y filtra la cache por context_hash (por defecto)
+# cache_first: consulta la cache (entradas no stale) y busca documentos solo si hay miss
+SEMANTIC_CACHE_PIPELINE = os.getenv("SEMANTIC_CACHE_PIPELINE", "context_first")
+# /rag/query_batch: prompts por petición y llamadas simultáneas al LLM para los misses
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "100"))
+QUERY_BATCH_LLM_CONCURRENCY = int(os.getenv("QUERY_BATCH_LLM_CONCURRENCY", "8"))
+
+DOCUMENT_SEARCH_SQL = text(f'''
+    SELECT content, id, embedding <#> :query_vector AS distance
+    FROM documents
+    ORDER BY distance ASC
+    LIMIT {TOP_K}
+''')
+
+# Versiones por lotes (query_many): un solo round-trip para todos los prompts. Cada vector
+# del array hace su búsqueda top-K (LATERAL, usa el índice) y su consulta a la cache. El
+# contexto y su hash se calculan en SQL igual que en _get_context_from_documents/_hash_context,
+# junto con los ids de los documentos y la distancia del K-ésimo (ver _sources).
+_BATCH_DOCUMENTS_LATERAL = f'''
+    SELECT COALESCE(string_agg(content, E'\\n\\n' ORDER BY distance), '') AS context,
+           COALESCE(array_agg(id ORDER BY distance), '{{{{}}}}') AS document_ids,
+           CASE WHEN count(*) = {TOP_K} THEN max(distance) END AS kth_distance
+    FROM (
+        SELECT content, id, embedding <#> q.query_vector AS distance
+        FROM documents
+        WHERE {{condition}}
+        ORDER BY distance ASC
+        LIMIT {TOP_K}
+    ) top_k
+'''
+
+BATCH_PROBE_SQL = text(f'''
+    WITH q AS (
+        SELECT query_vector, ord
+        FROM unnest(CAST(:query_vectors AS vector[])) WITH ORDINALITY AS v(query_vector, ord)
+    ),
+    ctx AS (
+        SELECT q.ord, q.query_vector, d.context, encode(sha256(convert_to(d.context, 'UTF8')), 'hex') AS context_hash,
+               d.document_ids, d.kth_distance
+        FROM q
+        CROSS JOIN LATERAL ({_BATCH_DOCUMENTS_LATERAL.format(condition="true")}) d
+    )
+    SELECT ctx.ord, ctx.context, ctx.context_hash, c.response, c.distance, c.id, c.radius, ctx.document_ids, ctx.kth_distance
+    FROM ctx
+    LEFT JOIN LATERAL (
+        SELECT response, prompt_embedding <#> ctx.query_vector AS distance, id, radius
+        FROM semantic_cache
+        WHERE context_hash = ctx.context_hash
+        ORDER BY distance ASC
+        LIMIT 1
+    ) c ON true
+    ORDER BY ctx.ord
+''')
+
+# cache_first: la búsqueda de documentos solo se ejecuta para los prompts sin hit (filtro
+# que Postgres evalúa una vez por prompt, antes de recorrer el índice)
+BATCH_PROBE_BY_CORPUS_VERSION_SQL = text(f'''
+    WITH q AS (
+        SELECT query_vector, ord
+        FROM unnest(CAST(:query_vectors AS vector[])) WITH ORDINALITY AS v(query_vector, ord)
+    )
+    SELECT q.ord, s.version, c.response, c.distance, c.id, c.radius, d.context, d.document_ids, d.kth_distance
+    FROM q
+    CROSS JOIN corpus_state s
+    LEFT JOIN LATERAL (
+        SELECT response, prompt_embedding <#> q.query_vector AS distance, id, radius
+        FROM semantic_cache
+        WHERE NOT stale
+        ORDER BY distance ASC
+        LIMIT 1
+    ) c ON true
+    CROSS JOIN LATERAL ({_BATCH_DOCUMENTS_LATERAL.format(
+        condition="c.distance IS NULL OR c.distance > LEAST(:threshold, COALESCE(c.radius, :threshold))"
+    )}) d
+    ORDER BY q.ord
+''')
+
+SYSTEM_PROMPT = """Eres un asistente experto.
+Responde únicamente usando la información del contexto proporcionado. Si el contexto no es suficiente, indica que no dispones de esa información.
+No inventes datos, no proporciones información falsa o ambigua, ni ofrezcas consejos médicos/legales/financieros.
+Prioriza la seguridad, equidad y respeto. Si la petición es peligrosa o inadecuada, recházala educadamente."""
+
+def create_llm():
+    # langchain_google_genai tarda en importarse: solo se carga al crear el primer Retriever
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(model=LLM_MODEL, temperature=0.1)
 
 class Retriever:
-    def __init__(self):
-        self.embeddings = GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL)
-        self.llm = ChatGoogleGenerativeAI(model=LLM_MODEL, temperature=0.1)
-        self.semantic_cache = SemanticCacheManager()
+    def __init__(self, pipeline: str = None):
+        self.embeddings = get_cached_embeddings(EMBEDDING_MODEL)
+        self.llm = create_llm()
+        self.semantic_cache = SemanticCacheManager(embeddings=self.embeddings)
+        self.pipeline = pipeline or SEMANTIC_CACHE_PIPELINE
+        if self.pipeline not in ("context_first", "cache_first"):
+            raise ValueError(f"SEMANTIC_CACHE_PIPELINE no soportado: {self.pipeline}")
 
     def _get_context_from_documents(self, session, query_vector):
-        sql = text(f'''
-            SELECT content, embedding <#> vector(:query_vector) AS distance
-            FROM documents
-            ORDER BY distance ASC
-            LIMIT {TOP_K}
-        ''')
-        results = session.execute(sql, {"query_vector": to_pgvector_str(query_vector)}).fetchall()
+        """Devuelve (context, sources) con los documentos top-K; ver _sources."""
+        apply_search_params(session)
+        results = session.execute(DOCUMENT_SEARCH_SQL, {"query_vector": as_vector(query_vector)}).fetchall()
         context = "\n\n".join([row[0] for row in results])
-        return context
+        return context, self._sources(results)
+
+    async def _aget_context_from_documents(self, session, query_vector):
+        await aapply_search_params(session)
+        results = (await session.execute(DOCUMENT_SEARCH_SQL, {"query_vector": as_vector(query_vector)})).fetchall()
+        return "\n\n".join([row[0] for row in results]), self._sources(results)
+
+    def _sources(self, results) -> tuple:
+        """
+        (document_ids, kth_distance) de la misma búsqueda que produjo el contexto, para la
+        invalidación incremental; kth_distance es None si hubo menos de TOP_K documentos.
+        """
+        document_ids = [row[1] for row in results]
+        kth_distance = results[-1][2] if len(results) == TOP_K else None
+        return document_ids, kth_distance
 
     def _hash_context(self, context: str) -> str:
         return hashlib.sha256(context.encode('utf-8')).hexdigest()
 
-    def query(self, prompt: str):
-        session = get_db_session()
-        start = time.perf_counter()
-        try:
-            query_vector = self.embeddings.embed_query(prompt)
-            context = self._get_context_from_documents(session, query_vector)
-            context_hash = self._hash_context(context)
+    def _build_messages(self, context: str, prompt: str):
+        return [
+            ("system", SYSTEM_PROMPT),
+            ("human", f"Contexto:\n{context}\n\nPregunta: {prompt}")
+        ]
+
+    def _probe(self, session, prompt: str, timer: StageTimer):
+        """
+        Embedding, búsqueda de documentos y consulta a la cache, sin llamar al LLM.
+        Devuelve (cached_response, min_distance, query_vector, context, context_hash, corpus_version, sources);
+        en un hit del pipeline cache-first context, context_hash y sources son None.
+        """
+        with timer.stage("embed"):
+            query_vector = normalize_vector(self.embeddings.embed_query(prompt, session=session))
+        corpus_version = None
+        context = context_hash = sources = None
+        if self.pipeline == "cache_first":
+            # Se consulta la cache solo con el embedding del prompt, entre las entradas no stale;
+            # la búsqueda de documentos se hace únicamente si hay miss
+            with timer.stage("cache_probe"):
+                cached_response, min_distance, corpus_version = self.semantic_cache.get_by_corpus_version(
+                    prompt, query_vector, session=session
+                )
+            if cached_response is not None:
+                return cached_response, min_distance, query_vector, context, context_hash, corpus_version, sources
+            with timer.stage("document_search"):
+                context, sources = self._get_context_from_documents(session, query_vector)
+                context_hash = self._hash_context(context)
+        else:
+            with timer.stage("document_search"):
+                context, sources = self._get_context_from_documents(session, query_vector)
+                context_hash = self._hash_context(context)
             # Usar SemanticCacheManager para buscar en cache
-            cached_response, min_distance = self.semantic_cache.get(
-                prompt, query_vector, context_hash
-            )
+            with timer.stage("cache_probe"):
+                cached_response, min_distance = self.semantic_cache.get(
+                    prompt, query_vector, context_hash, session=session
+                )
+        return cached_response, min_distance, query_vector, context, context_hash, corpus_version, sources
+
+    async def _aprobe(self, session, prompt: str, timer: StageTimer):
+        """Variante async de _probe."""
+        with timer.stage("embed"):
+            query_vector = normalize_vector(await self.embeddings.aembed_query(prompt, session=session))
+        corpus_version = None
+        context = context_hash = sources = None
+        if self.pipeline == "cache_first":
+            with timer.stage("cache_probe"):
+                cached_response, min_distance, corpus_version = await self.semantic_cache.aget_by_corpus_version(
+                    prompt, query_vector, session=session
+                )
             if cached_response is not None:
-                elapsed = time.perf_counter() - start
-                return cached_response, "hit", min_distance, elapsed
-            # Si no hay cache hit, invocar LLM
-            logger.info(f"CACHE MISS: prompt='{prompt[:30]}...', min_distance={min_distance}, context_hash={context_hash[:8]}...")
-            messages = [
-                ("system", """Eres un asistente experto.
-Responde únicamente usando la información del contexto proporcionado. Si el contexto no es suficiente, indica que no dispones de esa información.
-No inventes datos, no proporciones información falsa o ambigua, ni ofrezcas consejos médicos/legales/financieros.
-Prioriza la seguridad, equidad y respeto. Si la petición es peligrosa o inadecuada, recházala educadamente."""),
-                ("human", f"Contexto:\n{context}\n\nPregunta: {prompt}")
-            ]
-            response = self.llm.invoke(messages)
-            # Guardar en el semantic_cache
-            self.semantic_cache.set(
-                prompt, query_vector, context, context_hash, response.content
-            )
-            session.commit()
-            elapsed = time.perf_counter() - start
-            logger.info(f"Respuesta generada y cacheada para prompt='{prompt[:30]}...' en {elapsed:.2f}s")
-            return response.content, "miss", min_distance, elapsed
+                return cached_response, min_distance, query_vector, context, context_hash, corpus_version, sources
+            with timer.stage("document_search"):
+                context, sources = await self._aget_context_from_documents(session, query_vector)
+                context_hash = self._hash_context(context)
+        else:
+            with timer.stage("document_search"):
+                context, sources = await self._aget_context_from_documents(session, query_vector)
+                context_hash = self._hash_context(context)
+            with timer.stage("cache_probe"):
+                cached_response, min_distance = await self.semantic_cache.aget(
+                    prompt, query_vector, context_hash, session=session
+                )
+        return cached_response, min_distance, query_vector, context, context_hash, corpus_version, sources
+
+    def query(self, prompt: str, session=None):
+        """
+        Devuelve (respuesta, cache_status, min_distance, elapsed, timings).
+        cache_status es hit, miss o coalesced (se esperó a la generación de otra petición).
+        timings tiene el tiempo en ms de cada etapa ejecutada.
+        session es la sesión de la petición; sin ella se abre una propia.
+        """
+        timer = StageTimer()
+        try:
+            with reuse_session(session, get_db_session) as session:
+                cached_response, min_distance, query_vector, context, context_hash, corpus_version, sources = self._probe(
+                    session, prompt, timer
+                )
+                if cached_response is not None:
+                    return cached_response, "hit", min_distance, timer.elapsed(), timer.timings
+                # La conexión vuelve al pool mientras se espera al LLM; la sesión se reutiliza al guardar
+                session.commit()
+                # Si no hay cache hit, invocar LLM
+                logger.info(f"CACHE MISS: prompt='{prompt[:30]}...', min_distance={min_distance}, context_hash={context_hash[:8]}...")
+                def generate():
+                    messages = self._build_messages(context, prompt)
+                    with timer.stage("llm"):
+                        response = self.llm.invoke(messages)
+                    record_llm_usage(messages, response.content, getattr(response, "usage_metadata", None))
+                    # Guardar en el semantic_cache
+                    with timer.stage("cache_write"):
+                        self.semantic_cache.set(
+                            prompt, query_vector, context, context_hash, response.content,
+                            corpus_version=corpus_version, sources=sources, session=session
+                        )
+                    return response.content
+
+                # Misses concurrentes de prompts casi idénticos comparten una sola llamada al LLM
+                with timer.stage("generate"):
+                    result, cache_status = self.semantic_cache.coalesce(prompt, query_vector, context_hash, generate)
+            elapsed = timer.elapsed()
+            logger.info(f"Respuesta generada y cacheada para prompt='{prompt[:30]}...' ({cache_status}) en {elapsed:.2f}s {timer.timings}")
+            return result, cache_status, min_distance, elapsed, timer.timings
         except Exception as e:
-            session.rollback()
             logger.error(f"Error en Retriever.query: {e}", exc_info=True)
             raise e
-        finally:
-            session.close() 
\ No newline at end of file
+
+
+    async def aquery(self, prompt: str, session=None):
+        """
+        Variante async de query: embeddings, búsquedas y LLM sin bloquear el event loop.
+        Devuelve la misma tupla que query.
+        """
+        timer = StageTimer()
+        try:
+            async with areuse_session(session, get_async_db_session) as session:
+                cached_response, min_distance, query_vector, context, context_hash, corpus_version, sources = await self._aprobe(
+                    session, prompt, timer
+                )
+                if cached_response is not None:
+                    return cached_response, "hit", min_distance, timer.elapsed(), timer.timings
+                # Se libera la conexión: no se retiene mientras se espera al LLM
+                await session.commit()
+                logger.info(f"CACHE MISS: prompt='{prompt[:30]}...', min_distance={min_distance}, context_hash={context_hash[:8]}...")
+                async def generate():
+                    messages = self._build_messages(context, prompt)
+                    with timer.stage("llm"):
+                        response = await self.llm.ainvoke(messages)
+                    record_llm_usage(messages, response.content, getattr(response, "usage_metadata", None))
+                    with timer.stage("cache_write"):
+                        await self.semantic_cache.aset(
+                            prompt, query_vector, context, context_hash, response.content,
+                            corpus_version=corpus_version, sources=sources, session=session
+                        )
+                    return response.content
+
+                with timer.stage("generate"):
+                    result, cache_status = await self.semantic_cache.acoalesce(prompt, query_vector, context_hash, generate)
+            elapsed = timer.elapsed()
+            logger.info(f"Respuesta generada y cacheada para prompt='{prompt[:30]}...' ({cache_status}) en {elapsed:.2f}s {timer.timings}")
+            return result, cache_status, min_distance, elapsed, timer.timings
+        except Exception as e:
+            logger.error(f"Error en Retriever.aquery: {e}", exc_info=True)
+            raise e
+
+    def _batch_params(self, query_vectors: list) -> dict:
+        return {"query_vectors": [as_vector(v) for v in query_vectors], "threshold": CACHE_DISTANCE_THRESHOLD}
+
+    def _batch_probes(self, rows) -> list:
+        """
+        Convierte las filas de la consulta por lotes en
+        (cached_response, min_distance, context, context_hash, corpus_version, sources) por prompt.
+        """
+        probes = []
+        for row in rows:
+            if self.pipeline == "cache_first":
+                _, corpus_version, response, distance, entry_id, radius, context, document_ids, kth_distance = row
+                cached_response, min_distance = self.semantic_cache.check_candidate(response, distance, entry_id, radius)
+                context_hash = self._hash_context(context) if cached_response is None else None
+            else:
+                _, context, context_hash, response, distance, entry_id, radius, document_ids, kth_distance = row
+                corpus_version = None
+                cached_response, min_distance = self.semantic_cache.check_candidate(response, distance, entry_id, radius)
+            probes.append((cached_response, min_distance, context, context_hash, corpus_version, (document_ids, kth_distance)))
+        return probes
+
+    def _batch_misses(self, prompts: list, probes: list) -> dict:
+        """Agrupa los misses por (context_hash, prompt): los repetidos en el lote se generan una vez."""
+        misses = {}
+        for i, (cached_response, _, _, context_hash, _, _) in enumerate(probes):
+            if cached_response is None:
+                misses.setdefault((context_hash, prompts[i]), []).append(i)
+        return misses
+
+    def _batch_results(self, probes: list, misses: dict, responses: list) -> list:
+        """responses trae None en los misses cuya generación falló: esos prompts quedan con cache_status error."""
+        results = [(cached_response, "hit", min_distance) for cached_response, min_distance, *_ in probes]
+        for indexes, response in zip(misses.values(), responses):
+            for n, i in enumerate(indexes):
+                if response is None:
+                    results[i] = (None, "error", probes[i][1])
+                else:
+                    results[i] = (response, "miss" if n == 0 else "coalesced", probes[i][1])
+        return results
+
+    def _batch_responses(self, prompts: list, leaders: list, messages: list, generated: list) -> list:
+        """Contenido de cada respuesta generada; None (y un log) para las que fallaron."""
+        responses = []
+        for i, message_list, response in zip(leaders, messages, generated):
+            if isinstance(response, Exception):
+                logger.error(f"Error generando la respuesta de '{prompts[i][:30]}...' en el lote: {response}")
+                responses.append(None)
+                continue
+            record_llm_usage(message_list, response.content, getattr(response, "usage_metadata", None))
+            responses.append(response.content)
+        return responses
+
+    def query_many(self, prompts: list, session=None, max_concurrency: int = None):
+        """
+        Versión por lotes de query. Los prompts se embeben en una sola llamada, la búsqueda
+        de documentos y la consulta a la cache de todos ellos se resuelven en un solo
+        round-trip, y solo los misses van al LLM (hasta max_concurrency llamadas a la vez).
+        Devuelve ([(respuesta, cache_status, min_distance), ...], timings); si la generación
+        de un miss falla, ese prompt (y sus repetidos) vuelve como (None, "error", min_distance).
+        """
+        timer = StageTimer()
+        if not prompts:
+            return [], timer.timings
+        with reuse_session(session, get_db_session) as session:
+            with timer.stage("embed"):
+                query_vectors = [normalize_vector(v) for v in self.embeddings.embed_queries(prompts, session=session)]
+            with timer.stage("batch_probe"):
+                apply_search_params(session)
+                sql = BATCH_PROBE_BY_CORPUS_VERSION_SQL if self.pipeline == "cache_first" else BATCH_PROBE_SQL
+                probes = self._batch_probes(session.execute(sql, self._batch_params(query_vectors)).fetchall())
+            # La conexión vuelve al pool mientras se espera al LLM
+            session.commit()
+            misses = self._batch_misses(prompts, probes)
+            leaders = [indexes[0] for indexes in misses.values()]
+            messages = [self._build_messages(probes[i][2], prompts[i]) for i in leaders]
+            responses = []
+            if leaders:
+                logger.info(f"query_many: {len(prompts)} prompts, {len(leaders)} misses al LLM")
+                with timer.stage("llm"):
+                    # Un miss que falla no descarta el resto del lote (ni los hits ya resueltos)
+                    generated = self.llm.batch(
+                        messages, config={"max_concurrency": max_concurrency or QUERY_BATCH_LLM_CONCURRENCY},
+                        return_exceptions=True
+                    )
+                responses = self._batch_responses(prompts, leaders, messages, generated)
+                with timer.stage("cache_write"):
+                    for i, response in zip(leaders, responses):
+                        if response is None:
+                            continue
+                        _, _, context, context_hash, corpus_version, sources = probes[i]
+                        self.semantic_cache.set(
+                            prompts[i], query_vectors[i], context, context_hash, response,
+                            corpus_version=corpus_version, sources=sources, session=session
+                        )
+        return self._batch_results(probes, misses, responses), timer.timings
+
+    async def aquery_many(self, prompts: list, session=None, max_concurrency: int = None):
+        """Variante async de query_many."""
+        timer = StageTimer()
+        if not prompts:
+            return [], timer.timings
+        async with areuse_session(session, get_async_db_session) as session:
+            with timer.stage("embed"):
+                query_vectors = [normalize_vector(v) for v in await self.embeddings.aembed_queries(prompts, session=session)]
+            with timer.stage("batch_probe"):
+                await aapply_search_params(session)
+                sql = BATCH_PROBE_BY_CORPUS_VERSION_SQL if self.pipeline == "cache_first" else BATCH_PROBE_SQL
+                probes = self._batch_probes((await session.execute(sql, self._batch_params(query_vectors))).fetchall())
+            await session.commit()
+            misses = self._batch_misses(prompts, probes)
+            leaders = [indexes[0] for indexes in misses.values()]
+            messages = [self._build_messages(probes[i][2], prompts[i]) for i in leaders]
+            responses = []
+            if leaders:
+                logger.info(f"aquery_many: {len(prompts)} prompts, {len(leaders)} misses al LLM")
+                with timer.stage("llm"):
+                    generated = await self.llm.abatch(
+                        messages, config={"max_concurrency": max_concurrency or QUERY_BATCH_LLM_CONCURRENCY},
+                        return_exceptions=True
+                    )
+                responses = self._batch_responses(prompts, leaders, messages, generated)
+                with timer.stage("cache_write"):
+                    for i, response in zip(leaders, responses):
+                        if response is None:
+                            continue
+                        _, _, context, context_hash, corpus_version, sources = probes[i]
+                        await self.semantic_cache.aset(
+                            prompts[i], query_vectors[i], context, context_hash, response,
+                            corpus_version=corpus_version, sources=sources, session=session
+                        )
+        return self._batch_results(probes, misses, responses), timer.timings
+
+    def prepare_stream(self, prompt: str, timer: StageTimer, session=None):
+        """
+        Primera parte de una consulta en streaming: todo menos la generación.
+        Devuelve la misma tupla que _probe.
+        """
+        with reuse_session(session, get_db_session) as session:
+            probe = self._probe(session, prompt, timer)
+            # La conexión no se retiene durante el stream
+            session.commit()
+            return probe
+
+    async def aprepare_stream(self, prompt: str, timer: StageTimer, session=None):
+        async with areuse_session(session, get_async_db_session) as session:
+            probe = await self._aprobe(session, prompt, timer)
+            await session.commit()
+            return probe
+
+    def astream_answer(self, prompt: str, context: str):
+        """Generador async con los fragmentos de la respuesta del LLM."""
+        return llm_chunks(self.llm, self._build_messages(context, prompt))
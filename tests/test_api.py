@@ -1,12 +1,21 @@
 import pytest
 from fastapi.testclient import TestClient
 from src.app.main import app
-from src.app.dependencies import get_retriever
-from src.app.db import get_db_session
+from src.app.dependencies import get_retriever, get_exact_cache
+from src.app.db import get_db_session, get_request_session
 
 class DummyRetriever:
-    def query(self, prompt):
-        return f"Respuesta simulada para: {prompt}"
+    def query(self, prompt, session=None):
+        return f"Respuesta simulada para: {prompt}", "miss", None, 0.01, {"embed": 1.0}
+    def query_many(self, prompts, session=None):
+        return [(f"Respuesta simulada para: {p}", "miss", None) for p in prompts], {"embed": 1.0}
+
+class DummyExactCache:
+    def get(self, prompt, session=None):
+        return f"Respuesta cacheada para: {prompt}"
+    def set(self, prompt, response, session=None): pass
+    def get_or_generate(self, prompt, generate, session=None):
+        return self.get(prompt), "hit"
 
 class DummySession:
     def execute(self, *args, **kwargs): pass
@@ -17,12 +26,20 @@ class DummySession:
 def override_get_retriever():
     return DummyRetriever()
 
+def override_get_exact_cache():
+    return DummyExactCache()
+
 def override_get_db_session():
     return DummySession()
 
+def override_get_request_session():
+    yield DummySession()
+
 # Aplicar overrides para los tests
 app.dependency_overrides[get_retriever] = override_get_retriever
 app.dependency_overrides[get_db_session] = override_get_db_session
+app.dependency_overrides[get_request_session] = override_get_request_session
+app.dependency_overrides[get_exact_cache] = override_get_exact_cache
 
 client = TestClient(app)
 
@@ -36,4 +53,65 @@ def test_rag_query_semantic():
     response = client.post("/rag/query_semantic", json={"prompt": "¿Cuál es la capital de Francia?"})
     assert response.status_code == 200
     assert isinstance(response.json()["result"], str)
-    assert response.json()["result"]  # No vacío 
\ No newline at end of file
+    assert response.json()["result"]  # No vacío
+
+def test_requests_are_logged_once_through_the_writer():
+    from src.app.db.log_writer import get_query_log_writer
+    writer = get_query_log_writer()
+    before = writer.stats()["enqueued"]
+    response = client.post("/rag/query_exact", json={"prompt": "¿Cuál es la capital de Francia?"})
+    assert response.status_code == 200
+    assert writer.stats()["enqueued"] == before + 1
+
+def test_rag_query_semantic_stream_forwards_tokens_and_writes_behind():
+    import json
+    saved = []
+    class StreamingSemanticCache:
+        def set(self, prompt, prompt_embedding, context, context_hash, response, corpus_version=None, sources=None, session=None):
+            saved.append((response, sources))
+    class StreamingRetriever:
+        semantic_cache = StreamingSemanticCache()
+        def prepare_stream(self, prompt, timer, session=None):
+            return None, -0.5, [0.1] * 768, "contexto", "abc123", None, ([3, 5], -0.8)
+        async def astream_answer(self, prompt, context):
+            for chunk in ["París ", "es la ", "capital."]:
+                yield chunk
+    app.dependency_overrides[get_retriever] = lambda: StreamingRetriever()
+    try:
+        response = client.post("/rag/query_semantic/stream", json={"prompt": "¿Cuál es la capital de Francia?"})
+    finally:
+        app.dependency_overrides[get_retriever] = override_get_retriever
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [block.split("\n") for block in response.text.strip().split("\n\n")]
+    names = [lines[0].removeprefix("event: ") for lines in events]
+    assert names == ["start", "token", "token", "token", "done"]
+    assert json.loads(events[-1][1].removeprefix("data: "))["cache_status"] == "miss"
+    assert saved == [("París es la capital.", ([3, 5], -0.8))]
+
+def test_rag_query_exact_stream_returns_hits_as_single_token():
+    response = client.post("/rag/query_exact/stream", json={"prompt": "¿Cuál es la capital de Francia?"})
+    assert response.status_code == 200
+    assert "event: token" in response.text
+    assert "Respuesta cacheada para" in response.text
+    assert '"cache_status": "hit"' in response.text
+
+def test_metrics_expose_stage_histograms_and_cache_counters(monkeypatch):
+    monkeypatch.setattr("src.app.main.SERVER_TIMING_HEADER", True)
+    response = client.post("/rag/query_semantic", json={"prompt": "¿Cuál es la capital de Francia?"})
+    assert response.headers["Server-Timing"].startswith("embed;dur=1.0, total;dur=")
+    client.post("/rag/query_exact", json={"prompt": "¿Cuál es la capital de Francia?"})
+    metrics = client.get("/metrics").text
+    assert 'rag_cache_lookups_total{cache="semantic",status="miss"}' in metrics
+    assert 'rag_cache_lookups_total{cache="exact",status="hit"}' in metrics
+    assert 'rag_llm_cost_saved_usd_total{cache="exact"}' in metrics
+    assert "rag_log_queue_depth" in metrics
+
+def test_rag_query_batch_returns_one_result_per_prompt(monkeypatch):
+    response = client.post("/rag/query_batch", json={"prompts": ["¿Capital de Francia?", "¿Capital de Italia?"]})
+    assert response.status_code == 200
+    assert [r["result"] for r in response.json()["results"]] == [
+        "Respuesta simulada para: ¿Capital de Francia?", "Respuesta simulada para: ¿Capital de Italia?",
+    ]
+    monkeypatch.setattr("src.app.main.QUERY_BATCH_MAX_SIZE", 1)
+    assert client.post("/rag/query_batch", json={"prompts": ["a", "b"]}).status_code == 422
@@ -0,0 +1,31 @@
+import numpy as np
+from benchmarks.fakes import FakeEmbeddings, FakeChatModel
+from benchmarks.workload import base_questions, zipf_workload
+from benchmarks.run import summarize, compare
+
+def test_fake_embeddings_are_deterministic_and_close_for_paraphrases():
+    embeddings = FakeEmbeddings()
+    a, b, c = (np.asarray(v) for v in embeddings.embed_documents([
+        "¿Cómo puedo cancelar pagos?", "Hola, ¿cómo puedo cancelar pagos? Gracias.", "Tarifas de exportación",
+    ]))
+    assert np.array_equal(a, np.asarray(FakeEmbeddings().embed_query("¿Cómo puedo cancelar pagos?")))
+    cosine = lambda x, y: float(x @ y / (np.linalg.norm(x) * np.linalg.norm(y)))
+    assert cosine(a, b) > cosine(a, c)
+
+def test_fake_chat_model_streams_the_same_answer():
+    llm = FakeChatModel(first_token_ms=0, token_ms=0, tokens=5)
+    messages = [("human", "hola")]
+    assert "".join(chunk.content for chunk in llm.stream(messages)) == llm.invoke(messages).content
+
+def test_zipf_workload_is_reproducible_and_skewed():
+    questions = base_questions(20)
+    prompts = zipf_workload(questions, 500, paraphrase_rate=0.0)
+    assert prompts == zipf_workload(questions, 500, paraphrase_rate=0.0)
+    assert prompts.count(questions[0]) > prompts.count(questions[-1])
+
+def test_compare_flags_latency_and_throughput_regressions():
+    baseline = {"endpoints": {"semantic": summarize([(100.0, "hit", {"cache_probe": 2.0})] * 10, 1.0)}}
+    slower = {"endpoints": {"semantic": summarize([(150.0, "miss", {"cache_probe": 2.0})] * 10, 2.0)}}
+    assert baseline["endpoints"]["semantic"]["hit_rate"] == 1.0
+    assert compare(baseline, baseline, 0.2) == []
+    assert len(compare(slower, baseline, 0.2)) == 3
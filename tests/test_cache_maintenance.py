@@ -0,0 +1,123 @@
+import pytest
+from src.cache.maintenance import CacheMaintainer, HitTracker
+
+class RecordingSession:
+    def __init__(self, count_row=(0, 0), rowcount=0):
+        self.count_row = count_row
+        self.rowcount = rowcount
+        self.executed = []
+    def execute(self, sql, params=None):
+        self.executed.append((str(sql), params))
+        session = self
+        class Result:
+            rowcount = session.rowcount
+            def fetchone(self):
+                return session.count_row
+        return Result()
+    def commit(self): pass
+    def rollback(self): pass
+    def close(self): pass
+
+def test_hit_tracker_batches_hits_per_table():
+    hits = HitTracker()
+    hits.record("semantic_cache", 1)
+    hits.record("semantic_cache", 1)
+    hits.record("exact_cache", 5)
+    hits.record("exact_cache", None)
+    session = RecordingSession()
+    assert hits.flush(session) == 2
+    assert len(session.executed) == 2
+    sql, params = next(e for e in session.executed if "UPDATE semantic_cache" in e[0])
+    assert params["id_0"] == 1 and params["count_0"] == 2
+    assert hits.drain() == {}
+
+def test_hit_tracker_keeps_hits_when_the_write_fails():
+    hits = HitTracker()
+    hits.record("semantic_cache", 1)
+    class FailingSession(RecordingSession):
+        def commit(self):
+            raise RuntimeError("conexión perdida")
+    with pytest.raises(RuntimeError):
+        hits.flush(FailingSession())
+    hits.record("semantic_cache", 1)
+    drained = hits.drain()
+    assert [(entry_id, count) for entry_id, count, _ in drained["semantic_cache"]] == [(1, 2)]
+
+def test_evict_applies_ttl_and_row_budget_with_policy():
+    maintainer = CacheMaintainer(hits=HitTracker(), interval=0, policy="lfu")
+    session = RecordingSession(count_row=(120, 120 * 1000), rowcount=3)
+    evicted = maintainer._evict(session, "semantic_cache", ttl=60, max_rows=100, max_bytes=0)
+    assert evicted == 6
+    ttl_sql, ttl_params = session.executed[0]
+    assert "created_at <" in ttl_sql and ttl_params == {"ttl": 60}
+    size_sql, size_params = session.executed[1]
+    assert "pg_stat_user_tables" in size_sql and size_params == {"table": "semantic_cache"}
+    # Las 3 filas borradas por TTL aún cuentan en las estadísticas: 117 vivas, 17 de exceso
+    evict_sql, evict_params = session.executed[-1]
+    assert "ORDER BY hit_count ASC" in evict_sql and evict_params == {"excess": 17}
+
+def test_evict_uses_byte_budget_when_larger():
+    maintainer = CacheMaintainer(hits=HitTracker(), interval=0)
+    session = RecordingSession(count_row=(100, 100 * 1000))
+    maintainer._evict(session, "exact_cache", ttl=0, max_rows=90, max_bytes=50 * 1000)
+    evict_sql, evict_params = session.executed[-1]
+    assert "ORDER BY last_accessed_at ASC" in evict_sql and evict_params == {"excess": 50}
+
+def test_invalid_policy_raises():
+    with pytest.raises(ValueError):
+        CacheMaintainer(hits=HitTracker(), policy="fifo")
+
+class MaintenanceConnection:
+    def __init__(self, locked=True, due=(False, False)):
+        self.locked = locked
+        self.due = due
+        self.executed = []
+    def execution_options(self, **kwargs):
+        return self
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+    def execute(self, sql, params=None):
+        self.executed.append(str(sql))
+        connection = self
+        class Result:
+            def scalar(self):
+                return connection.locked
+            def fetchone(self):
+                return connection.due
+        return Result()
+
+def patch_maintenance_engine(monkeypatch, connection):
+    monkeypatch.setattr("src.cache.maintenance.get_engine", lambda: type("obj", (object,), {"connect": lambda self: connection})())
+
+def test_run_once_skips_when_another_worker_holds_the_lock(monkeypatch):
+    connection = MaintenanceConnection(locked=False)
+    patch_maintenance_engine(monkeypatch, connection)
+    monkeypatch.setattr("src.cache.maintenance.get_db_session", lambda: RecordingSession())
+    maintainer = CacheMaintainer(hits=HitTracker(), interval=300)
+    monkeypatch.setattr(maintainer, "_evict", lambda *args: pytest.fail("no debe desalojar"))
+    assert maintainer.run_once() == {}
+    assert maintainer.skipped_runs == 1 and maintainer.runs == 0
+    assert not any("pg_advisory_unlock" in sql for sql in connection.executed)
+
+def test_run_once_skips_when_another_process_just_ran(monkeypatch):
+    connection = MaintenanceConnection(due=None)
+    patch_maintenance_engine(monkeypatch, connection)
+    monkeypatch.setattr("src.cache.maintenance.get_db_session", lambda: RecordingSession())
+    maintainer = CacheMaintainer(hits=HitTracker(), interval=300)
+    monkeypatch.setattr(maintainer, "_evict", lambda *args: pytest.fail("no debe desalojar"))
+    maintainer.run_once()
+    assert maintainer.skipped_runs == 1
+    assert "pg_advisory_unlock" in connection.executed[-1]
+
+def test_run_once_reindexes_when_the_shared_state_says_it_is_due(monkeypatch):
+    connection = MaintenanceConnection(due=(False, True))
+    patch_maintenance_engine(monkeypatch, connection)
+    monkeypatch.setattr("src.cache.maintenance.get_db_session", lambda: RecordingSession())
+    maintainer = CacheMaintainer(hits=HitTracker(), interval=300, tables={"exact_cache": (0, 0, 0)})
+    assert maintainer.run_once() == {"exact_cache": 0}
+    assert "REINDEX TABLE CONCURRENTLY exact_cache" in connection.executed
+    assert not any("VACUUM" in sql for sql in connection.executed)
+    assert any("SET last_reindex_at" in sql for sql in connection.executed)
+    assert "pg_advisory_unlock" in connection.executed[-1] and maintainer.runs == 1
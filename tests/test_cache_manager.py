@@ -0,0 +1,215 @@
+import pytest
+from src.cache.l1_cache import L1Cache
+from src.cache.cache_manager import ExactCacheManager
+
+class CountingSession:
+    def __init__(self, row=None):
+        self.row = row
+        self.executed = 0
+    def execute(self, sql, params=None):
+        self.executed += 1
+        row = self.row
+        class MockResult:
+            def fetchone(self):
+                return row
+        return MockResult()
+    def commit(self): pass
+    def rollback(self): pass
+    def close(self): pass
+
+def test_l1_lru_eviction_respects_byte_budget():
+    cache = L1Cache(max_bytes=400, ttl_seconds=60)
+    for i in range(10):
+        cache.set(f"prompt-{i}", "x" * 50)
+    stats = cache.stats()
+    assert stats["bytes"] <= 400
+    assert stats["evictions"] > 0
+    assert cache.lookup("prompt-9") == (True, "x" * 50)
+    assert cache.lookup("prompt-0") == (False, None)
+
+def test_l1_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("src.cache.l1_cache.time.monotonic", lambda: now[0])
+    cache = L1Cache(max_bytes=10_000, ttl_seconds=10)
+    cache.set("a", "respuesta")
+    now[0] += 5
+    assert cache.lookup("a") == (True, "respuesta")
+    now[0] += 10
+    assert cache.lookup("a") == (False, None)
+
+def test_exact_cache_serves_repeats_from_l1(monkeypatch):
+    session = CountingSession(row=("respuesta cacheada", 1))
+    monkeypatch.setattr("src.cache.cache_manager.get_db_session", lambda: session)
+    manager = ExactCacheManager()
+    assert manager.get("¿Cuál es la capital de Francia?") == "respuesta cacheada"
+    assert manager.get("¿Cuál es la capital de Francia?") == "respuesta cacheada"
+    assert session.executed == 1
+    assert manager.stats()["hits"] == 1
+
+def test_exact_cache_l1_hits_update_hit_tracker(monkeypatch):
+    from src.cache.maintenance import HitTracker
+    session = CountingSession(row=("respuesta cacheada", 42))
+    monkeypatch.setattr("src.cache.cache_manager.get_db_session", lambda: session)
+    hits = HitTracker()
+    manager = ExactCacheManager(hits=hits)
+    for _ in range(3):
+        assert manager.get("prompt frecuente") == "respuesta cacheada"
+    assert session.executed == 1
+    assert [(entry_id, count) for entry_id, count, _ in hits.drain()["exact_cache"]] == [(42, 3)]
+
+def test_exact_cache_does_not_remember_misses(monkeypatch):
+    session = CountingSession(row=None)
+    monkeypatch.setattr("src.cache.cache_manager.get_db_session", lambda: session)
+    manager = ExactCacheManager()
+    assert manager.get("prompt nuevo") is None
+    assert manager.get("prompt nuevo") is None
+    assert session.executed == 2
+    assert manager.stats()["entries"] == 0
+    manager.set("prompt nuevo", "respuesta")
+    assert manager.get("prompt nuevo") == "respuesta"
+
+def test_get_or_generate_sees_responses_stored_by_other_workers(monkeypatch):
+    session = CountingSession(row=None)
+    monkeypatch.setattr("src.cache.cache_manager.get_db_session", lambda: session)
+    manager = ExactCacheManager()
+    assert manager.get("prompt") is None
+    # Otro worker guarda la respuesta después del primer miss
+    session.row = ("respuesta de otro worker", 9)
+    assert manager.get_or_generate("prompt", lambda: pytest.fail("no debe generar")) == ("respuesta de otro worker", "hit")
+    assert session.executed == 2
+
+def test_prompt_digest_normalization():
+    from src.cache.normalization import parse_normalization, prompt_digest
+    default = parse_normalization("nfc,whitespace")
+    folded = parse_normalization("nfc,whitespace,casefold,accents")
+    assert prompt_digest("¿Cuál es  la capital\nde Francia? ", default) == prompt_digest("¿Cuál es la capital de Francia?", default)
+    assert prompt_digest("¿Cual es la capital de Francia?", default) != prompt_digest("¿Cuál es la capital de Francia?", default)
+    assert prompt_digest("¿CUAL es la capital de Francia?", folded) == prompt_digest("¿Cuál es la capital de Francia?", folded)
+    assert len(prompt_digest("x", default)) == 32
+    with pytest.raises(ValueError):
+        parse_normalization("nfc,stemming")
+
+def test_semantic_cache_filters_by_context_hash(monkeypatch):
+    from src.cache.cache_manager import SemanticCacheManager
+    executed = []
+    class SemanticSession(CountingSession):
+        def execute(self, sql, params=None):
+            executed.append((str(sql), params))
+            return super().execute(sql, params)
+    session = SemanticSession(row=("respuesta", -0.99, 7, None))
+    monkeypatch.setattr("src.cache.cache_manager.get_db_session", lambda: session)
+    from src.cache.maintenance import HitTracker
+    hits = HitTracker()
+    response, distance = SemanticCacheManager(hits=hits).get("prompt", [0.1] * 768, "abc123")
+    assert (response, distance) == ("respuesta", -0.99)
+    assert [(entry_id, count) for entry_id, count, _ in hits.drain()["semantic_cache"]] == [(7, 1)]
+    sql, params = executed[-1]
+    assert "context_hash = :context_hash" in sql and "LIMIT 1" in sql
+    assert params["context_hash"] == "abc123"
+    # La búsqueda filtrada sigue recorriendo el índice HNSW más allá de ef_search
+    assert ("SELECT set_config('hnsw.iterative_scan', :mode, true)", {"mode": "relaxed_order"}) in executed[:-1]
+
+def test_single_flight_coalesces_concurrent_misses():
+    import threading
+    import time
+    from src.cache.single_flight import SingleFlight
+    flights = SingleFlight()
+    calls = []
+    results = []
+    def generate():
+        calls.append(1)
+        time.sleep(0.1)
+        return "respuesta"
+    def worker(key, vector):
+        results.append(flights.do(key, generate, vector=vector, threshold=-0.95))
+    threads = [threading.Thread(target=worker, args=("ctx", [1.0, 0.0])) for _ in range(4)]
+    # Embedding casi idéntico (distancia -0.99) se une a la misma generación
+    threads.append(threading.Thread(target=worker, args=("ctx", [0.99, 0.141])))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    # Un embedding lejano genera su propia respuesta
+    assert flights.do("ctx", generate, vector=[0.0, 1.0], threshold=-0.95) == ("respuesta", False)
+
+def test_single_flight_followers_retry_when_leader_is_cancelled():
+    import asyncio
+    from src.cache.single_flight import SingleFlight
+    flights = SingleFlight()
+    calls = []
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "respuesta"
+    async def main():
+        leader = asyncio.create_task(flights.ado("ctx", generate))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(flights.ado("ctx", generate))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+    # El que esperaba no recibe (None, True): pasa a líder y genera la respuesta
+    assert asyncio.run(main()) == ("respuesta", False)
+    assert len(calls) == 2
+
+def test_exact_generate_under_advisory_lock_uses_the_lock_session(monkeypatch):
+    lock_session = CountingSession(row=None)
+    monkeypatch.setattr("src.cache.single_flight.get_db_session", lambda: lock_session)
+    monkeypatch.setattr("src.cache.cache_manager.CACHE_ADVISORY_LOCKS", True)
+    request_session = CountingSession(row=None)
+    manager = ExactCacheManager()
+    assert manager.get_or_generate("prompt", lambda: "respuesta", session=request_session) == ("respuesta", "miss")
+    # La sesión de la petición solo hace la primera consulta; lock, re-consulta y escritura van por la del lock
+    assert request_session.executed == 1
+    assert lock_session.executed == 3
+
+def test_exact_get_or_generate_reports_status(monkeypatch):
+    session = CountingSession(row=None)
+    monkeypatch.setattr("src.cache.cache_manager.get_db_session", lambda: session)
+    manager = ExactCacheManager()
+    assert manager.get_or_generate("prompt", lambda: "respuesta") == ("respuesta", "miss")
+    assert manager.get_or_generate("prompt", lambda: pytest.fail("no debe generar")) == ("respuesta", "hit")
+
+def test_entry_radius_only_tightens_threshold(monkeypatch):
+    from src.cache.cache_manager import SemanticCacheManager
+    from src.cache.thresholds import DistanceRecorder, entry_radius, effective_threshold
+    assert entry_radius(-0.97, -0.95) == pytest.approx(-0.985)
+    assert entry_radius(-0.5, -0.95) is None
+    assert effective_threshold(-0.95, -0.985) == -0.985
+    session = CountingSession(row=("respuesta", -0.97, 3, -0.985))
+    monkeypatch.setattr("src.cache.cache_manager.get_db_session", lambda: session)
+    distances = DistanceRecorder()
+    response, distance = SemanticCacheManager(distances=distances).get("prompt", [0.1] * 768, "abc123")
+    # -0.97 pasa el threshold global pero no el radio de la entrada
+    assert response is None and distance == -0.97
+    assert distances.samples() == [(-0.97, False)]
+
+def test_entry_radius_tightens_only_when_answers_differ(monkeypatch):
+    from src.cache.cache_manager import SemanticCacheManager
+    class ResponseEmbeddings:
+        def embed_documents(self, texts):
+            return [[1.0, 0.0] if "París" in t else [0.0, 1.0] for t in texts]
+    def inserted_radius(neighbor_response):
+        session = CountingSession(row=(neighbor_response, -0.97, 3, None))
+        executed = []
+        original = session.execute
+        session.execute = lambda sql, params=None: executed.append(params) or original(sql, params)
+        SemanticCacheManager(embeddings=ResponseEmbeddings()).set(
+            "prompt", [0.1] * 768, "contexto", "abc123", "París es la capital.", session=session
+        )
+        return executed[-1]["radius"], executed[-1]["neighbor_id"]
+    assert inserted_radius("La capital es París.") == (None, None)
+    radius, neighbor_id = inserted_radius("Madrid es la capital.")
+    assert radius == pytest.approx(-0.985) and neighbor_id == 3
+
+def test_choose_threshold_respects_target_false_hit_rate():
+    from src.cache.thresholds import choose_threshold
+    samples = [(-0.99, True), (-0.98, True), (-0.96, True), (-0.95, False), (-0.9, True), (-0.8, False)]
+    result = choose_threshold(samples, target_false_hit_rate=0.25)
+    assert result["threshold"] == -0.9
+    assert result["hit_rate"] == pytest.approx(5 / 6)
+    assert choose_threshold(samples, target_false_hit_rate=0.0)["threshold"] == -0.96
@@ -0,0 +1,51 @@
+import pytest
+from src.cache.warmup import cluster_paraphrases, group_exact, select_within_budget, warm_exact
+
+def test_cluster_paraphrases_merges_prompts_within_threshold():
+    candidates = [("¿Horario de apertura?", 5.0), ("Horario de apertura", 2.0), ("¿Precio del envío?", 3.0)]
+    vectors = [[1.0, 0.0], [0.99, 0.05], [0.0, 1.0]]
+    clusters = cluster_paraphrases(candidates, vectors, threshold=-0.95)
+    assert clusters == [("¿Horario de apertura?", 7.0, 2), ("¿Precio del envío?", 3.0, 1)]
+
+def test_group_exact_and_budget_keep_the_highest_scores():
+    groups = group_exact([("Hola", 1.0), ("hola", 2.0), ("Adiós", 0.5)], key=lambda prompt: prompt.lower())
+    assert groups == [("Hola", 3.0), ("Adiós", 0.5)]
+    exact, semantic = select_within_budget(groups, [("¿Horario?", 2.0, 3)], max_prompts=2)
+    assert (exact, semantic) == (["Hola"], ["¿Horario?"])
+
+def test_warm_exact_only_generates_missing_prompts():
+    class Cache:
+        def __init__(self):
+            self.stored = {"cacheado": "ya estaba"}
+        def get(self, prompt, session=None):
+            return self.stored.get(prompt)
+        def set(self, prompt, response, session=None):
+            self.stored[prompt] = response
+    class LLM:
+        def batch(self, inputs, config=None, return_exceptions=False):
+            assert config == {"max_concurrency": 3} and return_exceptions
+            return [
+                RuntimeError("cuota agotada") if m[0][1] == "falla" else type("obj", (object,), {"content": f"respuesta a {m[0][1]}"})()
+                for m in inputs
+            ]
+    cache = Cache()
+    report = warm_exact(cache, LLM(), ["cacheado", "nuevo", "falla"], max_concurrency=3)
+    # Un prompt que falla no interrumpe el warm-up
+    assert report == {"prompts": 3, "cached": 1, "generated": 1, "failed": 1}
+    assert cache.stored["nuevo"] == "respuesta a nuevo"
+    assert "falla" not in cache.stored
+
+def test_warm_up_skips_when_another_worker_holds_the_lock(monkeypatch):
+    from src.cache.warmup import warm_up
+    class LockConnection:
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            return False
+        def execute(self, sql, params=None):
+            assert "pg_try_advisory_lock" in str(sql)
+            return type("obj", (object,), {"scalar": lambda self: False})()
+        def rollback(self): pass
+    monkeypatch.setattr("src.cache.warmup.get_engine", lambda: type("obj", (object,), {"connect": lambda self: LockConnection()})())
+    monkeypatch.setattr("src.cache.warmup.get_db_session", lambda: pytest.fail("no debe minar query_logs"))
+    assert warm_up(retriever=None, exact_cache=None) == {"skipped": True}
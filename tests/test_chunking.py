@@ -0,0 +1,21 @@
+import pytest
+from src.indexer.chunking import chunk_text
+
+def test_sentence_chunks_respect_size_and_overlap():
+    content = "Uno dos tres. Cuatro cinco. Seis siete ocho. Nueve diez."
+    chunks = chunk_text(content, size=5, overlap=2, strategy="sentence")
+    assert chunks == ["Uno dos tres. Cuatro cinco.", "Cuatro cinco. Seis siete ocho.", "Nueve diez."]
+    assert all(len(c.split()) <= 5 for c in chunks)
+
+def test_token_chunks_overlap():
+    content = " ".join(str(i) for i in range(10))
+    assert chunk_text(content, size=4, overlap=1, strategy="token") == ["0 1 2 3", "3 4 5 6", "6 7 8 9"]
+
+def test_long_sentence_is_split_by_words():
+    content = " ".join(f"w{i}" for i in range(7)) + "."
+    chunks = chunk_text(content, size=3, overlap=0, strategy="sentence")
+    assert chunks == ["w0 w1 w2", "w3 w4 w5", "w6."]
+
+def test_invalid_overlap_raises():
+    with pytest.raises(ValueError):
+        chunk_text("texto", size=3, overlap=3)
@@ -0,0 +1,58 @@
+import pytest
+from src.cache.embedding_cache import CachedEmbeddings
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.queries = []
+        self.documents = []
+    def embed_query(self, prompt):
+        self.queries.append(prompt)
+        return [float(len(prompt))] * 4
+    def embed_documents(self, docs):
+        self.documents.append(list(docs))
+        return [[float(len(d))] * 4 for d in docs]
+
+class MemoryStore:
+    def __init__(self):
+        self.rows = {}
+        self.sessions = []
+    def get_many(self, model, task, digests, session=None):
+        self.sessions.append(session)
+        return {d: self.rows[(model, task, d)] for d in digests if (model, task, d) in self.rows}
+    def put_many(self, model, task, items, session=None):
+        self.sessions.append(session)
+        for digest, vector in items:
+            self.rows[(model, task, digest)] = list(vector)
+
+def test_repeated_queries_do_not_call_remote_api():
+    remote = CountingEmbeddings()
+    embeddings = CachedEmbeddings(remote, "models/test", store=None)
+    assert embeddings.embed_query("hola") == [4.0] * 4
+    assert embeddings.embed_query("hola") == [4.0] * 4
+    assert remote.queries == ["hola"]
+
+def test_only_new_documents_are_embedded():
+    remote = CountingEmbeddings()
+    embeddings = CachedEmbeddings(remote, "models/test", store=None)
+    embeddings.embed_documents(["doc1", "doc22"])
+    vectors = embeddings.embed_documents(["doc1", "doc333", "doc333"])
+    assert remote.documents == [["doc1", "doc22"], ["doc333"]]
+    assert vectors == [[4.0] * 4, [6.0] * 4, [6.0] * 4]
+
+def test_persistent_store_is_shared_between_instances():
+    store = MemoryStore()
+    CachedEmbeddings(CountingEmbeddings(), "models/test", store=store).embed_documents(["doc1"])
+    remote = CountingEmbeddings()
+    vectors = CachedEmbeddings(remote, "models/test", store=store).embed_documents(["doc1"])
+    assert vectors == [[4.0] * 4]
+    assert remote.documents == []
+    # Consulta y documento usan tareas distintas, no comparten entrada
+    CachedEmbeddings(remote, "models/test", store=store).embed_query("doc1")
+    assert remote.queries == ["doc1"]
+
+def test_store_uses_the_request_session():
+    store = MemoryStore()
+    request_session = object()
+    CachedEmbeddings(CountingEmbeddings(), "models/test", store=store).embed_query("hola", session=request_session)
+    # Lectura y escritura del embedding nuevo en la sesión de la petición
+    assert store.sessions == [request_session, request_session]
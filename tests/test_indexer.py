@@ -5,13 +5,27 @@ class DummyEmbeddings:
     def embed_documents(self, docs):
         return [[0.1]*768 for _ in docs]
 
+class DummyResult:
+    def __init__(self, rows=None):
+        self.rows = rows or []
+    def fetchall(self):
+        return self.rows
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
 class DummySession:
-    def __init__(self):
+    def __init__(self, existing=None):
         self.inserted = []
         self.committed = False
         self.rolled_back = False
+        self.existing = existing or []
     def execute(self, *args, **kwargs):
         self.inserted.append((args, kwargs))
+        if "SELECT content_hash" in str(args[0]):
+            return DummyResult([(h,) for h in self.existing])
+        if "RETURNING id" in str(args[0]):
+            return DummyResult([(i,) for i, key in enumerate(args[1]) if key.startswith("content_")])
+        return DummyResult()
     def commit(self):
         self.committed = True
     def rollback(self):
@@ -26,5 +40,147 @@ def test_index_documents(monkeypatch):
     indexer = Indexer()
     indexer.embeddings = DummyEmbeddings()
     monkeypatch.setattr("src.indexer.indexer.get_db_session", dummy_get_db_session)
-    count = indexer.index_documents(["doc1", "doc2"])
-    assert count == 2 
\ No newline at end of file
+    assert indexer.index_documents(["doc1", "doc2"]) == (2, 0)
+
+def test_index_stream_commits_per_batch_and_checkpoints(monkeypatch):
+    sessions = []
+    def recording_get_db_session():
+        session = DummySession()
+        sessions.append(session)
+        return session
+    indexer = Indexer()
+    indexer.embeddings = DummyEmbeddings()
+    monkeypatch.setattr("src.indexer.indexer.get_db_session", recording_get_db_session)
+    monkeypatch.setattr(Indexer, "_load_checkpoint", lambda self, job_id: 2)
+    docs = (f"doc{i}" for i in range(7))
+    count = indexer.index_stream(docs, job_id="job-1", batch_size=2, max_concurrency=2)
+    # Los 2 primeros ya estaban confirmados: quedan 5 en lotes de 2, 2 y 1
+    assert count == (5, 0)
+    # Una sesión de lectura (dedup) y otra de escritura por lote
+    assert len([s for s in sessions if s.committed]) == 3
+    checkpoint_params = [kwargs or args[1] for s in sessions for args, kwargs in s.inserted if len(args) > 1 and "job_id" in args[1]]
+    assert [p["processed"] for p in checkpoint_params] == [4, 6, 7]
+
+def test_iter_documents_file_reads_jsonl_and_text():
+    import io
+    from src.indexer.indexer import iter_documents_file
+    data = io.BytesIO('{"content": "uno", "metadata": {"src": "a"}}\n\ndos\n'.encode("utf-8"))
+    assert list(iter_documents_file(data)) == [("uno", {"src": "a"}), ("dos", None)]
+
+def test_index_documents_chunks_and_skips_existing(monkeypatch):
+    from src.indexer.chunking import content_digest
+    indexer = Indexer()
+    embedded = []
+    class RecordingEmbeddings(DummyEmbeddings):
+        def embed_documents(self, docs):
+            embedded.extend(docs)
+            return super().embed_documents(docs)
+    indexer.embeddings = RecordingEmbeddings()
+    session = DummySession(existing=[content_digest("Ya indexada.")])
+    monkeypatch.setattr("src.indexer.indexer.get_db_session", lambda: session)
+    monkeypatch.setattr("src.indexer.indexer.chunk_text", lambda content: content.split(" | "))
+    count = indexer.index_documents(["Ya indexada. | Nueva.", "Nueva."])
+    # Solo se embebe el chunk que no estaba guardado ni repetido en la entrada
+    assert embedded == ["Nueva."]
+    assert count == (1, 2)
+    insert_params = session.inserted[1][0][1]
+    assert insert_params["chunk_0"] == 1
+    assert insert_params["parent_0"] == content_digest("Ya indexada. | Nueva.")
+    # El linaje se registra para todos los chunks, también los ya guardados o repetidos
+    lineage = [args[1] for args, _ in session.inserted if "document_parents" in str(args[0])]
+    assert lineage[0]["parent_ids"] == [content_digest("Ya indexada. | Nueva.")] * 2 + [content_digest("Nueva.")]
+    assert lineage[0]["chunk_indexes"] == [0, 1, 0]
+    assert lineage[0]["hashes"][2] == content_digest("Nueva.")
+
+def test_index_documents_counts_only_rows_actually_inserted(monkeypatch):
+    class ConflictSession(DummySession):
+        def execute(self, sql, params=None):
+            self.inserted.append(((sql, params), {}))
+            if "RETURNING id" in str(sql):
+                # Otra ingesta insertó doc2 entre la comprobación y el INSERT: ON CONFLICT lo descarta
+                return DummyResult([(41,)])
+            return DummyResult()
+    indexer = Indexer()
+    indexer.embeddings = DummyEmbeddings()
+    monkeypatch.setattr("src.indexer.indexer.get_db_session", lambda: ConflictSession())
+    assert indexer.index_documents(["doc1", "doc2"]) == (1, 1)
+
+def test_index_documents_marks_only_affected_cache_entries_stale(monkeypatch):
+    class InsertingSession(DummySession):
+        def execute(self, sql, params=None):
+            self.inserted.append(((sql, params), {}))
+            if "RETURNING id" in str(sql):
+                return DummyResult([(41,), (42,)])
+            return DummyResult()
+    session = InsertingSession()
+    indexer = Indexer()
+    indexer.embeddings = DummyEmbeddings()
+    monkeypatch.setattr("src.indexer.indexer.get_db_session", lambda: session)
+    indexer.index_documents(["doc1", "doc2"])
+    stale_updates = [args for args, _ in session.inserted if "SET stale = true" in str(args[0])]
+    assert [params for _, params in stale_updates] == [{"document_ids": [41, 42], "candidates": 100}]
+    # Acotado por una búsqueda ANN por documento nuevo, no un recorrido de toda la cache
+    assert "LIMIT :candidates" in str(stale_updates[0][0])
+    assert session.committed
+
+def test_new_document_beyond_the_ann_bound_gets_an_exact_scan(monkeypatch):
+    class InsertingSession(DummySession):
+        def execute(self, sql, params=None):
+            self.inserted.append(((sql, params), {}))
+            if "RETURNING id" in str(sql):
+                return DummyResult([(41,), (42,)])
+            if "max_kth" in str(sql):
+                # Los 100 candidatos de 42 siguen por debajo del mayor kth_distance: puede haber
+                # entradas afectadas más allá del límite
+                return DummyResult([(42,)])
+            return DummyResult()
+    session = InsertingSession()
+    indexer = Indexer()
+    indexer.embeddings = DummyEmbeddings()
+    monkeypatch.setattr("src.indexer.indexer.get_db_session", lambda: session)
+    indexer.index_documents(["doc1", "doc2"])
+    stale_updates = [args for args, _ in session.inserted if "SET stale = true" in str(args[0])]
+    assert len(stale_updates) == 2
+    exact_sql, exact_params = stale_updates[1]
+    assert "LIMIT" not in str(exact_sql) and "< c.kth_distance" in str(exact_sql)
+    assert exact_params == {"document_ids": [42]}
+
+def test_update_and_delete_use_reverse_lookup(monkeypatch):
+    class DeletingSession(DummySession):
+        def __init__(self, deleted):
+            super().__init__()
+            self.deleted = deleted
+        def execute(self, sql, params=None):
+            self.inserted.append(((sql, params), {}))
+            if "DELETE FROM documents" in str(sql):
+                return DummyResult([(i,) for i in self.deleted])
+            return DummyResult()
+    indexer = Indexer()
+    indexer.embeddings = DummyEmbeddings()
+    session = DeletingSession(deleted=[7])
+    monkeypatch.setattr("src.indexer.indexer.get_db_session", lambda: session)
+    assert indexer.delete_documents([7]) == 1
+    sql = [str(args[0]) for args, _ in session.inserted]
+    assert "document_ids &&" in sql[0] and "DELETE FROM documents" in sql[1]
+    missing = DeletingSession(deleted=[])
+    monkeypatch.setattr("src.indexer.indexer.get_db_session", lambda: missing)
+    assert indexer.update_document(99, "texto nuevo") is None
+    assert missing.rolled_back and not missing.committed
+
+def test_delete_parent_keeps_chunks_shared_with_other_documents(monkeypatch):
+    class ParentSession(DummySession):
+        def execute(self, sql, params=None):
+            self.inserted.append(((sql, params), {}))
+            if "DELETE FROM document_parents" in str(sql):
+                return DummyResult([(7, True), (8, False)])
+            if "DELETE FROM documents" in str(sql):
+                return DummyResult([(i,) for i in params["document_ids"]])
+            return DummyResult()
+    indexer = Indexer()
+    session = ParentSession()
+    monkeypatch.setattr("src.indexer.indexer.get_db_session", lambda: session)
+    assert indexer.delete_parent(b"\x01") == 1
+    deletes = [params for args, _ in session.inserted for sql, params in [args] if "DELETE FROM documents" in str(sql)]
+    # El chunk 8 sigue perteneciendo a otro documento original
+    assert deletes == [{"document_ids": [7]}]
+    assert session.committed
@@ -0,0 +1,46 @@
+import pytest
+from src.app.db.log_writer import QueryLogWriter
+
+class RecordingSession:
+    def __init__(self):
+        self.executed = []
+        self.committed = 0
+    def execute(self, sql, params=None):
+        self.executed.append((str(sql), params))
+    def commit(self):
+        self.committed += 1
+    def rollback(self): pass
+    def close(self): pass
+
+def test_flush_writes_batches_with_multi_row_insert(monkeypatch):
+    session = RecordingSession()
+    monkeypatch.setattr("src.app.db.log_writer.get_db_session", lambda: session)
+    writer = QueryLogWriter(max_size=100, batch_size=3)
+    for i in range(5):
+        writer.enqueue("/rag/query_exact", b'{"prompt": "hola"}', '{"result": "ok"}', 200)
+    writer.flush()
+    assert len(session.executed) == 2
+    sql, params = session.executed[0]
+    assert sql.count("(:endpoint_") == 3
+    assert params["response_0"] == '{"result": "ok"}'
+    assert writer.stats()["written"] == 5
+    assert writer.stats()["queue_depth"] == 0
+
+def test_full_queue_drops_instead_of_blocking(monkeypatch):
+    monkeypatch.setattr("src.app.db.log_writer.LOG_BACKPRESSURE_SAMPLE_RATE", 0.0)
+    writer = QueryLogWriter(max_size=2, batch_size=10)
+    results = [writer.enqueue("/rag/query_exact", b"{}", "{}", 500) for _ in range(3)]
+    assert results == [True, True, False]
+    # Bajo presión las respuestas OK se muestrean antes de llenar la cola
+    assert writer.enqueue("/rag/query_exact", b"{}", "{}", 200) is False
+    stats = writer.stats()
+    assert stats["dropped"] == 1 and stats["sampled_out"] == 1
+
+def test_invalid_json_bodies_are_logged_as_empty_objects(monkeypatch):
+    session = RecordingSession()
+    monkeypatch.setattr("src.app.db.log_writer.get_db_session", lambda: session)
+    writer = QueryLogWriter(max_size=10, batch_size=10)
+    writer.enqueue("/health", b"", "no es json", 200)
+    writer.flush()
+    _, params = session.executed[0]
+    assert params["request_0"] == "{}" and params["response_0"] == "{}"
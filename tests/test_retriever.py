@@ -2,7 +2,7 @@ import pytest
 from src.retriever.retriever import Retriever
 
 class DummyEmbeddings:
-    def embed_query(self, prompt):
+    def embed_query(self, prompt, session=None):
         return [0.1]*768
 
 class DummyLLM:
@@ -10,7 +10,7 @@ class DummyLLM:
         return type('obj', (object,), {"content": "Respuesta LLM simulada"})()
 
 class DummySession:
-    def execute(self, sql, params):
+    def execute(self, sql, params=None):
         class Row:
             def __getitem__(self, idx):
                 return "doc context" if idx == 0 else 0.0
@@ -30,6 +30,22 @@ class DummySession:
     def commit(self):
         pass
 
+class DummySemanticCache:
+    def __init__(self, response=None):
+        self.response = response
+        self.calls = []
+    def get(self, prompt, prompt_embedding, context_hash, threshold=None, session=None):
+        self.calls.append("get")
+        return self.response, -0.99
+    def get_by_corpus_version(self, prompt, prompt_embedding, threshold=None, session=None):
+        self.calls.append("get_by_corpus_version")
+        return self.response, -0.99, 3
+    def set(self, *args, **kwargs):
+        self.calls.append(("set", kwargs.get("corpus_version")))
+        self.sources = kwargs.get("sources")
+    def coalesce(self, prompt, prompt_embedding, context_hash, generate, threshold=None):
+        return generate(), "miss"
+
 def dummy_get_db_session():
     return DummySession()
 
@@ -37,7 +53,142 @@ def test_query(monkeypatch):
     retriever = Retriever()
     retriever.embeddings = DummyEmbeddings()
     retriever.llm = DummyLLM()
+    retriever.semantic_cache = DummySemanticCache()
     monkeypatch.setattr("src.retriever.retriever.get_db_session", dummy_get_db_session)
     result = retriever.query("¿Cuál es la capital de Francia?")
     assert isinstance(result, tuple)
-    assert "LLM simulada" in result[0] 
\ No newline at end of file
+    assert "LLM simulada" in result[0]
+
+def test_cache_first_hit_skips_document_search(monkeypatch):
+    retriever = Retriever(pipeline="cache_first")
+    retriever.embeddings = DummyEmbeddings()
+    retriever.llm = DummyLLM()
+    retriever.semantic_cache = DummySemanticCache(response="Respuesta cacheada")
+    monkeypatch.setattr("src.retriever.retriever.get_db_session", dummy_get_db_session)
+    monkeypatch.setattr(Retriever, "_get_context_from_documents", lambda *a: pytest.fail("no debe buscar documentos"))
+    result, cache_status, _, _, timings = retriever.query("¿Cuál es la capital de Francia?")
+    assert (result, cache_status) == ("Respuesta cacheada", "hit")
+    assert set(timings) == {"embed", "cache_probe"}
+
+def test_cache_first_miss_stores_corpus_version(monkeypatch):
+    retriever = Retriever(pipeline="cache_first")
+    retriever.embeddings = DummyEmbeddings()
+    retriever.llm = DummyLLM()
+    retriever.semantic_cache = DummySemanticCache()
+    monkeypatch.setattr("src.retriever.retriever.get_db_session", dummy_get_db_session)
+    result, cache_status, _, _, timings = retriever.query("¿Cuál es la capital de Francia?")
+    assert cache_status == "miss"
+    assert ("set", 3) in retriever.semantic_cache.calls
+    assert {"embed", "cache_probe", "document_search", "llm", "cache_write"} <= set(timings)
+
+class DummyAsyncSession:
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, *args):
+        return False
+    async def execute(self, sql, params=None):
+        return DummySession().execute(sql, params)
+    async def commit(self):
+        pass
+    async def rollback(self):
+        pass
+
+class DummyAsyncEmbeddings(DummyEmbeddings):
+    async def aembed_query(self, prompt, session=None):
+        return self.embed_query(prompt, session)
+
+class DummyAsyncLLM(DummyLLM):
+    async def ainvoke(self, messages):
+        return self.invoke(messages)
+
+class DummyAsyncSemanticCache(DummySemanticCache):
+    async def aget(self, *args, **kwargs):
+        return self.get(*args, **kwargs)
+    async def aset(self, *args, **kwargs):
+        return self.set(*args, **kwargs)
+    async def acoalesce(self, prompt, prompt_embedding, context_hash, generate, threshold=None):
+        return await generate(), "miss"
+
+def test_aquery(monkeypatch):
+    import asyncio
+    retriever = Retriever()
+    retriever.embeddings = DummyAsyncEmbeddings()
+    retriever.llm = DummyAsyncLLM()
+    retriever.semantic_cache = DummyAsyncSemanticCache()
+    monkeypatch.setattr("src.retriever.retriever.get_async_db_session", DummyAsyncSession)
+    result, cache_status, _, _, _ = asyncio.run(retriever.aquery("¿Cuál es la capital de Francia?"))
+    assert "LLM simulada" in result
+    assert cache_status == "miss"
+
+def test_query_reuses_request_session(monkeypatch):
+    retriever = Retriever()
+    retriever.embeddings = DummyEmbeddings()
+    retriever.llm = DummyLLM()
+    sessions = []
+    class SessionRecordingCache(DummySemanticCache):
+        def get(self, prompt, prompt_embedding, context_hash, threshold=None, session=None):
+            sessions.append(session)
+            return super().get(prompt, prompt_embedding, context_hash, threshold)
+        def set(self, *args, **kwargs):
+            sessions.append(kwargs.get("session"))
+            super().set(*args, **kwargs)
+    retriever.semantic_cache = SessionRecordingCache()
+    monkeypatch.setattr("src.retriever.retriever.get_db_session", lambda: pytest.fail("no debe abrir otra sesión"))
+    request_session = DummySession()
+    _, cache_status, _, _, _ = retriever.query("¿Cuál es la capital de Francia?", session=request_session)
+    assert cache_status == "miss"
+    assert sessions == [request_session, request_session]
+
+def test_miss_stores_documents_from_its_own_search(monkeypatch):
+    retriever = Retriever()
+    retriever.embeddings = DummyEmbeddings()
+    retriever.llm = DummyLLM()
+    retriever.semantic_cache = DummySemanticCache()
+    class TopKSession(DummySession):
+        def execute(self, sql, params=None):
+            rows = [(f"doc {i}", 10 + i, -0.9 + i / 10) for i in range(4)]
+            return type("obj", (object,), {"fetchall": lambda self: rows})()
+    monkeypatch.setattr("src.retriever.retriever.apply_search_params", lambda session: None)
+    retriever.query("¿Cuál es la capital de Francia?", session=TopKSession())
+    # Los documentos y la distancia del K-ésimo salen de la búsqueda que produjo el contexto
+    assert retriever.semantic_cache.sources == ([10, 11, 12, 13], pytest.approx(-0.6))
+
+def test_query_many_sends_only_distinct_misses_to_the_llm(monkeypatch):
+    retriever = Retriever()
+    class BatchEmbeddings:
+        def embed_queries(self, prompts, session=None):
+            return [[0.1] * 768 for _ in prompts]
+    class BatchLLM:
+        def __init__(self):
+            self.batches = []
+        def batch(self, inputs, config=None, return_exceptions=False):
+            self.batches.append((len(inputs), config))
+            assert return_exceptions
+            return [
+                RuntimeError("timeout") if m[1][1].endswith("Pregunta: c") else type("obj", (object,), {"content": f"Respuesta {i}"})()
+                for i, m in enumerate(inputs)
+            ]
+    class BatchSession(DummySession):
+        def execute(self, sql, params=None):
+            rows = [
+                (1, "ctx", "h1", "Respuesta cacheada", -0.99, 7, None, [4, 2], None),
+                (2, "ctx", "h1", None, None, None, None, [4, 2], None),
+                (3, "ctx", "h1", None, None, None, None, [4, 2], None),
+                (4, "ctx", "h1", None, None, None, None, [4, 2], None),
+            ]
+            return type("obj", (object,), {"fetchall": lambda self: rows})()
+    class BatchSemanticCache(DummySemanticCache):
+        def check_candidate(self, response, distance, entry_id, radius, threshold=None):
+            return (response, distance) if response is not None else (None, None)
+    retriever.embeddings = BatchEmbeddings()
+    retriever.llm = BatchLLM()
+    retriever.semantic_cache = BatchSemanticCache()
+    monkeypatch.setattr("src.retriever.retriever.apply_search_params", lambda session: None)
+    results, timings = retriever.query_many(["a", "b", "b", "c"], session=BatchSession(), max_concurrency=2)
+    # El miss que falla vuelve como error sin descartar el hit ni el resto del lote
+    assert [status for _, status, _ in results] == ["hit", "miss", "coalesced", "error"]
+    assert results[1][0] == results[2][0] == "Respuesta 0"
+    assert results[3][0] is None
+    assert retriever.llm.batches == [(2, {"max_concurrency": 2})]
+    assert retriever.semantic_cache.calls == [("set", None)]
+    assert {"embed", "batch_probe", "llm", "cache_write"} <= set(timings)
@@ -0,0 +1,32 @@
+from src.app import startup
+from src.app.startup import StartupReport, run_startup
+
+def test_run_startup_builds_clients_and_reports_each_step(monkeypatch):
+    calls = []
+    class Embeddings:
+        def embed_query(self, text_value):
+            calls.append("embed")
+    class Retriever:
+        embeddings = type("obj", (object,), {"embeddings": Embeddings()})()
+    monkeypatch.setattr(startup, "VECTOR_INDEX_CHECK", False)
+    monkeypatch.setattr(startup, "STARTUP_PREWARM_POOL", 3)
+    monkeypatch.setattr(startup, "STARTUP_PREWARM_EMBEDDINGS", True)
+    monkeypatch.setattr(startup, "get_engine", lambda: calls.append("engine"))
+    monkeypatch.setattr(startup, "prewarm_pool", lambda n: calls.append(("pool", n)))
+    monkeypatch.setattr(startup, "get_retriever", lambda: calls.append("retriever") or Retriever())
+    monkeypatch.setattr(startup, "get_indexer", lambda: calls.append("indexer"))
+    monkeypatch.setattr(startup, "get_exact_cache", lambda: calls.append("exact_cache"))
+    report = run_startup(StartupReport()).as_dict()
+    assert calls == ["engine", ("pool", 3), "retriever", "indexer", "exact_cache", "embed"]
+    assert list(report["steps"]) == ["engine", "pool", "clients", "first_embedding"]
+    assert report["total_ms"] >= 0
+
+def test_importing_the_app_does_not_create_engine_or_llm_client():
+    import subprocess
+    import sys
+    code = (
+        "import sys, src.app.main, src.app.db as db; "
+        "print('langchain_google_genai' in sys.modules, db._engine is None)"
+    )
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    assert output.split() == ["False", "True"]
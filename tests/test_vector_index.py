@@ -0,0 +1,35 @@
+import pytest
+import numpy as np
+from src.app.db.vector_index import verify_vector_indexes
+from src.app.utils import normalize_vector
+
+class CatalogSession:
+    def __init__(self, rows):
+        self.rows = rows
+    def execute(self, sql, params=None):
+        rows = self.rows
+        class MockResult:
+            def fetchall(self):
+                return rows
+        return MockResult()
+
+def test_verify_vector_indexes_accepts_matching_opclass():
+    session = CatalogSession([
+        ("idx_documents_embedding", "hnsw", "vector_ip_ops"),
+        ("idx_semantic_cache_embedding", "hnsw", "vector_ip_ops"),
+    ])
+    verify_vector_indexes(session, index_type="hnsw")
+
+def test_verify_vector_indexes_fails_on_cosine_opclass():
+    session = CatalogSession([
+        ("idx_documents_embedding", "ivfflat", "vector_cosine_ops"),
+        ("idx_semantic_cache_embedding", "ivfflat", "vector_ip_ops"),
+    ])
+    with pytest.raises(RuntimeError, match="vector_cosine_ops"):
+        verify_vector_indexes(session, index_type="ivfflat")
+
+def test_normalize_vector_has_unit_norm():
+    vec = normalize_vector([3.0, 4.0])
+    assert vec == pytest.approx([0.6, 0.8])
+    assert normalize_vector([0.0, 0.0]).tolist() == [0.0, 0.0]
+    assert vec.dtype == np.float32